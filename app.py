@@ -1,37 +1,311 @@
 # funcster\backend\app.py
+import base64
+import binascii
+import hashlib
+import hmac
 import json
 import os
-import requests
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, jsonify, request, stream_with_context
 from flask_cors import CORS
-
-from models import db, setup_db, Mentor, Coder, Snippet, User
-from auth import AUTH0_DOMAIN, AUTH0_CLIENT_ID, AUTH0_CONNECTION, AuthError, get_token_auth_header, has_scope, requires_auth
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+
+from models import db, setup_db, check_schema_version, pool_stats, row_versions, username_taken, DB_SCHEMA_CHECK, Mentor, Coder, Snippet, SnippetRevision, SignupOutbox, User, UserDirectory
+from auth import AuthError, requires_auth, verified_tokens
+from cache import RedisCache, ResponseCache
+from metrics import init_app as init_metrics, pool_samples, timed, timed_calls, token_cache_samples
+from replica import ReplicaRouter
+from serializers import encode, mentor_serializer, coder_serializer
+from warmup import Warmup
 
 # ---------------------------------------------------------------------------
 #                     Key for Routes in this file:
 # ---------------------------------------------------------------------------
 # index ('/')
+# healthz ('/healthz')
+# readyz ('/readyz')
+# get_stats ('/stats')
+# get_metrics ('/metrics')
 # signup_user ('signup', POST)
+# get_signup_status ('/signup/<signup_id>')
 # get_user_info ('/userinfo/<username>')
 # get_all_coders ('/coders')
 # get_available_coders ('/coders/available')
-# select_mentor ('/coder/<coder_id>/mentor', PATCH)
+# select_mentor ('/coder/<int:coder_id>/mentor', PATCH)
 # get_mentors ('/mentors')
-# select_coder ('/mentor/<mentor_id>/coder', PATCH)
+# select_coder ('/mentor/<int:mentor_id>/coder', PATCH)
 # get_snippet ('/snippet/<snippet_id>')
 # post_new_snippet ('/snippet', POST)
 # post_revised_snippet ('/snippet/<snippet_id>', PATCH)
 # delete_snippet ('/snippet/<snippet_id>', DELETE)
+# get_snippet_revisions ('/snippet/<snippet_id>/revisions')
+# get_snippet_revision ('/snippet/<snippet_id>/revisions/<number>')
 # favicon ('/favicon')
 # error handlers
 # ---------------------------------------------------------------------------
 
+# default and maximum number of rows returned per page by the list endpoints
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+# rows fetched from the database at a time when a list endpoint is streamed
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+
+'''
+encode_cursor(last_id) / decode_cursor(cursor)
+    the cursors handed out by the list endpoints are opaque to clients; they
+    wrap the id of the last row on a page so the next page can start after it
+    (a cursor that doesn't wrap an integer id, true/false included, is a 400)
+'''
+def encode_cursor(last_id):
+    raw = json.dumps({"after": last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        after = json.loads(raw)["after"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        abort(400)
+    if not isinstance(after, int) or isinstance(after, bool):
+        abort(400)
+    return after
+
+'''
+get_page(query, model)
+    keyset pagination for the list endpoints: reads the 'limit' (1 to
+    MAX_PAGE_SIZE) and 'cursor' query parameters and returns one page of
+    rows ordered by id, plus the cursor for the next page (None on the last
+    page). Each page is a range scan on the primary key (id > cursor), so
+    deep pages cost the same as the first one.
+'''
+def get_page(query, model):
+    limit = request.args.get('limit', PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400)
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        query = query.filter(model.id > decode_cursor(cursor))
+
+    # fetch one extra row to find out whether there is a next page
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+'''
+get_stream_format()
+    reads the 'stream' query parameter of the list endpoints: 'json' streams
+    the same JSON object as a normal response, 'ndjson' streams one JSON
+    object per line (newline delimited JSON). Either way the whole list (after
+    'cursor', if given) is sent, without a page limit. None (the default)
+    means a normal, paginated response.
+'''
+def get_stream_format():
+    stream = request.args.get('stream', None)
+    if stream not in (None, 'json', 'ndjson'):
+        abort(400)
+    return stream
+
+'''
+list_response(name, rows, serialize, next_cursor)
+    the response of a list endpoint, {name: [rows], "next_cursor": ...,
+    "success": true}, written with a serializer from serializers.py (the
+    same bytes as jsonify() of the rows' to_dict()s, without building them)
+'''
+def list_response(name, rows, serialize, next_cursor):
+    with timed('serialization'):
+        body = '{' + encode(name) + ':[' + ','.join([serialize(row) for row in rows]) + \
+            '],"next_cursor":' + encode(next_cursor) + ',"success":true}\n'
+    return Response(body, mimetype='application/json')
+
+'''
+stream_list(name, query, model, serialize, stream)
+    a streamed response for a list endpoint: iterates query with a server
+    side cursor, STREAM_BATCH_SIZE rows at a time (with the query's eager
+    loads run once per batch), and serializes and sends each row as soon as
+    it is read, so memory use doesn't grow with the length of the list.
+    name is the key of the list in the JSON object; with stream='json' the
+    output is byte for byte what list_response() would return for the whole
+    list.
+'''
+def stream_list(name, query, model, serialize, stream):
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        query = query.filter(model.id > decode_cursor(cursor))
+    rows = query.order_by(model.id).execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    serialize = timed_calls('serialization', serialize)
+
+    def generate_ndjson():
+        for row in rows:
+            yield serialize(row) + '\n'
+
+    def generate_json():
+        yield '{' + encode(name) + ':['
+        separator = ''
+        for row in rows:
+            yield separator + serialize(row)
+            separator = ','
+        yield '],"next_cursor":null,"success":true}\n'
+
+    if stream == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+'''
+get_fields()
+    sparse fieldsets for the coder listings: reads the 'view' ('full' or
+    'summary') and 'fields' query parameters and returns the coder fields and
+    snippet fields to serialize. 'fields' is a comma separated list of coder
+    fields, with snippet fields given as 'snippets.<field>', e.g.
+        /coders?fields=id,username,snippets.id,snippets.snippet_name
+    'view=summary' returns ids, usernames, mentor ids and snippet counts only
+    (and, if snippets are asked for in 'fields', leaves out their code and
+    comments). Unknown fields are a 400. The fields come back in the models'
+    order without duplicates, so the same field set always gives the same
+    serializer (see serializers.py), whatever order the client lists it in.
+'''
+def get_fields():
+    view = request.args.get('view', 'full')
+    if view not in ('full', 'summary'):
+        abort(400)
+    default_snippet_fields = Snippet.SUMMARY_FIELDS if view == 'summary' else Snippet.FIELDS
+
+    fields = request.args.get('fields', None)
+    if not fields:
+        if view == 'summary':
+            return Coder.SUMMARY_FIELDS, default_snippet_fields
+        return Coder.FIELDS, default_snippet_fields
+
+    coder_fields, snippet_fields = [], []
+    for field in fields.split(','):
+        field = field.strip()
+        if field.startswith('snippets.'):
+            snippet_fields.append(field[len('snippets.'):])
+        elif field:
+            coder_fields.append(field)
+    if snippet_fields and 'snippets' not in coder_fields:
+        coder_fields.append('snippets')
+
+    if not coder_fields or not set(coder_fields) <= set(Coder.ALL_FIELDS):
+        abort(400)
+    if not set(snippet_fields) <= set(Snippet.FIELDS):
+        abort(400)
+    coder_fields = tuple(field for field in Coder.ALL_FIELDS if field in coder_fields)
+    snippet_fields = tuple(field for field in Snippet.FIELDS if field in snippet_fields)
+    return coder_fields, snippet_fields or default_snippet_fields
+
+'''
+parse_id(value)
+    an id given in a request body (as an integer or a string of digits) as an
+    int, so it compares equal to the ids read from the database; anything
+    else, including true/false and numbers with a fraction, is a 400
+'''
+def parse_id(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    abort(400)
+
+'''
+make_etag(*versions) / set_etag(response, etag)
+    strong ETags for the responses clients poll: the etag is a digest of the
+    request's path and query string and of the (id, version)s of every row
+    the response is built from (see models.row_versions), so it changes
+    whenever one of those rows is updated, added or removed. Routes compare it
+    with If-None-Match before loading anything else, and answer 304 (with an
+    empty body) if the client's copy is still current.
+'''
+def make_etag(*versions):
+    key = repr((request.full_path,) + versions).encode()
+    return hashlib.sha1(key).hexdigest()
+
+def set_etag(response, etag):
+    response.set_etag(etag)
+    # clients may keep the response, but must revalidate it before reuse
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        return set_etag(Response(status=304), etag)
+    return None
+
+'''
+userinfo_versions(entry)
+    the row versions '/userinfo/<username>' is built from, for the user's
+    directory entry: a coder with their snippets, or a mentor with their
+    coders and those coders' snippets
+'''
+def userinfo_versions(entry):
+    if entry.usertype == 'coder':
+        coder = row_versions(Coder, Coder.id == entry.user_id)
+        return ('Coder', coder, row_versions(Snippet, Snippet.coder_id == entry.user_id))
+
+    mentor = row_versions(Mentor, Mentor.id == entry.user_id)
+    coders = row_versions(Coder, Coder.mentor_id == entry.user_id)
+    snippets = []
+    if coders:
+        snippets = row_versions(Snippet, Snippet.coder_id.in_([coder.id for coder in coders]))
+    return ('Mentor', mentor, coders, snippets)
+
+'''
+coder_tags(coder)
+    the response cache tags to invalidate when a coder (or one of their
+    snippets) changes: the coder and mentor listings, and the userinfo of the
+    coder and of the coder's mentor
+'''
+def coder_tags(coder):
+    tags = ['coders', 'mentors', 'user:' + coder.username]
+    if coder.mentor:
+        tags.append('user:' + coder.mentor.username)
+    return tags
+
+
 def create_app(test_config=None):
     app = Flask(__name__)
+    # first, so that its after_request function sees the final response
+    metrics_registry = init_metrics(app)
     setup_db(app)
+    # the tables aren't created here: the schema belongs to the migrations,
+    # so this only makes sure they have been run (see models.SCHEMA_VERSION)
+    if DB_SCHEMA_CHECK:
+        check_schema_version(app)
+
+    # the connection pool's and verified-token cache's statistics (as at
+    # '/stats') are reported at '/metrics' too, summed over the processes
+    def db_pool_samples():
+        with app.app_context():
+            return pool_samples(pool_stats())
+    metrics_registry.add_collector('db_pool', db_pool_samples)
+    metrics_registry.add_collector('token_cache', lambda: token_cache_samples(verified_tokens.stats()))
+
     CORS(app)
 
+    # caches the read endpoints' responses; see cache.py
+    response_cache = ResponseCache()
+    app.extensions['response_cache'] = response_cache
+
+    # sends the read only endpoints to the read replica, if there is one
+    # (see replica.py); shares its record of recent writers between
+    # processes if the response cache is in redis
+    replica_router = ReplicaRouter(response_cache.backend if isinstance(response_cache.backend, RedisCache) else None)
+    app.extensions['replica_router'] = replica_router
+    app.after_request(replica_router.after_request)
+
+    # primes a worker before it takes traffic (run by gunicorn, see
+    # gunicorn.conf.py and warmup.py); '/readyz' reports when it is done
+    warmup = Warmup(app, replica_router)
+    app.extensions['warmup'] = warmup
+
     @app.route('/')
     def index():
         return jsonify({
@@ -39,8 +313,56 @@ def create_app(test_config=None):
         "message": "welcome to funcster."
         })
 
+    # liveness: the worker is up and answering (touches nothing else)
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({
+            "success": True,
+            "status": "alive"
+        })
+
+    # readiness: 503 until this worker has warmed up (its database
+    # connections, mappers and serializers ready), so it gets no traffic cold
+    @app.route('/readyz')
+    def readyz():
+        status = warmup.status()
+        status['success'] = status['ready']
+        return jsonify(status), 200 if status['ready'] else 503
+
+    # live statistics of this worker process: its database connection pool
+    # (see models.pool_stats), its response cache, its verified-token cache
+    # and its read replica routing
+    @app.route('/stats')
+    @requires_auth(scopes=['get:stats'])
+    def get_stats():
+        return jsonify({
+            "success": True,
+            "pid": os.getpid(),
+            "db_pool": pool_stats(),
+            "response_cache": response_cache.stats(),
+            "token_cache": verified_tokens.stats(),
+            "replica": replica_router.stats(),
+            "warmup": warmup.status()
+        })
+
+    # request metrics (per route latency, status, response size, and time
+    # spent in auth, SQL and serialization) added up over all workers, in
+    # prometheus' text format; see metrics.py. A prometheus scraper sends
+    # METRICS_TOKEN as its bearer token; otherwise this is like '/stats'
+    @app.route('/metrics')
+    def get_metrics():
+        token = app.config['METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            return render_metrics()
+        return requires_auth(scopes=['get:stats'])(render_metrics)()
+
+    def render_metrics():
+        return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
     # route for new user signup. requires a username, email address and a status of mentor/coder
+    # the user is registered with auth0 in the background (see worker.py), and
+    # the response's signup_id can be used to follow that at '/signup/<signup_id>'
     @app.route('/signup', methods=['POST'])
     def signup_user():
 
@@ -51,51 +373,37 @@ def create_app(test_config=None):
 
         # set attributes for new User based on body input
         username = body.get('username', None)
-        usertype = body.get('usertype', None)
+        usertype = (body.get('usertype', None) or '').lower()
         email = body.get('email', None)
         password = body.get('password', None)
 
         # proceed only if both required fields are provided
-        if username and usertype:
+        if username and usertype in ('mentor', 'coder'):
 
             # First, check to see if username is already being used in local bd, and abort with 409 (conflict) if so
-            if Mentor.exists(username) or Coder.exists(username):
+            if username_taken(username):
                 abort(409)
 
-        # Then, try to add new user to auth0 database:
-            url = f'https://{AUTH0_DOMAIN}/dbconnections/signup'
-
-            post_object = {
-                "client_id" : AUTH0_CLIENT_ID,
-                "email": email,
-                "password": password,
-                "connection": AUTH0_CONNECTION,
-                "username": username,
-                "user_metadata": {
-                    "role": usertype.title()
-                }
-            }
-
-            auth0_response = requests.post(url, json = post_object)
-            
-            # If there was a problem with auth0 process, abort:
-            if hasattr(auth0_response, 'error'):
-                abort(401)
-
-            # Finally, if auth0 signup orcess successful,
-            # insert user into local database:
-
             # instantiate a new object for the new user
             if usertype == 'mentor':
                 user = Mentor(username = username)
             if usertype == 'coder':
                 user = Coder(username = username)
+            signup = SignupOutbox(username=username, usertype=usertype, email=email, password=password)
             
-            # try to add the new user to the applicable table in the database
+            # try to add the new user to the applicable table in the database,
+            # along with the outbox row that gets it added to auth0 database
             try:
-                user.insert()
+                signup.insert(user)
+            except IntegrityError:
+                # the username was taken by a signup that got in between
+                # (usernames are unique across mentors and coders in the
+                # user directory)
+                db.session.rollback()
+                abort(409)
             except:
                 abort(500)
+            response_cache.invalidate(['coders' if usertype == 'coder' else 'mentors', 'user:' + username])
         
         # if required fields weren't provided in the request, abort with 400
         else:
@@ -103,24 +411,46 @@ def create_app(test_config=None):
         
         return jsonify({
             "success": "True",
-            "user_id": user.id
-        })
+            "user_id": user.id,
+            "signup_id": signup.token,
+            "status": signup.status
+        }), 202
+
+    # status of a signup's registration with auth0: 'pending', 'done' or
+    # 'failed' (with auth0's reason as the "error")
+    @app.route('/signup/<signup_id>')
+    def get_signup_status(signup_id):
+        signup = SignupOutbox.query.filter_by(token=signup_id).first()
+        if not signup:
+            abort(404)
+
+        signup = signup.to_dict()
+        signup['success'] = True
+        return jsonify(signup)
 
     # method used to get information for a user after they're looged in
     # used by the front end's handleAuthentication() process to provide
     # customization depending on usertype
     @app.route('/userinfo/<username>')
-    @requires_auth
+    @requires_auth(scopes=['get:userinfo'])
+    @replica_router.read_only
+    @response_cache.cached(lambda username: ['user:' + username])
     def get_user_info(username):
-        
-        # check permissions:
-        if not has_scope("get:userinfo"):
-            abort(403)
+        # find out whether the user is a coder or a mentor (one lookup in
+        # the user directory); if neither, return 404 error
+        entry = UserDirectory.lookup(username)
+        if entry is None:
+            abort(404)
 
-        # First, check to see if user is a Coder
-        # If so, return relevant information for profile on front end
-        coder = Coder.get_by_name(username)
-        if coder:
+        # If the client's copy is still current, there's nothing more to do
+        etag = make_etag(*userinfo_versions(entry))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # If the user is a Coder, return relevant information for profile on front end
+        if entry.usertype == 'coder':
+            coder = Coder.with_snippets().options(joinedload(Coder.mentor)).get(entry.user_id)
             if coder.mentor:
                 mentor = coder.mentor.username
             else:
@@ -131,206 +461,199 @@ def create_app(test_config=None):
             else:
                 snippets = []
 
-            return jsonify({
+            return set_etag(jsonify({
                 "success": True,
                 "user_id": coder.id,
                 "usertype": "Coder",
                 "mentor": mentor,
                 "snippets": snippets
-            })
+            }), etag)
         
-        # If not a coder, then check to see if user is a Mentor
-        # If so, return relevant information for profile on front end
-        mentor = Mentor.get_by_name(username)
-        if mentor:
-            coders = []
-            if mentor.coders:
-                coder_objs = mentor.coders 
-                for coder in coder_objs:
-                    coders.append({ 
-                        "username": coder.username, 
-                        "id": coder.id,
-                        "snippets": [snippet.to_dict() for snippet in coder.snippets if snippet.needs_review] 
-                        })
-
-            else:
-                coders = []
+        # Otherwise the user is a Mentor; return relevant information for
+        # profile on front end
+        mentor = Mentor.query.get(entry.user_id)
+        coders = []
+        for coder, snippets in mentor.coders_for_review():
+            coders.append({ 
+                "username": coder.username, 
+                "id": coder.id,
+                "snippets": [snippet.to_dict() for snippet in snippets] 
+                })
 
-            return jsonify({
-                "success": True,
-                "user_id": mentor.id,
-                "usertype": "Mentor",
-                "coders": coders
-            })
-        
-        # If neither a coder nor a mentor is found, return 404 error
-        abort(404)
+        return set_etag(jsonify({
+            "success": True,
+            "user_id": mentor.id,
+            "usertype": "Mentor",
+            "coders": coders
+        }), etag)
 
 
     # return all current coders
     @app.route('/coders')
-    @requires_auth
+    @requires_auth(scopes=['get:coders'])
+    @replica_router.read_only
+    @response_cache.cached(lambda: ['coders'])
     def get_all_coders():
-        
-        if not has_scope('get:coders'):
-            abort(403)
-
+        fields, snippet_fields = get_fields()
+        stream = get_stream_format()
+        if stream:
+            return stream_list('coders', Coder.with_snippets(fields, snippet_fields), Coder,
+                               coder_serializer(fields, snippet_fields), stream)
+
+        # page through the coders' row versions first, and only load and
+        # serialize the page if the client's copy of it is out of date
+        page, next_cursor = get_page(Coder.query.with_entities(Coder.id, Coder.version), Coder)
+        coder_ids = [coder.id for coder in page]
+        snippets = row_versions(Snippet, Snippet.coder_id.in_(coder_ids)) if coder_ids else []
+        etag = make_etag(page, snippets)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        coders = []
+        if coder_ids:
+            coders = Coder.with_snippets(fields, snippet_fields).filter(Coder.id.in_(coder_ids)).order_by(Coder.id).all()
         try:
-            coders = [coder.to_dict() for coder in Coder.query.all()]
-            return jsonify ({
-                "success": True,
-                "coders": coders
-            })
+            return set_etag(list_response(
+                'coders', coders, coder_serializer(fields, snippet_fields), next_cursor), etag)
         except:
             abort(500)
 
     # return all coders who do not currently have mentors
     @app.route('/coders/available')
-    @requires_auth
+    @requires_auth(scopes=['get:coders'])
+    @replica_router.read_only
+    @response_cache.cached(lambda: ['coders'])
     def get_available_coders():
+        fields, snippet_fields = get_fields()
+        available_coders, next_cursor = get_page(Coder.need_mentor(fields, snippet_fields), Coder)
+        try:
+            return list_response(
+                'coders', available_coders, coder_serializer(fields, snippet_fields), next_cursor)
+        except:
+            abort(500)
 
-        if not has_scope('get:coders'):
-            abort(403)
 
-        try:
-            available_coders = [coder.to_dict() for coder in Coder.need_mentor()]
+    # makes mentor_id the mentor of coder_id with a single UPDATE (see
+    # Coder.assign_mentor) and drops the cached responses it affects; returns
+    # False if that already was the coder's mentor
+    def assign_mentor(coder_id, mentor_id):
+        mentor = db.session.query(Mentor.username).filter(Mentor.id == mentor_id).first()
+        if not mentor:
+            abort(404)
 
-            return jsonify({
-                "success": True,
-                "coders": available_coders
-            })
+        try:
+            assigned = Coder.assign_mentor(coder_id, mentor_id)
+            db.session.commit()
         except:
+            db.session.rollback()
             abort(500)
 
+        if not assigned:
+            # either there is no such coder, or the mentor was already theirs
+            if not db.session.query(db.exists().where(Coder.id == coder_id)).scalar():
+                abort(404)
+            return False
+
+        username, previous_mentor = assigned
+        tags = ['coders', 'mentors', 'user:' + username, 'user:' + mentor.username]
+        if previous_mentor:
+            tags.append('user:' + previous_mentor)
+        response_cache.invalidate(tags)
+        return True
 
     # Route to add/update the mentor selected for a specific coder:
-    # (If the coder is already associated with another mentor, this function
-    # first breaks that association and then adds the new mentor association)
-    @app.route('/coder/<coder_id>/mentor', methods=['PATCH'])
-    @requires_auth
+    # (If the coder is already associated with another mentor, this replaces
+    # that association)
+    @app.route('/coder/<int:coder_id>/mentor', methods=['PATCH'])
+    @requires_auth(scopes=['add:mentor'])
     def select_mentor(coder_id):
-
-        if not has_scope('add:mentor'):
-            abort(403)
-
         body = request.get_json()
-        mentor_id = body.get('mentorId', None)
-        if not mentor_id:
-            abort(400)
-        
-        mentor = Mentor.query.get(mentor_id)
-        if not mentor:
-            abort(404)
+        mentor_id = parse_id(body.get('mentorId', None))
 
-        coder = Coder.query.get(coder_id)
-        if not coder:
-            abort(404)
-        
-        try:
-            # check to see if the coder already has a mentor:
-            if coder.mentor_id:
-                # if the coder is already associated with the mentor from the call
-                # then no more need be done
-                if (coder.mentor_id == mentor_id):
-                    return jsonify({
-                        "success": True,
-                        "message": "This mentor was already the mentor for this coder."
-                    })
-                # if the coder is associated with a different mentor, then remove the coder
-                # from that mentor's list of coders
-                else:
-                    current_mentor = Mentor.query.get(coder.mentor_id)
-                    current_mentor.coders.remove(coder)
-                    current_mentor.update()
-            
-            # then, add the coder to the new mentor's list of coders
-            mentor.coders.append(coder)
-            mentor.update()
+        if not assign_mentor(coder_id, mentor_id):
             return jsonify({
                 "success": True,
-                "message": "A new mentor has been selected for this coder."
+                "message": "This mentor was already the mentor for this coder."
             })
-        except:
-            abort(500)
+        return jsonify({
+            "success": True,
+            "message": "A new mentor has been selected for this coder."
+        })
 
     # return all current mentors
     @app.route('/mentors', methods=['GET'])
-    @requires_auth
+    @requires_auth(scopes=['get:mentors'])
+    @replica_router.read_only
+    @response_cache.cached(lambda: ['mentors'])
     def get_mentors():
-        if not has_scope("get:mentors"):
-            abort(403)
+        coder_fields, snippet_fields = get_fields()
+        stream = get_stream_format()
+        if stream:
+            return stream_list('mentors', Mentor.with_coders(coder_fields, snippet_fields), Mentor,
+                               mentor_serializer(coder_fields, snippet_fields), stream)
 
+        mentors, next_cursor = get_page(Mentor.with_coders(coder_fields, snippet_fields), Mentor)
         try:
-            mentors = [mentor.to_dict() for mentor in Mentor.query.all()]
-            return jsonify ({
-                "success": True,
-                "mentors": mentors
-            })
+            return list_response(
+                'mentors', mentors, mentor_serializer(coder_fields, snippet_fields), next_cursor)
         except:
             abort(500)
         
     # add a coder to a mentor's list of coders
-    @app.route('/mentor/<mentor_id>/coder', methods=['PATCH'])
-    @requires_auth
+    @app.route('/mentor/<int:mentor_id>/coder', methods=['PATCH'])
+    @requires_auth(scopes=['add:coder'])
     def select_coder(mentor_id):
-
-        if not has_scope('add:coder'):
-            abort(403)
-
         body = request.get_json()
-        coder_id = body.get('coderId', None)
-        if not coder_id:
-            abort(400)
-        
-        coder = Coder.query.get(coder_id)
-        if not coder:
-            abort(404)
-        
-        mentor = Mentor.query.get(mentor_id)
-        if not mentor:
-            abort(404)
-        
-        try:
-            mentor.coders.append(coder)
-            mentor.update()
+        coder_id = parse_id(body.get('coderId', None))
+
+        if not assign_mentor(coder_id, mentor_id):
             return jsonify({
                 "success": True,
-                "message": "A new coder has been added to your list of coders."
+                "message": "This coder was already in your list of coders."
             })
-        except:
-            abort(500)
+        return jsonify({
+            "success": True,
+            "message": "A new coder has been added to your list of coders."
+        })
 
 
     # endpoint to obtain information about a specific snippet:
     @app.route('/snippet/<snippet_id>')
-    @requires_auth
+    @requires_auth(scopes=['edit:snippet'])
+    @replica_router.read_only
     def get_snippet(snippet_id):
-        
-        if not has_scope('edit:snippet'):
-            abort(403)
-        
-        snippet = Snippet.query.get(snippet_id)
+        # checks the snippet's version (without loading its code) first
+        versions = row_versions(Snippet, Snippet.id == snippet_id)
+        if not versions:
+            abort(404)
+        etag = make_etag(versions)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        snippet = Snippet.query.options(joinedload(Snippet.blob)).get(snippet_id)
         if not snippet:
             abort(404)
         
         snippet = snippet.to_dict()
         snippet['success'] = True
         
-        return jsonify(snippet)
+        return set_etag(jsonify(snippet), etag)
 
 
     # route to post new snippet to database
     @app.route('/snippet', methods=['POST'])
-    @requires_auth
+    @requires_auth(scopes=['post:snippet'])
     def post_new_snippet():
-        
-        if not has_scope("post:snippet"):
-            abort(403)
-
         body = request.get_json()
 
+        # only the coder's key, username and mentor's username are needed
+        # (for the cache tags), not the coder or their snippets
         coderId = body.get('coderId', None)
-        coder = Coder.query.get(coderId)
+        coder = db.session.query(Coder.id, Coder.username, Mentor.username.label('mentor')) \
+            .outerjoin(Mentor, Mentor.id == Coder.mentor_id) \
+            .filter(Coder.id == coderId).first()
         
         if not coder:
             abort(404)
@@ -343,11 +666,15 @@ def create_app(test_config=None):
 
         if attrs['snippet_name'] and attrs['code']:
             try:
-                snippet = Snippet(**attrs)
-                # insert snippet by appending as a child to its coder and 
-                # updating coder
-                coder.snippets.append(snippet)
-                coder.update()
+                snippet = Snippet(coder_id=coder.id, **attrs)
+                # insert snippet directly by its coder_id (along with the
+                # snippet's first revision)
+                SnippetRevision.record(snippet, None, None, 'Coder', coder.id)
+                snippet.insert()
+                tags = ['coders', 'mentors', 'user:' + coder.username]
+                if coder.mentor:
+                    tags.append('user:' + coder.mentor)
+                response_cache.invalidate(tags)
                 return jsonify({
                     "success": True,
                     "message": "Snippet has been successfully saved to database"
@@ -360,12 +687,8 @@ def create_app(test_config=None):
 
     # route to update a snippet in the database once it has been revised/edited on front end
     @app.route('/snippet/<snippet_id>', methods=['PATCH'])
-    @requires_auth
+    @requires_auth(scopes=['edit:snippet'])
     def post_revised_snippet(snippet_id):
-        
-        if not has_scope('edit:snippet'):
-            abort(403)
-
         body = request.get_json()
 
         # check to be sure required fields (body and code) are in snippet,
@@ -404,27 +727,31 @@ def create_app(test_config=None):
             abort(404)
         
         try:
-            snippet.snippet_name = body.get('name')
-            snippet.code = body.get('code')
-            snippet.needs_review = body.get('needsReview', False)
-            snippet.comments = body.get('comments', '')
+            # keeps the previous version in the snippet's revision history
+            snippet.revise(
+                body.get('name'),
+                body.get('code'),
+                body.get('needsReview', False),
+                body.get('comments', ''),
+                usertype,
+                user_id)
 
             snippet.update()
+            response_cache.invalidate(coder_tags(snippet.coder))
             return jsonify({
                 "success": True,
                 "message": "Snippet has been successfully updated in database"
             })
+        except StaleDataError:
+            # changed or deleted by someone else since it was read (see edit_conflict below)
+            raise
         except:
             abort(500)
 
     # route to delete a snippet
     @app.route('/snippet/<snippet_id>', methods=['DELETE'])
-    @requires_auth
+    @requires_auth(scopes=['delete:snippet'])
     def delete_snippet(snippet_id):
-        # verify has permission to delete a snippet
-        if not has_scope('delete:snippet'):
-            abort(403)
-
         body = request.get_json()
         # check to make sure a coder_id was supplied, if not return 400
         coder_id = body.get('coderId', None)
@@ -450,11 +777,43 @@ def create_app(test_config=None):
         
         try:
             snippet.delete()
+            response_cache.invalidate(coder_tags(coder))
             return jsonify({ "success": True, "message": "Snippet has been deleted."})
+        except StaleDataError:
+            # changed or deleted by someone else since it was read (see edit_conflict below)
+            raise
         except:
             abort(500)
 
 
+    # list the revisions of a snippet, oldest first (without their code)
+    @app.route('/snippet/<snippet_id>/revisions')
+    @requires_auth(scopes=['edit:snippet'])
+    def get_snippet_revisions(snippet_id):
+        snippet = Snippet.query.get(snippet_id)
+        if not snippet:
+            abort(404)
+
+        revisions = snippet.revisions.order_by(SnippetRevision.number)
+        return jsonify({
+            "success": True,
+            "snippet_id": snippet.id,
+            "revisions": [revision.to_dict() for revision in revisions]
+        })
+
+    # get one revision of a snippet, including its code as it was then
+    @app.route('/snippet/<snippet_id>/revisions/<int:number>')
+    @requires_auth(scopes=['edit:snippet'])
+    def get_snippet_revision(snippet_id, number):
+        revision = SnippetRevision.query.filter_by(snippet_id=snippet_id, number=number).first()
+        if not revision:
+            abort(404)
+
+        revision = revision.to_dict(include_code=True)
+        revision['success'] = True
+        return jsonify(revision)
+
+
     # route to quell 404 errors from favicon requests when serving api separately
     @app.route('/favicon.ico')
     def favicon():
@@ -465,6 +824,14 @@ def create_app(test_config=None):
     # Error Handler Routes
     #----------------------------------------------------------------------------#
 
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+        "success": False,
+        "error": 400,
+        "message": "I'm afraid I don't understand. Your request was missing something or was malformed."
+        }), 400
+
     @app.errorhandler(403)
     def not_found(error):
         return jsonify({
@@ -491,6 +858,18 @@ def create_app(test_config=None):
         }), 409
 
 
+    # a user or snippet changed by another request between being read and
+    # written (their version columns no longer match, see models.py)
+    @app.errorhandler(StaleDataError)
+    def edit_conflict(error):
+        db.session.rollback()
+        return jsonify({
+        "success": False,
+        "error": 409,
+        "message": "Someone else changed this while you were at it. Please reload it and try again."
+        }), 409
+
+
     @app.errorhandler(500)
     def internal_server(error):
         return jsonify({
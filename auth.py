@@ -1,24 +1,45 @@
+import hashlib
 import json
 import os
-import requests
-from flask import request, _request_ctx_stack
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from six.moves.urllib.request import urlopen
 
+from metrics import timed
+
 
 '''
 NOTE!! If you deploy this package, you would need to replace the following
 environment variables with information from your own auth0 account (application and api)
 either by setting/exporting them via the command line or storing them in an .env file
 and installing dotenv to run them as part of your flask run
+They are only used once a token is checked (or a signup sent to auth0), so the
+app can be loaded without them, e.g. by manage.py or the benchmarks.
 '''
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-AUTH0_CLIENT_ID = os.environ['AUTH0_CLIENT_ID']
-AUTH0_CONNECTION = os.environ['AUTH0_CONNECTION']
-API_IDENTIFIER = os.environ['API_IDENTIFIER']
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
+AUTH0_CLIENT_ID = os.environ.get('AUTH0_CLIENT_ID')
+AUTH0_CONNECTION = os.environ.get('AUTH0_CONNECTION')
+API_IDENTIFIER = os.environ.get('API_IDENTIFIER')
 ALGORITHMS = ["RS256"]
 
+# JWKS caching behaviour (all values in seconds). The TTL is only a fallback
+# for when Auth0 doesn't send a Cache-Control max-age with the key set.
+JWKS_URL = "https://"+AUTH0_DOMAIN+"/.well-known/jwks.json" if AUTH0_DOMAIN else None
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_STALE_TTL = int(os.environ.get('JWKS_STALE_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# Verified-token cache: maximum number of tokens kept, and the longest (in
+# seconds) a verified token is trusted before being re-verified, even if its
+# exp claim is further away.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -60,77 +81,310 @@ def get_token_auth_header():
     return token
 
 
-def has_scope(required_scope):
-    """Determines if the required scope is present in the access token
-    Args:
-        required_scope (str): The scope required to access the resource
-    """
-    token = get_token_auth_header()
-    unverified_claims = jwt.get_unverified_claims(token)
+'''
+JWKSKeyStore - process-wide cache of the signing keys published by Auth0
+    - keys are fetched once and kept for the Cache-Control max-age of the
+      response (or JWKS_CACHE_TTL if the response doesn't specify one)
+    - a key object is built once per kid and reused for every request
+    - once the TTL has passed, cached keys keep being served for up to the
+      stale window while a background thread refreshes them, so a refresh
+      never blocks a request
+    - a token with an unknown kid triggers a refresh, but at most once per
+      min_refresh_interval so that bad tokens can't cause a refetch storm
+    EXAMPLE
+        store = JWKSKeyStore("https://example.auth0.com/.well-known/jwks.json")
+        key = store.get_key(unverified_header["kid"])
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, stale_ttl=JWKS_STALE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}     # kid -> ((n, e), key object)
+        self._expires_at = 0
+        self._stale_until = 0
+        self._last_attempt = 0
+        self._lock = threading.Lock()          # held while fetching
+        self._refreshing_lock = threading.Lock()
+        self._refreshing = False
 
-    if unverified_claims.get("permissions"):
-        token_scopes = unverified_claims.get("permissions")
-        for token_scope in token_scopes:
-            if token_scope == required_scope:
-                return True
-    return False
+    def get_key(self, kid):
+        """Returns the key object for kid, or None if Auth0 doesn't publish it
+        """
+        now = time.time()
+        if now >= self._expires_at:
+            if self._keys and now < self._stale_until:
+                self._refresh_in_background()
+            else:
+                self.refresh()
 
+        entry = self._keys.get(kid)
+        if entry is None and now - self._last_attempt >= self.min_refresh_interval:
+            # the signing keys may have been rotated since our last fetch
+            self.refresh()
+            entry = self._keys.get(kid)
+        return entry[1] if entry else None
 
-def requires_auth(f):
-    """Determines if the access token is valid
-    """
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = get_token_auth_header()
-        jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
-        try:
-            unverified_header = jwt.get_unverified_header(token)
-        except jwt.JWTError:
-            raise AuthError({"code": "invalid_header",
-                            "description":
-                                "Invalid header. "
-                                "Use an RS256 signed JWT Access Token"}, 401)
-        if unverified_header["alg"] == "HS256":
-            raise AuthError({"code": "invalid_header",
-                            "description":
-                                "Invalid header. "
-                                "Use an RS256 signed JWT Access Token"}, 401)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
+    def refresh(self, force=False):
+        """Fetches the key set from Auth0 and replaces the cached keys
+        (rate limited to one fetch per min_refresh_interval unless forced)
+        """
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_attempt < self.min_refresh_interval:
+                return
+            self._last_attempt = now
+            try:
+                response = urlopen(self.url, timeout=self.timeout)
+                jwks = json.loads(response.read())
+                max_age, stale = self._parse_cache_control(
+                    response.headers.get("Cache-Control", ""))
+            except Exception:
+                if not self._keys:
+                    raise AuthError({"code": "jwks_unavailable",
+                                    "description":
+                                        "Unable to fetch signing keys"}, 503)
+                # keep serving the keys we already have
+                self._stale_until = max(self._stale_until, now + self.min_refresh_interval)
+                return
+
+            # jose takes a while to import (its ecdsa backend builds tables
+            # on import), so that is left until keys are first needed
+            from jose import jwk
+            keys = {}
+            for key in jwks.get("keys", []):
+                kid = key.get("kid")
+                if not kid or key.get("kty") != "RSA":
+                    continue
+                existing = self._keys.get(kid)
+                if existing is not None and existing[0] == (key["n"], key["e"]):
+                    keys[kid] = existing
+                    continue
+                keys[kid] = ((key["n"], key["e"]), jwk.construct({
                     "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
+                    "kid": kid,
+                    "use": key.get("use", "sig"),
                     "n": key["n"],
                     "e": key["e"]
-                }
-        if rsa_key:
+                }, ALGORITHMS[0]))
+
+            ttl = self.ttl if max_age is None else max(max_age, self.min_refresh_interval)
+            self._keys = keys
+            self._expires_at = now + ttl
+            self._stale_until = self._expires_at + (self.stale_ttl if stale is None else stale)
+
+    def _refresh_in_background(self):
+        # not under self._lock, which the refresh holds while it fetches
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
             try:
-                payload = jwt.decode(
-                    token,
-                    rsa_key,
-                    algorithms=ALGORITHMS,
-                    audience=API_IDENTIFIER,
-                    issuer="https://"+AUTH0_DOMAIN+"/"
-                )
-            except jwt.ExpiredSignatureError:
-                raise AuthError({"code": "token_expired",
-                                "description": "token is expired"}, 401)
-            except jwt.JWTClaimsError:
-                raise AuthError({"code": "invalid_claims",
-                                "description":
-                                    "incorrect claims,"
-                                    " please check the audience and issuer"}, 401)
-            except Exception:
-                raise AuthError({"code": "invalid_header",
-                                "description":
-                                    "Unable to parse authentication"
-                                    " token."}, 401)
+                self.refresh()
+            except AuthError:
+                pass
+            finally:
+                self._refreshing = False
 
-            _request_ctx_stack.top.current_user = payload
-            return f(*args, **kwargs)
+        threading.Thread(target=run, daemon=True).start()
+
+    @staticmethod
+    def _parse_cache_control(header):
+        max_age = re.search(r"max-age=(\d+)", header)
+        stale = re.search(r"stale-while-revalidate=(\d+)", header)
+        return (int(max_age.group(1)) if max_age else None,
+                int(stale.group(1)) if stale else None)
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+
+'''
+VerifiedTokenCache - bounded LRU cache of verified token payloads
+    - entries are keyed by a sha256 digest of the token, so raw bearer
+      tokens are never kept in memory
+    - an entry expires at the token's exp claim, or after max_ttl seconds
+      if that comes sooner
+    - hits and misses are counted so the hit rate can be monitored
+    EXAMPLE
+        payload = verified_tokens.get(token)
+        if payload is None:
+            payload = verify_token(token, rsa_key)
+            verified_tokens.put(token, payload)
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # digest -> (expires_at, payload)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        """Returns the cached payload for token, or None if it isn't cached
+        (or has expired)
+        """
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        """Caches a verified payload until its exp claim (or max_ttl)
+        """
+        if self.maxsize <= 0:
+            return
+        expires_at = time.time() + self.max_ttl
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (expires_at, payload)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+verified_tokens = VerifiedTokenCache()
+
+
+def has_scope(required_scope):
+    """Determines if the required scope is present in the verified access token
+    (only meaningful inside a view decorated with requires_auth)
+    Args:
+        required_scope (str): The scope required to access the resource
+    """
+    permissions = getattr(_request_ctx_stack.top, "current_permissions", frozenset())
+    return required_scope in permissions
+
+
+def verify_token(token, rsa_key):
+    """Checks the token's signature against an already-built key object and
+    validates its claims, returning the verified payload
+    """
+    from jose import jwt
+    from jose.utils import base64url_decode
+    try:
+        signing_input, crypto_segment = token.encode("utf-8").rsplit(b".", 1)
+        signature_ok = rsa_key.verify(signing_input, base64url_decode(crypto_segment))
+    except Exception:
+        signature_ok = False
+    if not signature_ok:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Unable to parse authentication"
+                            " token."}, 401)
+    try:
+        # the signature has been checked above, so jose only validates claims
+        return jwt.decode(
+            token,
+            "",
+            algorithms=ALGORITHMS,
+            audience=API_IDENTIFIER,
+            issuer="https://"+AUTH0_DOMAIN+"/",
+            options={"verify_signature": False}
+        )
+    except jwt.ExpiredSignatureError:
+        raise AuthError({"code": "token_expired",
+                        "description": "token is expired"}, 401)
+    except jwt.JWTClaimsError:
+        raise AuthError({"code": "invalid_claims",
+                        "description":
+                            "incorrect claims,"
+                            " please check the audience and issuer"}, 401)
+    except Exception:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Unable to parse authentication"
+                            " token."}, 401)
+
+
+def get_verified_payload(token):
+    """Returns the verified payload for a bearer token, from the verified-token
+    cache if this token has been seen before
+    """
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
+    from jose import jwt
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Invalid header. "
+                            "Use an RS256 signed JWT Access Token"}, 401)
+    if unverified_header.get("alg") not in ALGORITHMS:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                            "Invalid header. "
+                            "Use an RS256 signed JWT Access Token"}, 401)
+    rsa_key = jwks_store.get_key(unverified_header.get("kid"))
+    if not rsa_key:
         raise AuthError({"code": "invalid_header",
                         "description": "Unable to find appropriate key"}, 401)
-    return decorated
\ No newline at end of file
+    payload = verify_token(token, rsa_key)
+    verified_tokens.put(token, payload)
+    return payload
+
+
+def requires_auth(f=None, scopes=()):
+    """Determines if the access token is valid and, if scopes are given, that
+    its verified permissions include every one of them (aborts with 403 if not)
+    Can be used bare or with arguments:
+        @requires_auth
+        @requires_auth(scopes=['get:coders'])
+    """
+    if isinstance(scopes, str):
+        scopes = (scopes,)
+    required = frozenset(scopes)
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = get_verified_payload(token)
+                permissions = frozenset(payload.get("permissions") or ())
+                ctx = _request_ctx_stack.top
+                ctx.current_user = payload
+                ctx.current_permissions = permissions
+                if not required <= permissions:
+                    abort(403)
+            return f(*args, **kwargs)
+        return decorated
+
+    if f is not None:
+        return decorator(f)
+    return decorator
@@ -0,0 +1,234 @@
+import datetime
+import email.utils
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from auth import AUTH0_DOMAIN, AUTH0_CLIENT_ID, AUTH0_CONNECTION
+
+
+# Calls to the auth0 authentication api (signup). Timeouts are in seconds;
+# AUTH0_MAX_RETRIES is the number of retries after the first attempt, with
+# exponential backoff (AUTH0_RETRY_BACKOFF, doubling each time) plus random
+# jitter. After AUTH0_BREAKER_THRESHOLD consecutive failures the circuit
+# breaker fails calls straight away for AUTH0_BREAKER_RESET seconds. A
+# response asking to retry after more than AUTH0_MAX_RETRY_AFTER seconds isn't
+# retried here (the signup worker tries again later).
+AUTH0_BASE_URL = os.environ.get('AUTH0_BASE_URL', 'https://' + AUTH0_DOMAIN if AUTH0_DOMAIN else None)
+AUTH0_CONNECT_TIMEOUT = float(os.environ.get('AUTH0_CONNECT_TIMEOUT', 3.05))
+AUTH0_READ_TIMEOUT = float(os.environ.get('AUTH0_READ_TIMEOUT', 10))
+AUTH0_MAX_RETRIES = int(os.environ.get('AUTH0_MAX_RETRIES', 2))
+AUTH0_RETRY_BACKOFF = float(os.environ.get('AUTH0_RETRY_BACKOFF', 0.25))
+AUTH0_POOL_SIZE = int(os.environ.get('AUTH0_POOL_SIZE', 10))
+AUTH0_BREAKER_THRESHOLD = int(os.environ.get('AUTH0_BREAKER_THRESHOLD', 5))
+AUTH0_BREAKER_RESET = float(os.environ.get('AUTH0_BREAKER_RESET', 30))
+AUTH0_MAX_RETRY_AFTER = float(os.environ.get('AUTH0_MAX_RETRY_AFTER', 5))
+
+# responses meaning auth0 itself turned the request away unprocessed, so it is
+# safe to retry (a 502 or 504 comes from a gateway in front of auth0, and the
+# request may have reached auth0 all the same)
+RETRY_STATUSES = (429, 503)
+
+
+'''
+Auth0Error Exception
+    - status_code 4xx: auth0 rejected the request (e.g. a password that is too
+      weak, or an email address that is already registered); error holds
+      auth0's error body
+    - status_code 503: auth0 couldn't be reached, timed out, kept failing, or
+      the circuit breaker is open
+'''
+class Auth0Error(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+'''
+CircuitBreaker - stops calling a service that keeps failing
+    - closed: calls go through; `threshold` consecutive failures open it
+    - open: allow() is False (callers fail fast) until reset_timeout seconds
+      have passed
+    - half open: after that, one trial call is let through; its success
+      closes the breaker again, its failure re-opens it
+'''
+class CircuitBreaker:
+    def __init__(self, threshold=AUTH0_BREAKER_THRESHOLD, reset_timeout=AUTH0_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+'''
+Auth0Client - shared client for the auth0 authentication api
+    - one requests.Session, so connections (and their TLS sessions) are kept
+      alive and reused from a pool rather than set up for every signup
+    - every request has a connect and a read timeout
+    - retries, with exponential backoff and jitter, only where the request
+      can't have been processed by auth0: connections that couldn't be made
+      (refused, or timed out) and 429/503 responses, after their Retry-After
+      if they have one. A read timeout, a connection lost once the request
+      was sent, or a 502/504 isn't retried, as the user may have been created
+      already (the signup worker retries those later, and treats auth0's
+      "user exists" answer to a retry as done).
+    - a circuit breaker fails calls fast while auth0 is down; every call it
+      lets through records a success or a failure with it
+    EXAMPLE
+        auth0_client.signup('coder@email.com', 'password', 'coder7', 'Coder')
+'''
+class Auth0Client:
+    def __init__(self, base_url=AUTH0_BASE_URL,
+                 timeout=(AUTH0_CONNECT_TIMEOUT, AUTH0_READ_TIMEOUT),
+                 max_retries=AUTH0_MAX_RETRIES, backoff=AUTH0_RETRY_BACKOFF,
+                 pool_size=AUTH0_POOL_SIZE, breaker=None, max_retry_after=AUTH0_MAX_RETRY_AFTER):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def signup(self, email, password, username, role):
+        """Registers a user with the auth0 database connection and returns
+        auth0's response body (raises Auth0Error if that fails)
+        """
+        return self.post('/dbconnections/signup', {
+            "client_id": AUTH0_CLIENT_ID,
+            "email": email,
+            "password": password,
+            "connection": AUTH0_CONNECTION,
+            "username": username,
+            "user_metadata": {
+                "role": role
+            }
+        })
+
+    def post(self, path, body):
+        if self.base_url is None:
+            raise Auth0Error({"code": "auth0_not_configured",
+                              "description": "AUTH0_DOMAIN is not set"}, 503)
+        if not self.breaker.allow():
+            raise Auth0Error({"code": "auth0_unavailable",
+                              "description": "Auth0 is unavailable (circuit open)"}, 503)
+
+        retry_after = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # as long as auth0 asked for, or with full jitter: a random
+                # wait of up to backoff * 2^(attempt-1)
+                if retry_after is None:
+                    retry_after = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                time.sleep(retry_after)
+                retry_after = None
+            try:
+                response = self.session.post(self.base_url + path, json=body, timeout=self.timeout)
+            except requests.exceptions.ConnectTimeout:
+                continue
+            except requests.exceptions.ReadTimeout:
+                self.breaker.record_failure()
+                raise Auth0Error({"code": "auth0_timeout",
+                                  "description": "Auth0 didn't respond in time"}, 503)
+            except requests.exceptions.ConnectionError as error:
+                if self._not_connected(error):
+                    continue
+                self.breaker.record_failure()
+                raise Auth0Error({"code": "auth0_connection_lost",
+                                  "description": "The connection to Auth0 was lost"}, 503)
+            except requests.exceptions.RequestException as error:
+                self.breaker.record_failure()
+                raise Auth0Error({"code": "auth0_request_failed",
+                                  "description": "The request to Auth0 failed: {}".format(error)}, 503)
+            if response.status_code in RETRY_STATUSES:
+                retry_after = self._retry_after(response)
+                if retry_after is not None and retry_after > self.max_retry_after:
+                    break
+                continue
+
+            if response.status_code >= 500:
+                break
+            self.breaker.record_success()
+            if response.status_code >= 400:
+                raise Auth0Error(self._error_body(response), response.status_code)
+            return response.json()
+
+        self.breaker.record_failure()
+        raise Auth0Error({"code": "auth0_unavailable",
+                          "description": "Unable to reach Auth0"}, 503)
+
+    @staticmethod
+    def _not_connected(error):
+        # the connection couldn't be made (e.g. refused), so nothing was sent
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def _retry_after(response):
+        # the seconds to wait given by a Retry-After header (as a number of
+        # seconds or as a date), or None if there is none
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+    @staticmethod
+    def _error_body(response):
+        try:
+            error = response.json()
+        except ValueError:
+            error = None
+        return error if isinstance(error, dict) else {"description": response.text}
+
+
+auth0_client = Auth0Client()
@@ -0,0 +1,123 @@
+'''
+bench_review_queue.py - compares the two ways of building a mentor's review
+queue for '/userinfo/<username>':
+
+    python_filter : load every snippet of every coder of the mentor and keep
+                    the ones with needs_review in python (the old approach)
+    sql_filter    : Mentor.coders_for_review(), a single query joining coders
+                    to snippets on needs_review, served by the partial index
+                    ix_snippet_coder_id_needs_review
+
+USAGE
+    BENCH_DATABASE_URL=postgresql://localhost/funcster_bench python benchmarks/bench_review_queue.py
+    (defaults to a throwaway sqlite database; use a separate postgres database,
+    as the benchmark drops and recreates all tables)
+
+    optional: BENCH_SNIPPETS (default 100000), BENCH_CODERS (default 200),
+              BENCH_REVIEW_RATIO (default 0.02), BENCH_REPEAT (default 10)
+'''
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models import db, setup_db, CodeBlob, Mentor, Coder, Snippet
+
+SNIPPETS = int(os.environ.get('BENCH_SNIPPETS', 100000))
+CODERS = int(os.environ.get('BENCH_CODERS', 200))
+REVIEW_RATIO = float(os.environ.get('BENCH_REVIEW_RATIO', 0.02))
+REPEAT = int(os.environ.get('BENCH_REPEAT', 10))
+CODE = "def my_function(a, b):\n    ''' a typical snippet body '''\n    return a + b\n" * 8
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+    mentors = [Mentor(username='mentor{}'.format(i)) for i in range(4)]
+    db.session.add_all(mentors)
+    db.session.flush()
+    # the mentor being benchmarked gets a quarter of the coders
+    coders = [{'username': 'coder{}'.format(i), 'mentor_id': mentors[i % 4].id}
+              for i in range(CODERS)]
+    db.session.execute(Coder.__table__.insert(), coders)
+    coder_ids = [id for (id,) in db.session.query(Coder.id)]
+
+    rng = random.Random(42)
+    blobs, batch = [], []
+    for i in range(SNIPPETS):
+        blob = CodeBlob.encode(CODE + '# snippet {}\n'.format(i))
+        blobs.append(blob)
+        batch.append({
+            'snippet_name': 'snippet{}'.format(i),
+            'code_hash': blob['sha256'],
+            'comments': '',
+            'needs_review': rng.random() < REVIEW_RATIO,
+            'coder_id': coder_ids[i % len(coder_ids)]})
+        if len(batch) == 5000:
+            db.session.execute(CodeBlob.__table__.insert(), blobs)
+            db.session.execute(Snippet.__table__.insert(), batch)
+            blobs, batch = [], []
+    if batch:
+        db.session.execute(CodeBlob.__table__.insert(), blobs)
+        db.session.execute(Snippet.__table__.insert(), batch)
+    db.session.commit()
+    return mentors[0].id
+
+
+def python_filter(mentor_id):
+    mentor = Mentor.query.get(mentor_id)
+    return [{
+        "username": coder.username,
+        "id": coder.id,
+        "snippets": [snippet.to_dict() for snippet in coder.snippets if snippet.needs_review]
+    } for coder in mentor.coders]
+
+
+def sql_filter(mentor_id):
+    mentor = Mentor.query.get(mentor_id)
+    return [{
+        "username": coder.username,
+        "id": coder.id,
+        "snippets": [snippet.to_dict() for snippet in snippets]
+    } for coder, snippets in mentor.coders_for_review()]
+
+
+def timed(fn, mentor_id):
+    timings = []
+    for i in range(REPEAT):
+        db.session.expire_all()
+        start = time.perf_counter()
+        result = fn(mentor_id)
+        timings.append(time.perf_counter() - start)
+        db.session.rollback()
+    return statistics.median(timings), result
+
+
+def main():
+    database_url = os.environ.get('BENCH_DATABASE_URL')
+    if not database_url:
+        database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        mentor_id = seed()
+        print('database: {}'.format(db.engine.url.drivername))
+        print('snippets: {}, coders: {}, needing review: {:.0%}'.format(SNIPPETS, CODERS, REVIEW_RATIO))
+
+        old, old_result = timed(python_filter, mentor_id)
+        new, new_result = timed(sql_filter, mentor_id)
+        assert sorted(old_result, key=lambda c: c['id']) == new_result
+
+        print('python_filter: {:8.1f} ms'.format(old * 1000))
+        print('sql_filter:    {:8.1f} ms'.format(new * 1000))
+        print('speedup:       {:8.1f}x'.format(old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''
+bench_serializers.py - compares the two ways of writing the JSON body of the
+list endpoints ('/coders', '/mentors') once their rows are loaded:
+
+    to_dict_jsonify : jsonify() of the models' to_dict()s (the old approach)
+    serializers     : the per field set serializers from serializers.py, which
+                      write the JSON straight from the rows' attributes
+
+the rows are loaded once, so only serialization is timed. Both must produce
+the same bytes.
+
+USAGE
+    python benchmarks/bench_serializers.py
+
+    optional: BENCH_CODERS (default 2000), BENCH_SNIPPETS_PER_CODER (default 10),
+              BENCH_REPEAT (default 10)
+'''
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models import db, setup_db, CodeBlob, Mentor, Coder, Snippet
+from serializers import coder_serializer, mentor_serializer
+
+CODERS = int(os.environ.get('BENCH_CODERS', 2000))
+SNIPPETS_PER_CODER = int(os.environ.get('BENCH_SNIPPETS_PER_CODER', 10))
+REPEAT = int(os.environ.get('BENCH_REPEAT', 10))
+CODE = "def my_function(a, b):\n    ''' a typical snippet body '''\n    return a + b\n"
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+    mentors = [Mentor(username='mentor{}'.format(i)) for i in range(CODERS // 20 or 1)]
+    db.session.add_all(mentors)
+    db.session.flush()
+    db.session.execute(Coder.__table__.insert(), [
+        {'username': 'coder{}'.format(i), 'mentor_id': mentors[i % len(mentors)].id}
+        for i in range(CODERS)])
+    coder_ids = [id for (id,) in db.session.query(Coder.id)]
+
+    blobs, snippets = {}, []
+    for coder_id in coder_ids:
+        for i in range(SNIPPETS_PER_CODER):
+            blob = CodeBlob.encode(CODE + '# snippet {} of coder {}\n'.format(i, coder_id))
+            blobs[blob['sha256']] = blob
+            snippets.append({
+                'snippet_name': 'snippet {}'.format(i),
+                'code_hash': blob['sha256'],
+                'comments': 'Looks fine.' if i % 3 else None,
+                'needs_review': i % 2 == 0,
+                'coder_id': coder_id})
+    db.session.execute(CodeBlob.__table__.insert(), list(blobs.values()))
+    db.session.execute(Snippet.__table__.insert(), snippets)
+    db.session.commit()
+
+
+def to_dict_jsonify(name, rows, fields, snippet_fields):
+    return jsonify({
+        "success": True,
+        name: [row.to_dict(fields, snippet_fields) for row in rows],
+        "next_cursor": None
+    }).get_data()
+
+
+def serializers(name, rows, fields, snippet_fields):
+    serialize = (coder_serializer if name == 'coders' else mentor_serializer)(fields, snippet_fields)
+    body = '{"' + name + '":[' + ','.join([serialize(row) for row in rows]) + \
+        '],"next_cursor":null,"success":true}\n'
+    return body.encode('utf-8')
+
+
+def timed(fn, *args):
+    timings = []
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def main():
+    database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        seed()
+        print('coders: {}, snippets per coder: {}'.format(CODERS, SNIPPETS_PER_CODER))
+        cases = [
+            ('coders', 'full', Coder.with_snippets().all(), None, None),
+            ('coders', 'summary', Coder.with_snippets(Coder.SUMMARY_FIELDS).all(),
+             Coder.SUMMARY_FIELDS, Snippet.SUMMARY_FIELDS),
+            ('mentors', 'full', Mentor.with_coders().all(), None, None),
+        ]
+        for name, view, rows, fields, snippet_fields in cases:
+            old, old_body = timed(to_dict_jsonify, name, rows, fields, snippet_fields)
+            new, new_body = timed(serializers, name, rows, fields, snippet_fields)
+            assert old_body == new_body
+            print('{:8} {:8} to_dict_jsonify: {:7.1f} ms  serializers: {:7.1f} ms  speedup: {:4.1f}x'.format(
+                name, view, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
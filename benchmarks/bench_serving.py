@@ -0,0 +1,217 @@
+'''
+bench_serving.py - compares the two SERVING_MODEs of gunicorn.conf.py under
+concurrent load, with the same number of workers and the same pool settings:
+
+    sync  : gunicorn's sync workers, one request at a time per worker
+    async : gevent workers, which serve other requests while one waits on
+            the database
+
+the database is reached through a local proxy that delays every packet by
+half of BENCH_DB_RTT milliseconds each way, as a database on another host
+would; without that, a local database answers too fast for waiting on it to
+matter. The load is BENCH_CONCURRENCY clients, each sending its next request
+as soon as the last one is answered, for BENCH_DURATION seconds, to
+'/signup/<signup_id>' (one indexed query, no auth0).
+
+USAGE
+    BENCH_DATABASE_URL=postgresql://localhost/funcster_bench python benchmarks/bench_serving.py
+    (needs postgres, and gevent and psycogreen for the async mode; use a
+    separate database, as the benchmark drops and recreates all tables)
+
+    optional: BENCH_WORKERS (default 2), BENCH_CONCURRENCY (default 100),
+              BENCH_DURATION (default 10), BENCH_DB_RTT (default 5),
+              BENCH_MODES (default 'sync,async'); the DB_POOL_* settings
+              are passed on to the app
+'''
+import asyncio
+import http.client
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from flask import Flask
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from models import db, setup_db, Coder, SignupOutbox, SCHEMA_VERSION
+
+DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+WORKERS = int(os.environ.get('BENCH_WORKERS', 2))
+CONCURRENCY = int(os.environ.get('BENCH_CONCURRENCY', 100))
+DURATION = float(os.environ.get('BENCH_DURATION', 10))
+DB_RTT = float(os.environ.get('BENCH_DB_RTT', 5)) / 1000
+MODES = os.environ.get('BENCH_MODES', 'sync,async').split(',')
+
+
+def create_tables():
+    '''(re)creates the tables, marked as migrated for the app's schema check'''
+    db.drop_all()
+    db.create_all()
+    db.session.execute('DROP TABLE IF EXISTS alembic_version')
+    db.session.execute('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL PRIMARY KEY)')
+    db.session.execute(db.text('INSERT INTO alembic_version VALUES (:version)'), {'version': SCHEMA_VERSION})
+    db.session.commit()
+
+
+def seed():
+    create_tables()
+    signup = SignupOutbox(username='benchcoder', usertype='coder', email='bench@example.com')
+    signup.insert(Coder(username='benchcoder'))
+    return signup.token
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def delayed_copy(reader, writer, delay):
+    # packets are held for delay seconds but keep their order, and later
+    # ones aren't held up by earlier ones beyond that
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+
+    async def send():
+        while True:
+            due, data = await queue.get()
+            await asyncio.sleep(due - loop.time())
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    sender = loop.create_task(send())
+    while True:
+        data = await reader.read(65536)
+        queue.put_nowait((loop.time() + delay, data))
+        if not data:
+            break
+    await sender
+
+
+def start_latency_proxy(host, port, delay):
+    '''returns the port of a proxy to host:port that delays each direction'''
+    loop = asyncio.new_event_loop()
+    proxy_port = free_port()
+
+    async def handle(client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(host, port)
+            await asyncio.gather(delayed_copy(client_reader, server_writer, delay),
+                                 delayed_copy(server_reader, client_writer, delay))
+        except (ConnectionError, OSError):
+            client_writer.close()
+
+    loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', proxy_port))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return proxy_port
+
+
+def with_latency(database_url, rtt):
+    '''returns a url for the same database, through a proxy adding rtt seconds
+    to each round trip'''
+    url = urlsplit(database_url)
+    proxy_port = start_latency_proxy(url.hostname or 'localhost', url.port or 5432, rtt / 2)
+    credentials = url.netloc.rsplit('@', 1)[0] + '@' if '@' in url.netloc else ''
+    return urlunsplit(url._replace(netloc='{}127.0.0.1:{}'.format(credentials, proxy_port)))
+
+
+def start_server(port, database_url, **settings):
+    '''starts gunicorn with the given settings (environment variables) and
+    returns once it answers'''
+    env = dict(os.environ, WEB_CONCURRENCY=str(WORKERS), DATABASE_URL=database_url, **settings)
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         '--bind', '127.0.0.1:{}'.format(port), 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for i in range(1500):
+        try:
+            get(port, '/')
+            return server
+        except OSError:
+            time.sleep(0.02)
+    server.kill()
+    raise RuntimeError('gunicorn did not start ({})'.format(settings))
+
+
+def get(port, path):
+    # sync workers close the connection after each response, so every
+    # client opens a new one per request in both modes
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def load(port, path):
+    latencies, errors = [], []
+    deadline = time.monotonic() + DURATION
+
+    def client():
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                status = get(port, path)
+            except OSError as error:
+                errors.append(error)
+                continue
+            if status == 200:
+                latencies.append(time.monotonic() - start)
+            else:
+                errors.append(status)
+
+    clients = [threading.Thread(target=client) for i in range(CONCURRENCY)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    if not DATABASE_URL:
+        sys.exit('set BENCH_DATABASE_URL to a postgres database')
+    app = Flask(__name__)
+    setup_db(app, DATABASE_URL)
+    with app.app_context():
+        token = seed()
+    db.get_engine(app).dispose()
+
+    proxied_url = with_latency(DATABASE_URL, DB_RTT)
+
+    print('workers: {}, clients: {}, database round trip: {:.1f} ms, {} s per mode'.format(
+        WORKERS, CONCURRENCY, DB_RTT * 1000, DURATION))
+    for mode in MODES:
+        port = free_port()
+        server = start_server(port, proxied_url, SERVING_MODE=mode)
+        try:
+            latencies, errors = load(port, '/signup/' + token)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        if not latencies:
+            print('{:6} no successful requests ({} errors)'.format(mode, len(errors)))
+            continue
+        print('{:6} {:7.0f} req/s  p50: {:7.1f} ms  p99: {:7.1f} ms  mean: {:7.1f} ms  errors: {}'.format(
+            mode, len(latencies) / DURATION, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, statistics.mean(latencies) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+bench_startup.py - measures how long the api takes to start:
+
+    import app : loading the app in a fresh python process (its imports,
+                 create_app and the schema check); every gunicorn worker does
+                 this when it starts, unless the app is preloaded
+    gunicorn   : from starting gunicorn until it answers its first request
+                 ('/'), and how long the first request to the database
+                 ('/signup/<signup_id>') takes after that: with each worker
+                 loading the app itself, with GUNICORN_PRELOAD (loaded once
+                 by the master, which then forks the workers), and with or
+                 without the workers' warm-up (WARMUP_ON_START, warmup.py)
+
+the database is reached through the same proxy as in bench_serving.py, which
+adds BENCH_DB_RTT milliseconds to each round trip, as a database on another
+host would.
+
+USAGE
+    BENCH_DATABASE_URL=postgresql://localhost/funcster_bench python benchmarks/bench_startup.py
+    (use a separate database, as the benchmark drops and recreates all tables)
+
+    optional: BENCH_WORKERS (default 2), BENCH_DB_RTT (default 5),
+              BENCH_REPEAT (default 5)
+'''
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from flask import Flask
+
+from bench_serving import ROOT, WORKERS, DB_RTT, free_port, get, seed, start_server, with_latency
+from models import db, setup_db
+
+DATABASE_URL = os.environ.get('BENCH_DATABASE_URL')
+REPEAT = int(os.environ.get('BENCH_REPEAT', 5))
+
+IMPORT_APP = '''
+import sys, time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start, 'jose' in sys.modules, 'requests' in sys.modules)
+'''
+
+
+def import_app(database_url):
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_APP], cwd=ROOT,
+                                     env=dict(os.environ, DATABASE_URL=database_url))
+    seconds, jose, requests = output.split()
+    return float(seconds), jose == b'True', requests == b'True'
+
+
+def start_gunicorn(database_url, path, **settings):
+    port = free_port()
+    start = time.monotonic()
+    server = start_server(port, database_url, **settings)
+    started = time.monotonic() - start
+    try:
+        start = time.monotonic()
+        assert get(port, path) == 200
+        first_request = time.monotonic() - start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return started, first_request
+
+
+def main():
+    if not DATABASE_URL:
+        sys.exit('set BENCH_DATABASE_URL to a postgres database')
+    app = Flask(__name__)
+    setup_db(app, DATABASE_URL)
+    with app.app_context():
+        token = seed()
+    db.get_engine(app).dispose()
+    database_url = with_latency(DATABASE_URL, DB_RTT)
+
+    print('workers: {}, database round trip: {:.1f} ms, median of {} runs'.format(
+        WORKERS, DB_RTT * 1000, REPEAT))
+    runs = [import_app(database_url) for i in range(REPEAT)]
+    print('import app                       : {:7.1f} ms  (loads jose: {}, requests: {})'.format(
+        statistics.median(seconds for seconds, jose, requests in runs) * 1000, runs[0][1], runs[0][2]))
+    for name, settings in (('gunicorn', {'WARMUP_ON_START': 'false'}),
+                           ('gunicorn, preload', {'GUNICORN_PRELOAD': 'true', 'WARMUP_ON_START': 'false'}),
+                           ('gunicorn, warm-up', {}),
+                           ('gunicorn, preload, warm-up', {'GUNICORN_PRELOAD': 'true'})):
+        timings = [start_gunicorn(database_url, '/signup/' + token, **settings) for i in range(REPEAT)]
+        print('{:33}: {:7.1f} ms  first database request: {:6.1f} ms'.format(
+            name, statistics.median(started for started, first in timings) * 1000,
+            statistics.median(first for started, first in timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
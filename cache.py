@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, g, request, _request_ctx_stack
+from functools import wraps
+
+
+# Response cache for the read endpoints. RESPONSE_CACHE_BACKEND is 'memory'
+# (per process), 'redis' (shared by every worker, at RESPONSE_CACHE_URL) or
+# 'none'. Entries live for at most RESPONSE_CACHE_TTL seconds; the memory
+# backend also keeps at most RESPONSE_CACHE_SIZE entries and
+# RESPONSE_CACHE_MAX_BYTES bytes, evicting the least recently used first.
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# headers of a cached response that are replayed on a hit
+CACHED_HEADERS = ('ETag', 'Cache-Control')
+
+
+'''
+Cache backends - store opaque byte strings under string keys, each entry
+    labelled with tags, and implement:
+        get(key)                    -> the value, or None if absent/expired
+        set(key, value, tags, ttl)
+        invalidate(tags)            drops every entry labelled with any of tags
+        clear()
+        stats()                     -> dict of counters
+    any class with these methods can be passed to ResponseCache
+'''
+
+'''
+MemoryCache - bounded LRU cache with a TTL, private to the process
+    - bounded by entry count (maxsize) and by the total size of the stored
+      values (max_bytes)
+    - keeps an index from each tag to its keys, so invalidate() only touches
+      the affected entries
+'''
+class MemoryCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires_at, value, tags)
+        self._tags = {}                 # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value, tags=(), ttl=RESPONSE_CACHE_TTL):
+        if self.maxsize <= 0 or len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, value, tuple(tags))
+            self.bytes += len(value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def _remove(self, key):
+        expires_at, value, tags = self._entries.pop(key)
+        self.bytes -= len(value)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+'''
+RedisCache - cache shared by all workers (and hosts), stored in redis
+    - each tag is a redis set of the keys labelled with it
+    - size limits and eviction are left to the redis server (configure it
+      with maxmemory and an allkeys-lru policy)
+    - needs the redis package, which is only imported if this backend is used
+'''
+class RedisCache:
+    def __init__(self, url=RESPONSE_CACHE_URL, prefix='funcster:response:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, tags=(), ttl=RESPONSE_CACHE_TTL):
+        pipe = self._redis.pipeline()
+        pipe.set(self.prefix + key, value, ex=ttl)
+        for tag in tags:
+            pipe.sadd(self.prefix + 'tag:' + tag, key)
+            pipe.expire(self.prefix + 'tag:' + tag, ttl)
+        pipe.execute()
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [self.prefix + key.decode() for key in self._redis.smembers(tag_key)]
+            self._redis.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self._redis.delete(*keys)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+'''
+NullCache - caches nothing (RESPONSE_CACHE_BACKEND=none)
+'''
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags=(), ttl=RESPONSE_CACHE_TTL):
+        pass
+
+    def invalidate(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def make_backend(name=RESPONSE_CACHE_BACKEND):
+    """Returns the cache backend named by RESPONSE_CACHE_BACKEND
+    """
+    if name == 'memory':
+        return MemoryCache()
+    if name == 'redis':
+        return RedisCache()
+    if name == 'none':
+        return NullCache()
+    raise ValueError("unknown RESPONSE_CACHE_BACKEND: {}".format(name))
+
+
+'''
+ResponseCache - caches the JSON responses of read endpoints
+    - the key is the route, its query parameters and the caller's permissions
+      (set by requires_auth, so decorate below it)
+    - only 200 responses are cached (and not streamed ones); their ETag is
+      kept with them, so a conditional request is answered 304 straight
+      from the cache
+    - each response is labelled with tags naming what it was built from, and
+      the write endpoints invalidate() the tags of whatever they change.
+      Entries also expire after ttl seconds, which bounds how long one can
+      outlive a change it missed (e.g. a change made by another worker when
+      the cache isn't shared)
+    EXAMPLE
+        @app.route('/userinfo/<username>')
+        @requires_auth(scopes=['get:userinfo'])
+        @response_cache.cached(lambda username: ['user:' + username])
+        def get_user_info(username):
+            ...
+
+        response_cache.invalidate(['user:' + coder.username])
+'''
+class ResponseCache:
+    def __init__(self, backend=None, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend if backend is not None else make_backend()
+        self.ttl = ttl
+
+    @staticmethod
+    def _key():
+        permissions = getattr(_request_ctx_stack.top, 'current_permissions', ())
+        key = json.dumps([
+            request.path,
+            sorted(request.args.items(multi=True)),
+            sorted(permissions)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _encode(response):
+        headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+        return json.dumps(headers).encode('utf-8') + b'\n' + response.get_data()
+
+    @staticmethod
+    def _decode(value):
+        headers, body = value.split(b'\n', 1)
+        return json.loads(headers.decode('utf-8')), body
+
+    def cached(self, tags):
+        """Decorator caching a view's responses, labelled with tags(**view_args)
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                # a view marked with g.bypass_response_cache neither reads nor
+                # fills the cache (e.g. a user's reads right after their own
+                # write, see replica.py)
+                if g.get('bypass_response_cache'):
+                    return f(*args, **kwargs)
+                key = self._key()
+                value = self.backend.get(key)
+                if value is not None:
+                    headers, body = self._decode(value)
+                    etag = dict(headers).get('ETag')
+                    if etag and request.if_none_match.contains_weak(etag.strip('"')):
+                        return Response(status=304, headers=headers)
+                    return Response(body, headers=headers, mimetype='application/json')
+
+                response = f(*args, **kwargs)
+                # streamed responses are never buffered to be cached, nor are
+                # those a view marked with g.skip_response_cache (e.g. read
+                # from a replica, see replica.py)
+                if (getattr(response, 'status_code', None) == 200 and not response.is_streamed
+                        and not g.get('skip_response_cache')):
+                    self.backend.set(key, self._encode(response), tags(*args, **kwargs), self.ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, tags):
+        self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
@@ -0,0 +1,75 @@
+import glob
+import os
+import tempfile
+
+# gunicorn settings (read by "gunicorn app:app" from the root folder, as in
+# the Procfile). SERVING_MODE picks how each worker process serves requests:
+#   sync  - one request at a time per worker (gunicorn's default)
+#   async - gevent workers: each worker serves up to
+#           GUNICORN_WORKER_CONNECTIONS requests at once, switching between
+#           them whenever one waits on the network (the database, auth0's
+#           signing keys, ...). Needs "pip install gevent psycogreen".
+# The number of workers is gunicorn's WEB_CONCURRENCY, as before.
+# GUNICORN_PRELOAD=true loads the app once, in the master process, and forks
+# the workers from it (gunicorn's --preload): workers start in milliseconds
+# and share the app's memory. In async mode, set this rather than passing
+# --preload, so gevent is set up before the app is loaded.
+SERVING_MODE = os.environ.get('SERVING_MODE', 'sync')
+GUNICORN_WORKER_CONNECTIONS = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+GUNICORN_PRELOAD = os.environ.get('GUNICORN_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+preload_app = GUNICORN_PRELOAD
+
+# the workers' request metrics are added up from their files in METRICS_DIR
+# (see metrics.py); a new directory for each start, unless it is set
+if not os.environ.get('METRICS_DIR'):
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='funcster-metrics-')
+
+if SERVING_MODE == 'async':
+    worker_class = 'gevent'
+    worker_connections = GUNICORN_WORKER_CONNECTIONS
+    if GUNICORN_PRELOAD:
+        # the workers only patch the standard library once forked, which
+        # would be too late for the modules the master has loaded already
+        from gevent import monkey
+        monkey.patch_all()
+elif SERVING_MODE != 'sync':
+    raise ValueError("unknown SERVING_MODE: {}".format(SERVING_MODE))
+
+
+def on_starting(server):
+    # counts left over from an earlier run would be added to this one's
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        # the master checked the schema while loading the app; its
+        # connection mustn't be inherited by (and shared between) workers
+        from app import app
+        from models import dispose_engines
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    if SERVING_MODE == 'async':
+        # psycopg2 waits on its sockets inside C code, out of gevent's
+        # reach; this makes it yield to other requests while it waits
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    # primes the worker (signing keys, database connections, mappers,
+    # serializers) before it takes requests; see warmup.py
+    from warmup import WARMUP_ON_START
+    if WARMUP_ON_START:
+        worker.wsgi.extensions['warmup'].start()
+
+
+def worker_exit(server, worker):
+    # the requests counted since the last write would be lost otherwise;
+    # the worker's pool gauges go, as its connections do
+    from metrics import registry
+    registry.flush(final=True)
@@ -1,8 +1,16 @@
+import os
 from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import Migrate, MigrateCommand, stamp
+
+# migrations and maintenance commands may run for longer than any request
+# should, so they aren't subject to the api's statement timeout; and they
+# must start while the database is still behind the models (to migrate it)
+os.environ.setdefault('DB_STATEMENT_TIMEOUT', '0')
+os.environ.setdefault('DB_SCHEMA_CHECK', 'false')
 
 from app import app
-from models import db
+from models import db, check_schema_version, CodeBlob
+import worker
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +18,30 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def create_db():
+    "Creates the tables in a new, empty database and marks it as up to date with the migrations"
+    existing = set(db.engine.table_names()) & set(db.metadata.tables)
+    if existing:
+        raise SystemExit('The database already has tables ({}); use "python manage.py db upgrade".'.format(
+            ', '.join(sorted(existing))))
+    db.create_all()
+    stamp()
+    print('Created the tables.')
+
+
+@manager.command
+def prune_code_blobs():
+    "Deletes stored code bodies that no snippet refers to any more"
+    print('Deleted {} unused code blobs.'.format(CodeBlob.prune()))
+
+
+@manager.command
+def process_signups():
+    "Registers new signups with auth0 as they come in (runs until stopped)"
+    check_schema_version(app)
+    worker.run()
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,368 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Request metrics, served in prometheus' text format at '/metrics'. Each
+# process counts its own requests and writes them to a file in METRICS_DIR
+# (at most every METRICS_FLUSH_INTERVAL seconds), and '/metrics' adds up the
+# files of all processes, so it reports the same totals whichever gunicorn
+# worker answers (gunicorn.conf.py makes a new METRICS_DIR each start, unless
+# it is set). Without METRICS_DIR, '/metrics' reports only its own process.
+# '/metrics' requires the bearer token METRICS_TOKEN if that is set (for a
+# prometheus scraper), or an auth0 token with the 'get:stats' permission.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# upper bounds of the histograms' buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# where a request's time goes, besides the view's own code
+PHASES = ('auth', 'sql', 'serialization')
+
+# the methods recorded under their own name; any other is recorded as 'other',
+# as a client can send any token there (and unmatched paths and 405s do count)
+METHODS = ('GET', 'HEAD', 'POST', 'PATCH', 'PUT', 'DELETE', 'OPTIONS')
+
+# name, type and help of each metric
+FAMILIES = (
+    ('funcster_http_requests_total', 'counter',
+     'Requests answered, by route, method and status.'),
+    ('funcster_http_request_duration_seconds', 'histogram',
+     'Time taken to answer a request (to its last byte, if streamed), by route and method.'),
+    ('funcster_http_response_size_bytes', 'histogram',
+     'Size of the response body (streamed responses aren\'t counted), by route and method.'),
+    ('funcster_http_request_phase_seconds_total', 'counter',
+     'Time spent checking the access token (auth), in SQL statements (sql) and writing JSON '
+     '(serialization), by route and method.'),
+    ('funcster_http_request_queries_total', 'counter',
+     'SQL statements executed, by route and method.'),
+    ('funcster_db_pool_size', 'gauge',
+     'Connections the database connection pools keep open (DB_POOL_SIZE per process).'),
+    ('funcster_db_pool_checked_out', 'gauge',
+     'Database connections in use.'),
+    ('funcster_db_pool_overflow', 'gauge',
+     'Database connections open beyond the pools\' size.'),
+    ('funcster_db_pool_checkouts_total', 'counter',
+     'Database connections taken from the pools.'),
+    ('funcster_db_pool_wait_seconds_total', 'counter',
+     'Time spent waiting for a free database connection.'),
+    ('funcster_db_pool_timeouts_total', 'counter',
+     'Waits for a database connection that gave up (DB_POOL_TIMEOUT).'),
+    ('funcster_token_cache_size', 'gauge',
+     'Verified access tokens cached (TOKEN_CACHE_SIZE per process at most).'),
+    ('funcster_token_cache_hits_total', 'counter',
+     'Access tokens found in the verified-token cache.'),
+    ('funcster_token_cache_misses_total', 'counter',
+     'Access tokens that had to be verified (not cached, or expired).'),
+)
+REQUESTS, DURATION, SIZE, PHASE_SECONDS, QUERIES = [name for name, kind, help in FAMILIES[:5]]
+KINDS = {name: kind for name, kind, help in FAMILIES}
+
+# the samples of the connection pool's statistics (see models.pool_stats)
+POOL_STATS = (('funcster_db_pool_size', 'size'),
+              ('funcster_db_pool_checked_out', 'checked_out'),
+              ('funcster_db_pool_overflow', 'overflow'),
+              ('funcster_db_pool_checkouts_total', 'checkouts'),
+              ('funcster_db_pool_wait_seconds_total', 'wait_time'),
+              ('funcster_db_pool_timeouts_total', 'timeouts'))
+
+# the samples of the verified-token cache's statistics (see auth.VerifiedTokenCache)
+TOKEN_CACHE_STATS = (('funcster_token_cache_size', 'size'),
+                     ('funcster_token_cache_hits_total', 'hits'),
+                     ('funcster_token_cache_misses_total', 'misses'))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def pool_samples(stats):
+    return {name: stats[key] for name, key in POOL_STATS if key in stats}
+
+def token_cache_samples(stats):
+    return {name: stats[key] for name, key in TOKEN_CACHE_STATS if key in stats}
+
+
+'''
+RequestRecord - what one request has spent so far in each phase, and how many
+    SQL statements it ran (kept in g while the request runs)
+'''
+class RequestRecord:
+    __slots__ = ('start', 'phases', 'queries', 'depth')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.depth = 0
+
+
+def current_record():
+    return g.get('request_metrics') if has_request_context() else None
+
+
+'''
+timed(phase) / timed_calls(phase, f)
+    count the time spent in a block, or in every call of f, towards the
+    current request's phase (only the outermost one, if they are nested, e.g.
+    JSON encoding inside a list serializer)
+    EXAMPLE
+        with timed('serialization'):
+            body = json.dumps(...)
+'''
+@contextmanager
+def timed(phase):
+    record = current_record()
+    if record is None or record.depth:
+        yield
+        return
+    record.depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.phases[phase] += time.perf_counter() - start
+        record.depth -= 1
+
+def timed_calls(phase, f):
+    record = current_record()
+    if record is None:
+        return f
+
+    def timed_f(*args):
+        if record.depth:
+            return f(*args)
+        record.depth += 1
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            record.phases[phase] += time.perf_counter() - start
+            record.depth -= 1
+    return timed_f
+
+
+'''
+TimedJSONEncoder - flask's JSON encoder, counting the time spent encoding
+    (jsonify) as serialization
+'''
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with timed('serialization'):
+            return super().encode(o)
+
+
+# every statement run while a request is handled counts towards its sql time
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_record() is not None:
+        conn.info['metrics_start'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record = current_record()
+    start = conn.info.pop('metrics_start', None)
+    if record is not None and start is not None:
+        record.phases['sql'] += time.perf_counter() - start
+        record.queries += 1
+
+
+'''
+MetricsRegistry - this process's samples, keyed by their prometheus text
+    (name and labels) within each metric, and their sum over all processes
+    - observe(): records one answered request
+    - flush(): writes the samples to this process's file in directory (done
+      in the background at most every flush_interval seconds)
+    - collect(): the samples added up over every process's file
+    - render(): collect() in prometheus' text format
+    - add_collector(): a function returning samples (name -> value) that are
+      read whenever the samples are written, such as the connection pool's
+      gauges; an exiting process drops its gauges (flush(final=True))
+    Histogram buckets are kept as the count of values in each bucket alone
+    (one increment per value), and made cumulative by render(). A process
+    forked from one that has recorded requests starts from zero, with its
+    own file.
+'''
+class MetricsRegistry:
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self.collectors = {}
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self.samples = {name: {} for name, kind, help in FAMILIES}
+        self.path = os.path.join(self.directory, '{}-{}.json'.format(
+            self._pid, uuid.uuid4().hex[:8])) if self.directory else None
+        self._dirty = False
+        self._flusher = None
+        self._series = {}   # (route, method) -> the keys of its samples
+
+    def add_collector(self, key, collector):
+        self.collectors[key] = collector
+
+    def _keys(self, route, method):
+        keys = self._series.get((route, method))
+        if keys is None:
+            labels = 'route="{}",method="{}"'.format(escape(route), method)
+            keys = {'labels': labels, 'status': {}}
+            for name, buckets in ((DURATION, LATENCY_BUCKETS), (SIZE, SIZE_BUCKETS)):
+                keys[name] = (
+                    ['{}_bucket{{{},le="{}"}}'.format(name, labels, bound) for bound in buckets + ('+Inf',)],
+                    '{}_sum{{{}}}'.format(name, labels),
+                    '{}_count{{{}}}'.format(name, labels))
+                # every bucket is there, in order, from the start
+                for key in keys[name][0]:
+                    self.samples[name].setdefault(key, 0)
+            keys[PHASE_SECONDS] = [(phase, '{}{{{},phase="{}"}}'.format(PHASE_SECONDS, labels, phase))
+                                   for phase in PHASES]
+            keys[QUERIES] = '{}{{{}}}'.format(QUERIES, labels)
+            self._series[(route, method)] = keys
+        return keys
+
+    def _observe_histogram(self, name, keys, buckets, value):
+        samples = self.samples[name]
+        bucket_keys, sum_key, count_key = keys
+        samples[bucket_keys[bisect_left(buckets, value)]] += 1
+        samples[sum_key] = samples.get(sum_key, 0) + value
+        samples[count_key] = samples.get(count_key, 0) + 1
+
+    def observe(self, route, method, status, duration, size, phases, queries):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            keys = self._keys(route, method)
+            key = keys['status'].get(status)
+            if key is None:
+                key = keys['status'][status] = '{}{{{},status="{}"}}'.format(REQUESTS, keys['labels'], status)
+            samples = self.samples
+            samples[REQUESTS][key] = samples[REQUESTS].get(key, 0) + 1
+            self._observe_histogram(DURATION, keys[DURATION], LATENCY_BUCKETS, duration)
+            if size is not None:
+                self._observe_histogram(SIZE, keys[SIZE], SIZE_BUCKETS, size)
+            phase_seconds = samples[PHASE_SECONDS]
+            for phase, key in keys[PHASE_SECONDS]:
+                phase_seconds[key] = phase_seconds.get(key, 0) + phases[phase]
+            samples[QUERIES][keys[QUERIES]] = samples[QUERIES].get(keys[QUERIES], 0) + queries
+            self._dirty = True
+            if self.path and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._flusher.start()
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _snapshot(self, final=False):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            samples = {name: dict(values) for name, values in self.samples.items()}
+            self._dirty = False
+        for collector in list(self.collectors.values()):
+            for name, value in collector().items():
+                if not (final and KINDS[name] == 'gauge'):
+                    samples[name][name] = value
+        return samples
+
+    def flush(self, final=False):
+        if not self.directory or not (self._dirty or self.collectors or final):
+            return
+        data = json.dumps(self._snapshot(final))
+        temporary = '{}.{}.tmp'.format(self.path, threading.get_ident())
+        with open(temporary, 'w') as f:
+            f.write(data)
+        os.replace(temporary, self.path)
+
+    def collect(self):
+        if not self.directory:
+            return self._snapshot()
+        self.flush()
+        total = {name: {} for name, kind, help in FAMILIES}
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            try:
+                with open(path) as f:
+                    samples = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, values in samples.items():
+                family = total.setdefault(name, {})
+                for key, value in values.items():
+                    family[key] = family.get(key, 0) + value
+        return total
+
+    def render(self):
+        samples = self.collect()
+        lines = []
+        for name, kind, help in FAMILIES:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            series, count = None, 0
+            for key, value in samples.get(name, {}).items():
+                if kind == 'histogram' and '_bucket{' in key:
+                    # buckets come in order for each series; add up the ones before
+                    if key[:key.rindex(',le=')] != series:
+                        series, count = key[:key.rindex(',le=')], 0
+                    count += value
+                    value = count
+                lines.append('{} {}'.format(key, repr(float(value)) if isinstance(value, float) else value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+'''
+init_app(app)
+    instruments the app's requests: each one is recorded in the registry once
+    answered (streamed responses once their last byte has been sent), under
+    its route's rule rather than its path and under METHODS or 'other', so
+    the number of series is bounded by the number of routes. Register this before any other after_request
+    function, so it sees the final response.
+'''
+def init_app(app, registry=registry):
+    app.json_encoder = TimedJSONEncoder
+    app.config.setdefault('METRICS_TOKEN', METRICS_TOKEN)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = RequestRecord()
+
+    @app.after_request
+    def record_request_metrics(response):
+        # (left in g: a streamed response's statements still count towards it)
+        record = g.get('request_metrics')
+        if record is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        method = request.method if request.method in METHODS else 'other'
+        status = response.status_code
+
+        def finish(size):
+            registry.observe(route, method, status, time.perf_counter() - record.start,
+                             size, record.phases, record.queries)
+
+        if response.is_streamed:
+            response.call_on_close(lambda: finish(None))
+        else:
+            finish(response.calculate_content_length())
+        return response
+
+    return registry
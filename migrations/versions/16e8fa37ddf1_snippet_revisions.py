@@ -0,0 +1,41 @@
+"""snippet revisions
+
+Revision ID: 16e8fa37ddf1
+Revises: 2546477d52e0
+Create Date: 2026-10-18 13:05:12.671934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '16e8fa37ddf1'
+down_revision = '2546477d52e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing snippets get their first revision the next time they are edited
+    op.create_table('snippet_revisions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('snippet_id', sa.Integer(), nullable=False),
+        sa.Column('number', sa.Integer(), nullable=False),
+        sa.Column('snippet_name', sa.String(length=200), nullable=True),
+        sa.Column('needs_review', sa.Boolean(), nullable=True),
+        sa.Column('comments', sa.String(), nullable=True),
+        sa.Column('code_hash', sa.String(length=64), nullable=True),
+        sa.Column('delta', sa.Text(), nullable=True),
+        sa.Column('author_type', sa.String(length=6), nullable=True),
+        sa.Column('author_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['code_hash'], ['code_blobs.sha256'], ),
+        sa.ForeignKeyConstraint(['snippet_id'], ['snippet.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('snippet_id', 'number')
+    )
+
+
+def downgrade():
+    op.drop_table('snippet_revisions')
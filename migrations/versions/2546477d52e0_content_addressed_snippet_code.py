@@ -0,0 +1,120 @@
+"""content addressed snippet code
+
+Revision ID: 2546477d52e0
+Revises: d0615d8fd6cb
+Create Date: 2026-10-18 11:27:53.090442
+
+"""
+import hashlib
+import os
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2546477d52e0'
+down_revision = 'd0615d8fd6cb'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+COMPRESS_THRESHOLD = int(os.environ.get('CODE_COMPRESS_THRESHOLD', 1024))
+
+snippet = sa.table('snippet',
+    sa.column('id', sa.Integer),
+    sa.column('code', sa.String),
+    sa.column('code_hash', sa.String))
+
+code_blobs = sa.table('code_blobs',
+    sa.column('sha256', sa.String),
+    sa.column('compressed', sa.Boolean),
+    sa.column('data', sa.LargeBinary))
+
+
+def encode(text):
+    # same encoding as models.CodeBlob.encode, frozen as of this revision
+    raw = text.encode('utf-8')
+    data, compressed = raw, False
+    if len(raw) > COMPRESS_THRESHOLD:
+        packed = zlib.compress(raw)
+        if len(packed) < len(raw):
+            data, compressed = packed, True
+    return {'sha256': hashlib.sha256(raw).hexdigest(), 'compressed': compressed, 'data': data}
+
+
+def upgrade():
+    op.create_table('code_blobs',
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('compressed', sa.Boolean(), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('sha256')
+    )
+    op.add_column('snippet', sa.Column('code_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_snippet_code_hash'), 'snippet', ['code_hash'], unique=False)
+    op.create_foreign_key('snippet_code_hash_fkey', 'snippet', 'code_blobs', ['code_hash'], ['sha256'])
+
+    # move the existing code bodies into code_blobs, BATCH_SIZE snippets at a time
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([snippet.c.id, snippet.c.code])
+            .where(snippet.c.id > last_id)
+            .order_by(snippet.c.id)
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        blobs = {}
+        hashes = {}
+        for id, code in rows:
+            if code is None:
+                continue
+            blob = encode(code)
+            blobs[blob['sha256']] = blob
+            hashes[id] = blob['sha256']
+
+        if blobs:
+            existing = {sha256 for (sha256,) in connection.execute(
+                sa.select([code_blobs.c.sha256]).where(code_blobs.c.sha256.in_(list(blobs))))}
+            new_blobs = [blob for sha256, blob in blobs.items() if sha256 not in existing]
+            if new_blobs:
+                connection.execute(code_blobs.insert(), new_blobs)
+            connection.execute(
+                snippet.update().where(snippet.c.id == sa.bindparam('snippet_id'))
+                .values(code_hash=sa.bindparam('sha256')),
+                [{'snippet_id': id, 'sha256': sha256} for id, sha256 in hashes.items()])
+
+    op.drop_column('snippet', 'code')
+
+
+def downgrade():
+    op.add_column('snippet', sa.Column('code', sa.VARCHAR(), autoincrement=False, nullable=True))
+
+    # copy the code bodies back onto the snippets, BATCH_SIZE at a time
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([snippet.c.id, code_blobs.c.compressed, code_blobs.c.data])
+            .select_from(snippet.join(code_blobs, snippet.c.code_hash == code_blobs.c.sha256))
+            .where(snippet.c.id > last_id)
+            .order_by(snippet.c.id)
+            .limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        connection.execute(
+            snippet.update().where(snippet.c.id == sa.bindparam('snippet_id'))
+            .values(code=sa.bindparam('text')),
+            [{'snippet_id': id,
+              'text': (zlib.decompress(data) if compressed else data).decode('utf-8')}
+             for id, compressed, data in rows])
+
+    op.drop_constraint('snippet_code_hash_fkey', 'snippet', type_='foreignkey')
+    op.drop_index(op.f('ix_snippet_code_hash'), table_name='snippet')
+    op.drop_column('snippet', 'code_hash')
+    op.drop_table('code_blobs')
@@ -0,0 +1,29 @@
+"""partial index on snippets needing review
+
+Revision ID: 393d7478acea
+Revises:
+Create Date: 2026-10-18 09:12:41.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '393d7478acea'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # serves a mentor's review queue in /userinfo (Mentor.coders_for_review),
+    # indexing only the snippets that are waiting for review
+    op.create_index('ix_snippet_coder_id_needs_review', 'snippet', ['coder_id'],
+                    unique=False,
+                    postgresql_where=sa.text('needs_review'),
+                    sqlite_where=sa.text('needs_review'))
+
+
+def downgrade():
+    op.drop_index('ix_snippet_coder_id_needs_review', table_name='snippet')
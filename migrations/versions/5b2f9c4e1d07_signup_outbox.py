@@ -0,0 +1,45 @@
+"""signup outbox
+
+Revision ID: 5b2f9c4e1d07
+Revises: 8c1e5f0b7a92
+Create Date: 2026-10-18 15:02:11.640375
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2f9c4e1d07'
+down_revision = '8c1e5f0b7a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('signup_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('token', sa.String(length=32), nullable=False),
+        sa.Column('username', sa.String(length=24), nullable=False),
+        sa.Column('usertype', sa.String(length=6), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('email', sa.String(length=254), nullable=True),
+        sa.Column('password', sa.String(), nullable=True),
+        sa.Column('status', sa.String(length=7), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token')
+    )
+    # the rows the signup worker may claim (SignupOutbox.claim)
+    op.create_index('ix_signup_outbox_pending', 'signup_outbox', ['next_attempt_at'],
+                    unique=False,
+                    postgresql_where=sa.text("status = 'pending'"),
+                    sqlite_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_signup_outbox_pending', table_name='signup_outbox')
+    op.drop_table('signup_outbox')
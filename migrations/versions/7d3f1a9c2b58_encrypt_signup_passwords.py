@@ -0,0 +1,69 @@
+"""encrypt signup passwords
+
+Revision ID: 7d3f1a9c2b58
+Revises: e3a7d26b9f41
+Create Date: 2026-10-19 09:12:40.281614
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3f1a9c2b58'
+down_revision = 'e3a7d26b9f41'
+branch_labels = None
+depends_on = None
+
+signup_outbox = sa.table('signup_outbox',
+    sa.column('id', sa.Integer),
+    sa.column('password', sa.String),
+    sa.column('encrypted_password', sa.String))
+
+
+def cipher():
+    # same as models.password_cipher, frozen as of this revision
+    from cryptography.fernet import Fernet, MultiFernet
+    keys = os.environ.get('SIGNUP_PASSWORD_KEYS')
+    if not keys:
+        raise RuntimeError('set SIGNUP_PASSWORD_KEYS to move the passwords of pending signups')
+    return MultiFernet([Fernet(key.strip()) for key in keys.split(',') if key.strip()])
+
+
+def upgrade():
+    op.add_column('signup_outbox', sa.Column('encrypted_password', sa.String(), nullable=True))
+
+    # only pending signups still have a password
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([signup_outbox.c.id, signup_outbox.c.password])
+        .where(signup_outbox.c.password.isnot(None))).fetchall()
+    if rows:
+        fernet = cipher()
+        connection.execute(
+            signup_outbox.update().where(signup_outbox.c.id == sa.bindparam('row_id'))
+            .values(encrypted_password=sa.bindparam('token')),
+            [{'row_id': id, 'token': fernet.encrypt(password.encode('utf-8')).decode()}
+             for id, password in rows])
+
+    op.drop_column('signup_outbox', 'password')
+
+
+def downgrade():
+    op.add_column('signup_outbox', sa.Column('password', sa.String(), nullable=True))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([signup_outbox.c.id, signup_outbox.c.encrypted_password])
+        .where(signup_outbox.c.encrypted_password.isnot(None))).fetchall()
+    if rows:
+        fernet = cipher()
+        connection.execute(
+            signup_outbox.update().where(signup_outbox.c.id == sa.bindparam('row_id'))
+            .values(password=sa.bindparam('password')),
+            [{'row_id': id, 'password': fernet.decrypt(token.encode()).decode('utf-8')}
+             for id, token in rows])
+
+    op.drop_column('signup_outbox', 'encrypted_password')
@@ -0,0 +1,30 @@
+"""row versions
+
+Revision ID: 8c1e5f0b7a92
+Revises: 16e8fa37ddf1
+Create Date: 2026-10-18 14:05:37.218904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1e5f0b7a92'
+down_revision = '16e8fa37ddf1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # bumped on every update by the ORM (version_id_col); the ETags of
+    # '/snippet/<id>', '/userinfo/<username>' and '/coders' are built from them
+    op.add_column('mentors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('coders', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('snippet', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('snippet', 'version')
+    op.drop_column('coders', 'version')
+    op.drop_column('mentors', 'version')
@@ -0,0 +1,54 @@
+"""user directory triggers
+
+Revision ID: b6e2c94d1f35
+Revises: 7d3f1a9c2b58
+Create Date: 2026-10-19 14:03:26.551870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2c94d1f35'
+down_revision = '7d3f1a9c2b58'
+branch_labels = None
+depends_on = None
+
+# same as models.USER_DIRECTORY_TRIGGERS['postgresql'], frozen as of this revision
+SYNC_FUNCTION = '''CREATE OR REPLACE FUNCTION sync_user_directory() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM user_directory WHERE usertype = TG_ARGV[0] AND user_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.username IS NOT NULL THEN
+        INSERT INTO user_directory (username, usertype, user_id) VALUES (NEW.username, TG_ARGV[0], NEW.id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+USER_TABLES = (('mentors', 'mentor'), ('coders', 'coder'))
+
+
+def upgrade():
+    # the ORM listeners that kept the directory up to date until now missed
+    # users deleted in bulk and renames made outside the ORM, so rebuild it
+    # before the triggers take over
+    op.execute('DELETE FROM user_directory')
+    for table, usertype in USER_TABLES:
+        op.execute(
+            "INSERT INTO user_directory (username, usertype, user_id) "
+            "SELECT username, '{1}', id FROM {0} WHERE username IS NOT NULL".format(table, usertype))
+
+    op.execute(SYNC_FUNCTION)
+    for table, usertype in USER_TABLES:
+        op.execute(
+            'CREATE TRIGGER {0}_user_directory AFTER INSERT OR DELETE OR UPDATE OF username, id ON {0} '
+            "FOR EACH ROW EXECUTE PROCEDURE sync_user_directory('{1}')".format(table, usertype))
+
+
+def downgrade():
+    for table, usertype in USER_TABLES:
+        op.execute('DROP TRIGGER {0}_user_directory ON {0}'.format(table))
+    op.execute('DROP FUNCTION sync_user_directory()')
@@ -0,0 +1,33 @@
+"""foreign key and lookup indexes
+
+Revision ID: d0615d8fd6cb
+Revises: 393d7478acea
+Create Date: 2026-10-18 10:02:17.884310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0615d8fd6cb'
+down_revision = '393d7478acea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # postgres doesn't index the referencing side of a foreign key, so
+    # mentor.coders and coder.snippets were sequential scans
+    op.create_index(op.f('ix_coders_mentor_id'), 'coders', ['mentor_id'], unique=False)
+    op.create_index(op.f('ix_snippet_coder_id'), 'snippet', ['coder_id'], unique=False)
+    # coders without a mentor ('/coders/available'), paged by id
+    op.create_index('ix_coders_unmentored', 'coders', ['id'], unique=False,
+                    postgresql_where=sa.text('mentor_id IS NULL'),
+                    sqlite_where=sa.text('mentor_id IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_coders_unmentored', table_name='coders')
+    op.drop_index(op.f('ix_snippet_coder_id'), table_name='snippet')
+    op.drop_index(op.f('ix_coders_mentor_id'), table_name='coders')
@@ -0,0 +1,46 @@
+"""user directory
+
+Revision ID: e3a7d26b9f41
+Revises: 5b2f9c4e1d07
+Create Date: 2026-10-18 16:21:47.118093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a7d26b9f41'
+down_revision = '5b2f9c4e1d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # usernames become unique across mentors and coders, so existing
+    # duplicates have to be resolved by hand before upgrading
+    duplicates = op.get_bind().execute(sa.text(
+        'SELECT mentors.username FROM mentors '
+        'JOIN coders ON coders.username = mentors.username')).fetchall()
+    if duplicates:
+        raise RuntimeError('usernames used by both a mentor and a coder: {}'.format(
+            ', '.join(row[0] for row in duplicates)))
+
+    op.create_table('user_directory',
+        sa.Column('username', sa.String(length=24), nullable=False),
+        sa.Column('usertype', sa.String(length=6), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.CheckConstraint("usertype IN ('mentor', 'coder')", name='ck_user_directory_usertype'),
+        sa.PrimaryKeyConstraint('username'),
+        sa.UniqueConstraint('usertype', 'user_id')
+    )
+    op.execute(
+        "INSERT INTO user_directory (username, usertype, user_id) "
+        "SELECT username, 'mentor', id FROM mentors WHERE username IS NOT NULL")
+    op.execute(
+        "INSERT INTO user_directory (username, usertype, user_id) "
+        "SELECT username, 'coder', id FROM coders WHERE username IS NOT NULL")
+
+
+def downgrade():
+    op.drop_table('user_directory')
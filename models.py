@@ -1,16 +1,223 @@
+import datetime
+import difflib
+import functools
+import hashlib
 import json
 import os
+import threading
+import time
+import uuid
+import zlib
 
-from sqlalchemy import create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import joinedload, selectinload, undefer
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 
-db = SQLAlchemy()
-def setup_db(app, database_path=os.environ.get('DATABASE_URL')):
+# code bodies larger than this (in bytes) are stored zlib-compressed
+CODE_COMPRESS_THRESHOLD = int(os.environ.get('CODE_COMPRESS_THRESHOLD', 1024))
+# every n-th revision of a snippet stores its full code rather than a delta,
+# which bounds the number of deltas applied to rebuild any revision
+SNIPPET_CHECKPOINT_INTERVAL = int(os.environ.get('SNIPPET_CHECKPOINT_INTERVAL', 10))
+
+# Database connection pool, per process (only applied to postgres databases;
+# see "Sizing the connection pool" in the README): DB_POOL_SIZE connections
+# are kept open, up to DB_MAX_OVERFLOW more are opened under load, and a
+# request waits at most DB_POOL_TIMEOUT seconds for a free one. Connections
+# are replaced after DB_POOL_RECYCLE seconds and, if DB_POOL_PRE_PING is set,
+# tested before each use. DB_STATEMENT_TIMEOUT (milliseconds, 0 for none)
+# cancels runaway queries; DB_APPLICATION_NAME labels the connections in
+# pg_stat_activity.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 2))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 3))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+DB_APPLICATION_NAME = os.environ.get('DB_APPLICATION_NAME', 'funcster-api')
+
+# The passwords of signups waiting to be sent to auth0 (see worker.py) are
+# kept encrypted in the signup outbox, with SIGNUP_PASSWORD_KEYS: one or more
+# comma separated Fernet keys, of which the first encrypts and all of them
+# decrypt (so a new key can be put in front of the old one). The web and
+# signup worker processes need the same keys; make one with "python -c 'from
+# cryptography.fernet import Fernet; print(Fernet.generate_key().decode())'".
+SIGNUP_PASSWORD_KEYS = os.environ.get('SIGNUP_PASSWORD_KEYS')
+
+# The alembic revision (see migrations/versions) these models match; keep it
+# at the newest migration's. The schema is only changed by migrations ("python
+# manage.py db upgrade"), so at start up the app just checks, with one query,
+# that the database is at this revision (skipped if DB_SCHEMA_CHECK is false).
+SCHEMA_VERSION = 'b6e2c94d1f35'
+DB_SCHEMA_CHECK = os.environ.get('DB_SCHEMA_CHECK', 'true').lower() in ('1', 'true', 'yes')
+
+'''
+RoutingSession - the session the models use; sends statements to the read
+    replica (the 'replica' bind, set up by setup_db() from
+    DATABASE_REPLICA_URL) while the request has asked for it with
+    g.use_replica (see replica.py), and to the primary database otherwise.
+    Flushes and UPDATE/INSERT/DELETE statements always go to the primary.
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if (has_app_context() and g.get('use_replica') and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+'''
+RoutingSQLAlchemy - Flask-SQLAlchemy with the RoutingSession, and the pool
+    settings of engine_options() applied to each database (primary and
+    replica) by its own url. SQLALCHEMY_ENGINE_OPTIONS, if set in the app's
+    config, overrides them.
+'''
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        options.update(engine_options(str(sa_url)))
+        return super().apply_driver_hacks(app, sa_url, options)
+
+
+db = RoutingSQLAlchemy()
+def setup_db(app, database_path=os.environ.get('DATABASE_URL'),
+             replica_path=os.environ.get('DATABASE_REPLICA_URL')):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
+    app.config['SQLALCHEMY_BINDS'] = {'replica': replica_path} if replica_path else {}
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+'''
+check_schema_version(app)
+    raises a RuntimeError unless the app's database has been migrated to
+    SCHEMA_VERSION. The outcome is remembered per database, so this is one
+    query per process (or none in the workers, if gunicorn preloads the app).
+'''
+_checked_databases = set()
+def check_schema_version(app):
+    database_path = app.config['SQLALCHEMY_DATABASE_URI']
+    if database_path in _checked_databases:
+        return
+    with app.app_context():
+        try:
+            version = db.get_engine(app).execute('SELECT version_num FROM alembic_version').scalar()
+        except exc.DBAPIError:
+            version = None
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            "the database is at schema version {}, but the app needs {}: run "
+            "'python manage.py db upgrade' (or 'python manage.py create_db' for a "
+            "new database)".format(version, SCHEMA_VERSION))
+    _checked_databases.add(database_path)
+
+'''
+dispose_engines(app)
+    closes the app's pooled database connections (primary and replica); a
+    process that forks must call this first, as a connection can't be shared
+    with the child processes
+'''
+def dispose_engines(app):
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS']):
+            db.get_engine(app, bind).dispose()
+
+'''
+engine_options(database_path)
+    the engine's pool and connection settings (from the DB_* settings above)
+    for a database url; other databases than postgres (e.g. sqlite in the
+    benchmarks) keep SQLAlchemy's defaults
+'''
+def engine_options(database_path):
+    if not database_path or not database_path.startswith('postgres'):
+        return {}
+    connect_args = {'application_name': DB_APPLICATION_NAME}
+    if DB_STATEMENT_TIMEOUT:
+        connect_args['options'] = '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'connect_args': connect_args
+    }
+
+'''
+TimedQueuePool - SQLAlchemy's QueuePool, also keeping track of how long
+    checkouts wait for a connection: how many checkouts there were, their
+    total and longest wait (seconds), and how many gave up after
+    DB_POOL_TIMEOUT. Time spent waiting means the pool is too small for the
+    load (or connections are held too long).
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+'''
+pool_stats()
+    live statistics of this process's connection pool: connections checked
+    out and idle, overflow connections open beyond the pool size, and (with
+    a TimedQueuePool) the time checkouts spent waiting
+'''
+def pool_stats():
+    pool = db.engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout()
+        })
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            "checkouts": pool.checkouts,
+            "wait_time": round(pool.wait_time, 6),
+            "max_wait": round(pool.max_wait, 6),
+            "timeouts": pool.timeouts
+        })
+    return stats
+
+'''
+row_versions(model, *criterion)
+    returns (id, version) for each row of model matching criterion, ordered by
+    id. Every update of a row bumps its version, so this is a cheap fingerprint
+    of those rows (used for ETags) that doesn't load any of their other columns
+    EXAMPLE
+        row_versions(Snippet, Snippet.coder_id == 1)
+'''
+def row_versions(model, *criterion):
+    return db.session.query(model.id, model.version).filter(*criterion).order_by(model.id).all()
 
 '''
 User - generic User base class (can be further modelled into Mentor or Coder)
@@ -20,6 +227,12 @@ class User(db.Model):
     __abstract__ = True
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(24), unique=True)
+    # incremented by the ORM on every update (see row_versions)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.version}
 
     '''
     insert()
@@ -87,14 +300,54 @@ class Mentor(User):
 
     '''
     to_dict(): Method for returning dictionarified version of a Mentor
+        coder_fields/snippet_fields select which fields of each coder (and of
+        each coder's snippets) are included; see Coder.to_dict()
     '''
-    def to_dict(self):
+    def to_dict(self, coder_fields=None, snippet_fields=None):
         return {
             "id": self.id,
             "username": self.username,
-            "coders": [coder.to_dict() for coder in self.coders]
+            "coders": [coder.to_dict(coder_fields, snippet_fields) for coder in self.coders]
         }
 
+    '''
+    with_coders(): Class Method for querying mentors with their coders and each
+        coder's snippets loaded up front, so that to_dict() runs a fixed number
+        of queries (one per table) however many rows there are
+        (only what to_dict(coder_fields, snippet_fields) needs is loaded)
+        EXAMPLE
+            mentors = Mentor.with_coders().all()
+    '''
+    @classmethod
+    def with_coders(cls, coder_fields=None, snippet_fields=None):
+        return cls.query.options(
+            selectinload(cls.coders),
+            *Coder.loader_options(coder_fields, snippet_fields,
+                                  via=lambda: selectinload(cls.coders)))
+
+    '''
+    coders_for_review(): Method returning each of the mentor's coders paired
+        with that coder's snippets which need review, as (coder, [snippets]);
+        coders with nothing to review get an empty list. The filtering is done
+        in a single query (coders left-joined to snippets on needs_review),
+        served by the partial index on snippet(coder_id) WHERE needs_review
+        EXAMPLE
+            for coder, snippets in mentor.coders_for_review(): ...
+    '''
+    def coders_for_review(self):
+        rows = db.session.query(Coder, Snippet).outerjoin(
+            Snippet, db.and_(Snippet.coder_id == Coder.id, Snippet.needs_review == True)
+        ).options(joinedload(Snippet.blob)
+        ).filter(Coder.mentor_id == self.id).order_by(Coder.id, Snippet.id)
+
+        coders = []
+        for coder, snippet in rows:
+            if not coders or coders[-1][0] is not coder:
+                coders.append((coder, []))
+            if snippet is not None:
+                coders[-1][1].append(snippet)
+        return coders
+
 
 '''
 Coder - User who writes and stores functions & classes
@@ -103,38 +356,367 @@ Coder - User who writes and stores functions & classes
 '''
 class Coder(User):
     __tablename__ = 'coders'
-    snippets = db.relationship('Snippet', backref='coder', lazy=True)
-    mentor_id = db.Column(db.Integer, db.ForeignKey('mentors.id'))
+    # read only: snippets are added by their coder_id (see Snippet.insert()),
+    # never through this collection, so saving a snippet doesn't load it;
+    # reads load it eagerly (see loader_options())
+    snippets = db.relationship('Snippet', viewonly=True, lazy=True)
+    mentor_id = db.Column(db.Integer, db.ForeignKey('mentors.id'), index=True)
+
+    __table_args__ = (
+        # partial index for the coders without a mentor (Coder.need_mentor),
+        # on id so that '/coders/available' pages are index range scans
+        db.Index('ix_coders_unmentored', 'id',
+                 postgresql_where=db.text('mentor_id IS NULL'),
+                 sqlite_where=db.text('mentor_id IS NULL')),
+    )
+
+    # fields returned by to_dict() by default, in summary views, and all of the
+    # fields a client may ask for
+    FIELDS = ('id', 'username', 'snippets', 'mentor_id')
+    SUMMARY_FIELDS = ('id', 'username', 'mentor_id', 'snippet_count')
+    ALL_FIELDS = FIELDS + ('snippet_count',)
 
     '''
     to_dict(): Method for returning dictionarified version of a Coder
+        fields: which of Coder.ALL_FIELDS to include (default Coder.FIELDS)
+        snippet_fields: which fields of each snippet to include (default Snippet.FIELDS)
+        EXAMPLE
+            coder.to_dict(Coder.SUMMARY_FIELDS)
     '''
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "username": self.username,
-            "snippets": [snippet.to_dict() for snippet in self.snippets],
-            "mentor_id": self.mentor_id
-        }
+    def to_dict(self, fields=None, snippet_fields=None):
+        coder = {}
+        for field in fields or self.FIELDS:
+            if field == 'snippets':
+                coder['snippets'] = [snippet.to_dict(snippet_fields) for snippet in self.snippets]
+            else:
+                coder[field] = getattr(self, field)
+        return coder
     
+    '''
+    with_snippets(): Class Method for querying coders with their snippets
+        loaded up front, so that to_dict() doesn't run a separate query for
+        each coder (only what to_dict(fields, snippet_fields) needs is loaded)
+        EXAMPLE
+            coders = Coder.with_snippets().all()
+    '''
+    @classmethod
+    def with_snippets(cls, fields=None, snippet_fields=None):
+        return cls.query.options(*cls.loader_options(fields, snippet_fields))
+
+    '''
+    loader_options(): Class Method returning the query options that load just
+        what to_dict(fields, snippet_fields) needs: snippets only if they are
+        asked for (and without their code/comments columns unless those are
+        asked for), and snippet_count only if it is asked for.
+        via is a callable returning the load path coders are reached through
+        (e.g. lambda: selectinload(Mentor.coders)), or None for coder queries
+    '''
+    @classmethod
+    def loader_options(cls, fields=None, snippet_fields=None, via=None):
+        fields = fields or cls.FIELDS
+        snippet_fields = snippet_fields or Snippet.FIELDS
+        options = []
+        if 'snippets' in fields:
+            def snippets():
+                return via().selectinload(cls.snippets) if via else selectinload(cls.snippets)
+            columns = {'id', 'coder_id'}.union(snippet_fields).difference(['code'])
+            if 'code' in snippet_fields:
+                # code lives in code_blobs; load the blobs in one more query
+                columns.add('code_hash')
+                options.append(snippets().selectinload(Snippet.blob))
+            options.append(snippets().load_only(*columns))
+        if 'snippet_count' in fields:
+            options.append(via().undefer(cls.snippet_count) if via else undefer(cls.snippet_count))
+        return options
+
     '''
     need_mentors(): Class Method for returning all coders who don't have a Mentor
     '''
     @classmethod
-    def need_mentor(cls):
-        return cls.query.filter_by(mentor_id=None)
+    def need_mentor(cls, fields=None, snippet_fields=None):
+        return cls.with_snippets(fields, snippet_fields).filter_by(mentor_id=None)
+
+    '''
+    assign_mentor(): Class Method making mentor_id the mentor of a coder, in a
+        single UPDATE ... FROM ... RETURNING statement (no coder or mentor
+        objects, nor their collections, are loaded). The coder's current row
+        is locked first (FOR UPDATE OF), so concurrent reassignments of the
+        coder queue up behind it and each sees the mentor the one before it
+        set. That statement is postgres only: other databases (sqlite, in
+        tests) read the current mentor and then update the row only if its
+        mentor is still that one, trying again if it isn't.
+        returns (coder's username, previous mentor's username) if the mentor
+        was changed, or None if the coder doesn't exist or already had that
+        mentor. The caller commits.
+        EXAMPLE
+            Coder.assign_mentor(2, 3)
+            db.session.commit()
+    '''
+    @classmethod
+    def assign_mentor(cls, coder_id, mentor_id):
+        if db.session.get_bind().dialect.name != 'postgresql':
+            return cls._assign_mentor_portable(coder_id, mentor_id)
+        locked = cls.__table__.alias('locked')
+        previous = db.select([locked.c.id, Mentor.username.label('mentor_username')]) \
+            .select_from(locked.outerjoin(Mentor.__table__, Mentor.id == locked.c.mentor_id)) \
+            .where(locked.c.id == coder_id) \
+            .where(locked.c.mentor_id.is_distinct_from(mentor_id)) \
+            .with_for_update(of=locked) \
+            .alias('previous')
+        statement = cls.__table__.update() \
+            .where(cls.id == previous.c.id) \
+            .values(mentor_id=mentor_id, version=cls.version + 1) \
+            .returning(cls.username, previous.c.mentor_username)
+        return db.session.execute(statement).first()
+
+    @classmethod
+    def _assign_mentor_portable(cls, coder_id, mentor_id):
+        while True:
+            current = db.session.query(cls.username, cls.mentor_id, Mentor.username) \
+                .outerjoin(Mentor, Mentor.id == cls.mentor_id) \
+                .filter(cls.id == coder_id).first()
+            if current is None or current[1] == mentor_id:
+                return None
+            username, previous_id, previous_username = current
+            statement = cls.__table__.update() \
+                .where(cls.id == coder_id) \
+                .where(cls.mentor_id.isnot_distinct_from(previous_id)) \
+                .values(mentor_id=mentor_id, version=cls.version + 1)
+            if db.session.execute(statement).rowcount:
+                return username, previous_username
+
+
+'''
+UserDirectory - one row per user (mentor or coder), keyed by username
+    - the username is the primary key, so the database itself keeps usernames
+      unique across mentors and coders
+    - resolves a username to its usertype ('mentor' or 'coder') and id in a
+      single index lookup, instead of trying the mentors and coders tables in
+      turn
+    - kept up to date by triggers on the mentors and coders tables whenever a
+      user is inserted, deleted or renamed (see USER_DIRECTORY_TRIGGERS
+      below), so bulk Query.update()/delete(), Core statements and plain SQL
+      keep it in step as well; it is never written to directly
+    EXAMPLE
+        entry = UserDirectory.lookup('coder1')
+        entry.usertype, entry.user_id     # ('coder', 2)
+'''
+class UserDirectory(db.Model):
+    __tablename__ = 'user_directory'
+    username = db.Column(db.String(24), primary_key=True)
+    usertype = db.Column(db.String(6), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('usertype', 'user_id'),
+        db.CheckConstraint("usertype IN ('mentor', 'coder')", name='ck_user_directory_usertype'),
+    )
+
+    '''
+    lookup(username)
+        returns the directory entry for a username, or None
+    '''
+    @classmethod
+    def lookup(cls, username):
+        return cls.query.get(username)
+
+
+# The triggers keeping user_directory in step with the mentors and coders
+# tables, per dialect. They are created along with the tables by
+# db.create_all() (and by the user_directory_triggers migration); a rename is
+# a delete and an insert of the directory row, so taking a username that is
+# already used fails with an IntegrityError just like inserting a user with it.
+USER_DIRECTORY_TRIGGERS = {
+    'postgresql': [
+        '''CREATE OR REPLACE FUNCTION sync_user_directory() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM user_directory WHERE usertype = TG_ARGV[0] AND user_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.username IS NOT NULL THEN
+        INSERT INTO user_directory (username, usertype, user_id) VALUES (NEW.username, TG_ARGV[0], NEW.id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+    ] + [
+        'CREATE TRIGGER {0}_user_directory AFTER INSERT OR DELETE OR UPDATE OF username, id ON {0} '
+        "FOR EACH ROW EXECUTE PROCEDURE sync_user_directory('{1}')".format(table, usertype)
+        for table, usertype in (('mentors', 'mentor'), ('coders', 'coder'))
+    ],
+    'sqlite': [
+        statement.format(table, usertype)
+        for table, usertype in (('mentors', 'mentor'), ('coders', 'coder'))
+        for statement in (
+            'CREATE TRIGGER {0}_user_directory_insert AFTER INSERT ON {0} '
+            'WHEN NEW.username IS NOT NULL BEGIN '
+            "INSERT INTO user_directory (username, usertype, user_id) VALUES (NEW.username, '{1}', NEW.id); "
+            'END',
+            'CREATE TRIGGER {0}_user_directory_update AFTER UPDATE OF username, id ON {0} BEGIN '
+            "DELETE FROM user_directory WHERE usertype = '{1}' AND user_id = OLD.id; "
+            "INSERT INTO user_directory (username, usertype, user_id) "
+            "SELECT NEW.username, '{1}', NEW.id WHERE NEW.username IS NOT NULL; "
+            'END',
+            'CREATE TRIGGER {0}_user_directory_delete AFTER DELETE ON {0} BEGIN '
+            "DELETE FROM user_directory WHERE usertype = '{1}' AND user_id = OLD.id; "
+            'END',
+        )
+    ],
+}
+
+for dialect, statements in USER_DIRECTORY_TRIGGERS.items():
+    for statement in statements:
+        event.listen(db.metadata, 'after_create', db.DDL(statement).execute_if(dialect=dialect))
+event.listen(db.metadata, 'after_drop',
+             db.DDL('DROP FUNCTION IF EXISTS sync_user_directory()').execute_if(dialect='postgresql'))
+
+
+'''
+username_taken(username)
+    checks whether a mentor or a coder already has the username, in one
+    index lookup on the user directory
+'''
+def username_taken(username):
+    return db.session.query(db.exists().where(UserDirectory.username == username)).scalar()
+
+
+'''
+CodeBlob - the body of a code snippet, stored once per distinct content
+    - keyed by the sha256 of the code, so identical code (boilerplate, copies
+      of a snippet) is only stored once however many snippets use it
+    - bodies over CODE_COMPRESS_THRESHOLD bytes are stored zlib-compressed
+    - blobs are never updated; changing a snippet's code points it at another
+      blob (see CodeBlob.prune() for removing blobs no snippet uses any more)
+'''
+class CodeBlob(db.Model):
+    __tablename__ = 'code_blobs'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    compressed = db.Column(db.Boolean, nullable=False, default=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    '''
+    text: the plain text of the code
+    '''
+    @property
+    def text(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode('utf-8')
+
+    '''
+    encode(text)
+        returns the column values (sha256, compressed, data) for a code body
+    '''
+    @staticmethod
+    def encode(text):
+        raw = text.encode('utf-8')
+        data, compressed = raw, False
+        if len(raw) > CODE_COMPRESS_THRESHOLD:
+            packed = zlib.compress(raw)
+            if len(packed) < len(raw):
+                data, compressed = packed, True
+        return {"sha256": hashlib.sha256(raw).hexdigest(), "compressed": compressed, "data": data}
+
+    '''
+    store(text)
+        returns the blob for a code body, inserting it if it doesn't exist yet
+        (the insert ignores conflicts, so concurrent writers of the same code
+        can't fail on the primary key)
+        EXAMPLE
+            snippet.blob = CodeBlob.store('def add(x,y):\\n\\treturn (x+y)')
+    '''
+    @classmethod
+    def store(cls, text):
+        values = cls.encode(text)
+        blob = cls.query.get(values['sha256'])
+        if blob is None:
+            dialect = db.session.get_bind().dialect.name
+            if dialect == 'postgresql':
+                insert = postgresql.insert(cls.__table__).on_conflict_do_nothing()
+            elif dialect == 'sqlite':
+                insert = cls.__table__.insert().prefix_with('OR IGNORE')
+            else:
+                insert = cls.__table__.insert()
+            db.session.execute(insert.values(**values))
+            blob = cls.query.get(values['sha256'])
+        return blob
+
+    '''
+    prune()
+        deletes the blobs that no snippet refers to any more and returns how
+        many were deleted (best run while the api is quiet, as a snippet saved
+        at the same moment may refer to a blob that is being deleted)
+    '''
+    @classmethod
+    def prune(cls):
+        unused = db.and_(
+            ~db.exists().where(Snippet.code_hash == cls.sha256),
+            ~db.exists().where(SnippetRevision.code_hash == cls.sha256))
+        count = cls.query.filter(unused).delete(synchronize_session=False)
+        db.session.commit()
+        return count
 
 
 '''
 Snippet - Code function or class written and stored by Coder and Reviewed by Mentor
+    the code itself is stored in code_blobs (see CodeBlob); snippet.code reads
+    and writes it as plain text
 '''
 class Snippet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     snippet_name = db.Column(db.String(200))
-    code = db.Column(db.String())
+    code_hash = db.Column(db.String(64), db.ForeignKey('code_blobs.sha256'), index=True)
     needs_review = db.Column(db.Boolean, default=False)
     comments = db.Column(db.String())
-    coder_id = db.Column(db.Integer, db.ForeignKey('coders.id'))
+    coder_id = db.Column(db.Integer, db.ForeignKey('coders.id'), index=True)
+    # incremented by the ORM on every update (see row_versions)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    coder = db.relationship('Coder', lazy=True)
+    blob = db.relationship('CodeBlob', lazy=True)
+    revisions = db.relationship('SnippetRevision', backref='snippet', lazy='dynamic',
+                                cascade='all, delete-orphan', passive_deletes=True)
+
+    @property
+    def code(self):
+        return self.blob.text if self.blob is not None else None
+
+    @code.setter
+    def code(self, text):
+        self.blob = CodeBlob.store(text) if text is not None else None
+
+    '''
+    revise()
+        changes a snippet and records the change as a new revision (call
+        update() afterwards to save both). A snippet saved before revisions
+        were kept first gets its current state recorded as revision 1.
+        EXAMPLE
+            snippet = Snippet.query.get(21)
+            snippet.revise('add', 'def add(x,y,z):\\n\\treturn (x+y+z)', True, '', 'Coder', 3)
+            snippet.update()
+    '''
+    def revise(self, snippet_name, code, needs_review, comments, author_type=None, author_id=None):
+        latest = self.revisions.order_by(SnippetRevision.number.desc()).first()
+        if latest is None:
+            latest = SnippetRevision.record(self, None, None)
+        previous_code = self.code
+
+        self.snippet_name = snippet_name
+        self.code = code
+        self.needs_review = needs_review
+        self.comments = comments
+        return SnippetRevision.record(self, latest, previous_code, author_type, author_id)
+
+    __table_args__ = (
+        # partial index for the mentor's review queue (Mentor.coders_for_review)
+        db.Index('ix_snippet_coder_id_needs_review', 'coder_id',
+                 postgresql_where=db.text('needs_review'),
+                 sqlite_where=db.text('needs_review')),
+    )
+    __mapper_args__ = {'version_id_col': version}
+
+    # fields returned by to_dict() by default, and in summary views (which
+    # leave out the code and comments bodies)
+    FIELDS = ('id', 'snippet_name', 'code', 'needs_review', 'comments', 'coder_id')
+    SUMMARY_FIELDS = ('id', 'snippet_name', 'needs_review', 'coder_id')
 
     '''
     insert()
@@ -175,15 +757,289 @@ class Snippet(db.Model):
 
     ''' to_dict() 
         returns dictionarified version of a snippet
+        fields: which of Snippet.FIELDS to include (default all of them)
     '''
         
-    def to_dict(self):
-        return {
-            "id": self.id,
+    def to_dict(self, fields=None):
+        return {field: getattr(self, field) for field in fields or self.FIELDS}
+
+
+
+'''
+SnippetRevision - one saved version of a Snippet
+    - revision 1 and every SNIPPET_CHECKPOINT_INTERVAL-th revision after it is
+      a checkpoint, referring to its full code in code_blobs (code_hash)
+    - every other revision stores only a compact delta from the revision
+      before it, so keeping the history doesn't multiply storage
+    - name, comments and needs_review are small and stored in full
+'''
+class SnippetRevision(db.Model):
+    __tablename__ = 'snippet_revisions'
+    id = db.Column(db.Integer, primary_key=True)
+    snippet_id = db.Column(db.Integer, db.ForeignKey('snippet.id', ondelete='CASCADE'), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    snippet_name = db.Column(db.String(200))
+    needs_review = db.Column(db.Boolean)
+    comments = db.Column(db.String())
+    code_hash = db.Column(db.String(64), db.ForeignKey('code_blobs.sha256'))
+    delta = db.Column(db.Text())
+    author_type = db.Column(db.String(6))
+    author_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    blob = db.relationship('CodeBlob', lazy=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('snippet_id', 'number'),
+    )
+
+    '''
+    record(snippet, previous, previous_code, author_type, author_id)
+        adds a revision holding the snippet's current state to the session,
+        following the revision previous (whose code was previous_code), or as
+        revision 1 if previous is None
+    '''
+    @classmethod
+    def record(cls, snippet, previous, previous_code, author_type=None, author_id=None):
+        revision = cls(
+            snippet=snippet,
+            number=previous.number + 1 if previous else 1,
+            snippet_name=snippet.snippet_name,
+            needs_review=snippet.needs_review,
+            comments=snippet.comments,
+            author_type=author_type,
+            author_id=author_id)
+        if (revision.number - 1) % SNIPPET_CHECKPOINT_INTERVAL == 0:
+            revision.blob = snippet.blob
+        else:
+            revision.delta = make_delta(previous_code, snippet.code)
+        db.session.add(revision)
+        return revision
+
+    '''
+    get_code()
+        rebuilds the code of this revision from the nearest checkpoint at or
+        before it, applying at most SNIPPET_CHECKPOINT_INTERVAL - 1 deltas
+        (one query for the checkpoint and the deltas after it)
+    '''
+    def get_code(self):
+        if self.code_hash is not None:
+            return self.blob.text
+
+        cls = type(self)
+        checkpoint = db.select([db.func.max(cls.number)]).where(db.and_(
+            cls.snippet_id == self.snippet_id,
+            cls.number <= self.number,
+            cls.code_hash != None)).as_scalar()
+        chain = cls.query.options(joinedload(cls.blob)).filter(
+            cls.snippet_id == self.snippet_id,
+            cls.number >= db.func.coalesce(checkpoint, 1),
+            cls.number <= self.number).order_by(cls.number)
+
+        code = None
+        for revision in chain:
+            if revision.blob is not None:
+                code = revision.blob.text
+            elif revision.delta is not None:
+                code = apply_delta(code, revision.delta)
+        return code
+
+    '''
+    to_dict()
+        returns dictionarified version of a revision (the code is only
+        included if include_code is True, as it has to be rebuilt)
+    '''
+    def to_dict(self, include_code=False):
+        revision = {
+            "number": self.number,
+            "snippet_id": self.snippet_id,
             "snippet_name": self.snippet_name,
-            "code": self.code,
             "needs_review": self.needs_review,
             "comments": self.comments,
-            "coder_id": self.coder_id
+            "author_type": self.author_type,
+            "author_id": self.author_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None
         }
+        if include_code:
+            revision["code"] = self.get_code()
+        return revision
+
+
+'''
+password_cipher(keys)
+    the cipher for SIGNUP_PASSWORD_KEYS (raises RuntimeError if none are set)
+    EXAMPLE
+        token = password_cipher(SIGNUP_PASSWORD_KEYS).encrypt(b'password')
+'''
+@functools.lru_cache()
+def password_cipher(keys):
+    if not keys:
+        raise RuntimeError("SIGNUP_PASSWORD_KEYS is not set; it is needed to keep signup passwords encrypted")
+    from cryptography.fernet import Fernet, MultiFernet
+    return MultiFernet([Fernet(key.strip()) for key in keys.split(',') if key.strip()])
+
+
+'''
+SignupOutbox - signups waiting to be registered with auth0 (transactional outbox)
+    - '/signup' adds the local user and its outbox row in one transaction, so
+      the user is only ever sent to auth0 if it was saved locally
+    - worker.py drains the outbox: rows are 'pending' until auth0 accepts
+      them ('done') or rejects them ('failed', which also removes the local
+      user again, so the username can be used for a new signup)
+    - the password is kept encrypted (with SIGNUP_PASSWORD_KEYS), and only
+      until the row is done or failed
+    - token is the random id clients poll the signup's status with
+'''
+class SignupOutbox(db.Model):
+    __tablename__ = 'signup_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), nullable=False, unique=True, default=lambda: uuid.uuid4().hex)
+    username = db.Column(db.String(24), nullable=False)
+    usertype = db.Column(db.String(6), nullable=False)
+    user_id = db.Column(db.Integer)
+    email = db.Column(db.String(254))
+    encrypted_password = db.Column(db.String())
+    status = db.Column(db.String(7), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # when the row may next be sent (a claim by a worker also pushes it back)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    error = db.Column(db.String())
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # partial index for the rows a worker may claim (SignupOutbox.claim)
+        db.Index('ix_signup_outbox_pending', 'next_attempt_at',
+                 postgresql_where=db.text("status = 'pending'"),
+                 sqlite_where=db.text("status = 'pending'")),
+    )
+
+    @property
+    def password(self):
+        if self.encrypted_password is None:
+            return None
+        return password_cipher(SIGNUP_PASSWORD_KEYS).decrypt(self.encrypted_password.encode()).decode('utf-8')
 
+    @password.setter
+    def password(self, password):
+        self.encrypted_password = password_cipher(SIGNUP_PASSWORD_KEYS).encrypt(
+            password.encode('utf-8')).decode() if password is not None else None
+
+    '''
+    insert(user)
+        saves a new user together with its outbox row, in one transaction
+        EXAMPLE
+            coder = Coder(username='coder7')
+            signup = SignupOutbox(username='coder7', usertype='coder', email=..., password=...)
+            signup.insert(coder)
+    '''
+    def insert(self, user):
+        db.session.add(user)
+        db.session.flush()
+        self.user_id = user.id
+        db.session.add(self)
+        db.session.commit()
+
+    '''
+    claim(batch_size, lease)
+        returns up to batch_size pending rows that are due, oldest first, and
+        pushes their next_attempt_at lease seconds ahead so no other worker
+        picks them up meanwhile (if this worker dies, they are picked up again
+        once the lease runs out). On postgres, concurrent claims skip each
+        other's rows (FOR UPDATE SKIP LOCKED) rather than waiting.
+    '''
+    @classmethod
+    def claim(cls, batch_size, lease):
+        now = datetime.datetime.utcnow()
+        ids = [id for (id,) in db.session.query(cls.id)
+               .filter(cls.status == 'pending', cls.next_attempt_at <= now)
+               .order_by(cls.id).limit(batch_size)
+               .with_for_update(skip_locked=True)]
+        if not ids:
+            db.session.commit()
+            return []
+        cls.query.filter(cls.id.in_(ids)).update(
+            {cls.next_attempt_at: now + datetime.timedelta(seconds=lease)},
+            synchronize_session=False)
+        db.session.commit()
+        return cls.query.filter(cls.id.in_(ids)).order_by(cls.id).all()
+
+    '''
+    done() / retry(delay) / fail(error)
+        record the outcome of sending the row to auth0 (and commit it)
+    '''
+    def done(self):
+        self.status = 'done'
+        self.password = None
+        db.session.commit()
+
+    def retry(self, delay):
+        self.attempts += 1
+        self.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        db.session.commit()
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.password = None
+        self.error = error
+        user_class = Mentor if self.usertype == 'mentor' else Coder
+        user_class.query.filter_by(id=self.user_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def to_dict(self):
+        return {
+            "signup_id": self.token,
+            "username": self.username,
+            "usertype": self.usertype,
+            "status": self.status,
+            "error": self.error
+        }
+
+
+'''
+make_delta(old, new) / apply_delta(old, delta)
+    line-based deltas between two versions of some code, as compact json:
+    a positive number n copies the next n lines of the old code, a negative
+    number -n skips the next n lines, and a list of strings inserts those lines
+    EXAMPLE
+        apply_delta(old, make_delta(old, new)) == new
+'''
+def make_delta(old, new):
+    old_lines = (old or '').splitlines(True)
+    new_lines = (new or '').splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append(new_lines[j1:j2])
+    return json.dumps(ops, separators=(',', ':'))
+
+def apply_delta(old, delta):
+    old_lines = (old or '').splitlines(True)
+    new_lines = []
+    position = 0
+    for op in json.loads(delta):
+        if isinstance(op, list):
+            new_lines.extend(op)
+        elif op > 0:
+            new_lines.extend(old_lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return ''.join(new_lines)
+
+
+'''
+snippet_count - number of snippets a coder has, as a correlated subquery
+    deferred, so it is only computed when asked for with undefer() (see
+    Coder.loader_options()), without loading the snippets themselves
+'''
+Coder.snippet_count = db.column_property(
+    db.select([db.func.count(Snippet.id)])
+    .where(Snippet.coder_id == Coder.id)
+    .correlate_except(Snippet)
+    .label('snippet_count'),
+    deferred=True)
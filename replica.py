@@ -0,0 +1,148 @@
+import math
+import os
+import threading
+import time
+from flask import current_app, g, request, _request_ctx_stack
+from functools import wraps
+
+from cache import MemoryCache
+from models import db
+
+
+# Read replica routing (only if DATABASE_REPLICA_URL is set; see setup_db).
+# Read only endpoints use the replica while its lag, measured at most every
+# REPLICA_LAG_CHECK_INTERVAL seconds, is at most REPLICA_MAX_LAG seconds, and
+# use the primary otherwise. A user's reads also stay on the primary for
+# REPLICA_STICKY_SECONDS after each of their writes, so they see their own
+# changes.
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 1))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# how far (in seconds) a postgres standby is behind its primary: 0 once it
+# has replayed everything it has received, or if it isn't a standby at all
+# (e.g. a second local database standing in for a replica)
+POSTGRES_LAG_QUERY = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END'''
+
+# requests that don't write
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+'''
+ReplicaRouter - decides, per request, whether a read only endpoint reads from
+    the replica (by setting g.use_replica for models.RoutingSession)
+    - read_only: decorator for the endpoints that may read from the replica
+      (below requires_auth, which identifies the user, and above
+      response_cache.cached)
+    - after_request: remembers which users just wrote, in store (any cache
+      backend from cache.py; pass the redis backend to share this between
+      processes, otherwise each process only knows of the writes it served)
+    - responses read from the replica aren't put in the response cache, as
+      they may miss a change that was just invalidated (its lag may have been
+      measured up to check_interval seconds ago), and a user who just wrote
+      bypasses the response cache altogether, so they don't get a response
+      cached before their write reached it
+    EXAMPLE
+        replica_router = ReplicaRouter()
+        app.after_request(replica_router.after_request)
+
+        @app.route('/coders')
+        @requires_auth(scopes=['get:coders'])
+        @replica_router.read_only
+        @response_cache.cached(lambda: ['coders'])
+        def get_all_coders():
+            ...
+'''
+class ReplicaRouter:
+    def __init__(self, store=None, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_LAG_CHECK_INTERVAL, sticky_seconds=REPLICA_STICKY_SECONDS):
+        self.store = store if store is not None else MemoryCache()
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.sticky_seconds = sticky_seconds
+        self.last_lag = None
+        self.checked_at = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.sticky_reads = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def configured():
+        return bool(current_app.config.get('SQLALCHEMY_BINDS', {}).get('replica'))
+
+    @staticmethod
+    def _current_user():
+        payload = getattr(_request_ctx_stack.top, 'current_user', None)
+        return payload.get('sub') if payload else None
+
+    @staticmethod
+    def _key(user):
+        return 'replica:wrote:' + user
+
+    def measure_lag(self):
+        """Asks the replica how far behind the primary it is, in seconds
+        """
+        engine = db.get_engine(current_app, bind='replica')
+        if engine.dialect.name != 'postgresql':
+            return 0.0
+        with engine.connect() as connection:
+            return float(connection.execute(POSTGRES_LAG_QUERY).scalar() or 0)
+
+    def lag(self):
+        """Returns the replica's lag as last measured, measuring it again if
+        that is more than check_interval seconds ago (inf if the replica
+        can't be reached, None until the first measurement is in)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return self.last_lag
+            # other requests keep using the last value while this one measures
+            self.checked_at = now
+        try:
+            self.last_lag = self.measure_lag()
+        except Exception:
+            self.last_lag = math.inf
+        return self.last_lag
+
+    def read_only(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self.configured():
+                user = self._current_user()
+                if user is not None and self.store.get(self._key(user)) is not None:
+                    self.sticky_reads += 1
+                    g.bypass_response_cache = True
+                    return f(*args, **kwargs)
+                lag = self.lag()
+                if lag is None or lag > self.max_lag:
+                    self.primary_reads += 1
+                else:
+                    self.replica_reads += 1
+                    g.use_replica = True
+                    g.skip_response_cache = True
+            return f(*args, **kwargs)
+        return wrapper
+
+    def after_request(self, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400 and self.configured():
+            user = self._current_user()
+            if user is not None:
+                self.store.set(self._key(user), b'1', (), self.sticky_seconds)
+        return response
+
+    def stats(self):
+        lag = self.last_lag
+        return {
+            "configured": self.configured(),
+            "lag": None if lag is None or math.isinf(lag) else lag,
+            "max_lag": self.max_lag,
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "sticky_reads": self.sticky_reads
+        }
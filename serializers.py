@@ -0,0 +1,116 @@
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from flask import json as flask_json
+
+from models import Coder, Snippet
+
+
+'''
+Serializers - write the JSON of a Mentor, Coder or Snippet straight from its
+    attributes, without building the dict that to_dict() returns first
+    - a serializer is built once per model and field set (see
+      coder_serializer() etc.) and reused for every row; it works on model
+      instances and on query rows with the same attribute names alike
+    - the output is byte for byte what jsonify() writes for to_dict() with
+      Flask's default JSON settings (keys sorted, compact separators, non
+      ascii characters escaped)
+    EXAMPLE
+        serialize = coder_serializer(Coder.SUMMARY_FIELDS)
+        body = '[' + ','.join(serialize(coder) for coder in coders) + ']'
+'''
+
+def encode_none(value):
+    return 'null'
+
+def encode_bool(value):
+    return 'true' if value else 'false'
+
+# how json.dumps() writes each of the column types the models use
+ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: encode_bool,
+    float: float.__repr__,
+    type(None): encode_none,
+}
+
+def encode(value):
+    """Returns the JSON for a single value (anything but the column types
+    above goes through flask's encoder, as jsonify() would)
+    """
+    encoder = ENCODERS.get(type(value))
+    if encoder is None:
+        return flask_json.dumps(value, separators=(',', ':'))
+    return encoder(value)
+
+def encode_list(serialize, rows):
+    return '[' + ','.join([serialize(row) for row in rows]) + ']'
+
+
+def make_serializer(fields, nested=None):
+    """Builds a serializer writing the given fields of a row, in sorted
+    order. nested maps a field holding a list of rows to the serializer for
+    those rows.
+
+    Loaded columns are read from the row's __dict__ (where SQLAlchemy keeps
+    them, for model instances and query rows alike), which skips the
+    attribute instrumentation; anything else (properties, deferred or expired
+    columns) is read as an attribute. The serializer is compiled into a single function that reads
+    each field once and fills a template, e.g. for ('id', 'username'):
+        def serialize(row):
+            values = row.__dict__
+            v0 = values['id'] if 'id' in values else row.id
+            v1 = values['username'] if 'username' in values else row.username
+            return '{"id":%s,"username":%s}' % (
+                get_encoder(type(v0), encode)(v0), get_encoder(type(v1), encode)(v1),)
+    """
+    nested = nested or {}
+    fields = sorted(set(fields))
+    if not fields:
+        return lambda row: '{}'
+
+    namespace = {'get_encoder': ENCODERS.get, 'encode': encode, 'encode_list': encode_list}
+    keys, lines, values = [], [], []
+    for i, field in enumerate(fields):
+        if not field.isidentifier():
+            raise ValueError("not a field name: {!r}".format(field))
+        keys.append(encode_basestring_ascii(field).replace('%', '%%') + ':%s')
+        lines.append('    v{0} = values[{1!r}] if {1!r} in values else row.{1}'.format(i, field))
+        if field in nested:
+            namespace['serialize_{}'.format(i)] = nested[field]
+            values.append('encode_list(serialize_{0}, v{0})'.format(i))
+        else:
+            values.append('get_encoder(type(v{0}), encode)(v{0})'.format(i))
+    template = '{' + ','.join(keys) + '}'
+
+    source = 'def serialize(row):\n    values = row.__dict__\n{}\n    return {!r} % ({},)\n'.format(
+        '\n'.join(lines), template, ', '.join(values))
+    exec(compile(source, '<serializer {}>'.format(','.join(fields)), 'exec'), namespace)
+    return namespace['serialize']
+
+
+# the serializers of each model, built the first time a field set is used
+# (fields and snippet_fields are tuples in the models' order, as returned by
+# get_fields() in app.py, so there is one per field set; the caches are
+# bounded all the same, as their keys come from query parameters)
+SERIALIZER_CACHE_SIZE = 256
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def snippet_serializer(fields=None):
+    """Serializer equivalent to Snippet.to_dict(fields)
+    """
+    return make_serializer(fields or Snippet.FIELDS)
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def coder_serializer(fields=None, snippet_fields=None):
+    """Serializer equivalent to Coder.to_dict(fields, snippet_fields)
+    """
+    return make_serializer(fields or Coder.FIELDS,
+                           {'snippets': snippet_serializer(snippet_fields)})
+
+@lru_cache(maxsize=SERIALIZER_CACHE_SIZE)
+def mentor_serializer(coder_fields=None, snippet_fields=None):
+    """Serializer equivalent to Mentor.to_dict(coder_fields, snippet_fields)
+    """
+    return make_serializer(('id', 'username', 'coders'),
+                           {'coders': coder_serializer(coder_fields, snippet_fields)})
@@ -1,13 +1,29 @@
+import base64
 import os
+import socket
+import tempfile
+import threading
 import unittest
 import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from alembic.script import ScriptDirectory
+from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc
 from dotenv import load_dotenv
 
 load_dotenv()
+# signup passwords are kept encrypted; any key will do for the tests
+os.environ.setdefault('SIGNUP_PASSWORD_KEYS', 'HiJ2MXro2T_mh3js_nLb89zvCRTZwDhB4TuOS6NzQS8=')
 
+import auth
 from app import create_app
-from models import db, setup_db, Mentor, Coder, Snippet, User
+from models import db, setup_db, check_schema_version, CODE_COMPRESS_THRESHOLD, SCHEMA_VERSION, TimedQueuePool, CodeBlob, Mentor, Coder, Snippet, SnippetRevision, SignupOutbox, User, UserDirectory
+from auth0_client import Auth0Client, Auth0Error, CircuitBreaker, auth0_client
+import worker
+from warmup import Warmup
+from metrics import MetricsRegistry, PHASES, pool_samples
+from serializers import coder_serializer
 
 mentor_token = "Bearer {}".format(os.environ.get('AUTH0_MENTOR_TOKEN'))
 coder_token = "Bearer {}".format(os.environ.get('AUTH0_CODER_TOKEN'))
@@ -37,6 +53,58 @@ class FuncsterCase(unittest.TestCase):
     def tearDown(self):
         """Executed after reach test"""
         pass
+
+    def record_queries(self, send):
+        """Runs send(client) and returns its response and the SQL statements it executed"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = send(self.client())
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    def count_queries(self, path, headers):
+        """Runs a GET request and returns the number of SQL statements it executed"""
+        res, statements = self.record_queries(lambda client: client.get(path, headers=headers))
+
+        self.assertEqual(res.status_code, 200)
+        return len(statements)
+
+    def add_mock_users(self, prefix, mentor_count, coders_per_mentor, snippets_per_coder):
+        """Adds mentors/coders/snippets (plus one coder without a mentor) and
+        returns the ids needed to remove them again"""
+        with self.app.app_context():
+            mentors, coders, snippets = [], [], []
+            for i in range(mentor_count):
+                mentor = Mentor(username='{}m{}'.format(prefix, i))
+                for j in range(coders_per_mentor):
+                    coder = Coder(username='{}c{}_{}'.format(prefix, i, j))
+                    snippets.extend(Snippet(coder=coder, snippet_name='mock', code='pass', needs_review=True)
+                                    for k in range(snippets_per_coder))
+                    mentor.coders.append(coder)
+                    coders.append(coder)
+                mentors.append(mentor)
+            coders.append(Coder(username='{}free'.format(prefix)))
+            db.session.add_all(mentors + coders + snippets)
+            db.session.commit()
+            # the rows were added behind the app's back, so drop any cached responses
+            self.app.extensions['response_cache'].clear()
+            return [m.id for m in mentors], [c.id for c in coders]
+
+    def remove_mock_users(self, mentor_ids, coder_ids):
+        with self.app.app_context():
+            Snippet.query.filter(Snippet.coder_id.in_(coder_ids)).delete(synchronize_session=False)
+            Coder.query.filter(Coder.id.in_(coder_ids)).delete(synchronize_session=False)
+            Mentor.query.filter(Mentor.id.in_(mentor_ids)).delete(synchronize_session=False)
+            db.session.commit()
+        self.app.extensions['response_cache'].clear()
     
     #----------------------------------------------------------------------------
     #  Tests:
@@ -53,6 +121,200 @@ class FuncsterCase(unittest.TestCase):
     # Note: the index ('/') endpoint isn't really a functional endpoint, doesn't require 
     # data or authentification, so no fail test has been created for that endpoint
 
+    def test_a2_jwks_key_store(self):
+        '''Test that the signing keys are kept for the Cache-Control max-age (and
+           served stale, while a background refresh runs, for its
+           stale-while-revalidate), that an unknown kid refetches them at most
+           once per min_refresh_interval, and that a key set that was never
+           fetched is a 503'''
+        from base64 import urlsafe_b64encode
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        def jwk(kid):
+            numbers = rsa.generate_private_key(65537, 2048, default_backend()).public_key().public_numbers()
+            encode = lambda n: urlsafe_b64encode(n.to_bytes((n.bit_length() + 7) // 8, 'big')).rstrip(b'=').decode()
+            return {'kid': kid, 'kty': 'RSA', 'use': 'sig', 'n': encode(numbers.n), 'e': encode(numbers.e)}
+
+        now, fetches, responses = [1000.0], [], []
+        fetching, release = threading.Event(), threading.Event()
+
+        class Response:
+            def __init__(self, keys, cache_control):
+                self.body = json.dumps({'keys': keys}).encode()
+                self.headers = {'Cache-Control': cache_control}
+
+            def read(self):
+                return self.body
+
+        def urlopen(url, timeout):
+            fetches.append(url)
+            response = responses.pop(0)
+            if isinstance(response, threading.Event):
+                fetching.set()
+                release.wait(5)
+                response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        class Clock:
+            @staticmethod
+            def time():
+                return now[0]
+
+        saved = auth.urlopen, auth.time
+        auth.urlopen, auth.time = urlopen, Clock
+        try:
+            key1, key2, key3 = jwk('k1'), jwk('k2'), jwk('k3')
+            store = auth.JWKSKeyStore('https://example/jwks.json', ttl=600, stale_ttl=3600,
+                                      min_refresh_interval=30)
+            responses.append(Response([key1], 'public, max-age=120, stale-while-revalidate=60'))
+            first = store.get_key('k1')
+            self.assertIsNotNone(first)
+            now[0] = 1119
+            self.assertIs(store.get_key('k1'), first)
+            self.assertEqual(len(fetches), 1)
+
+            # an unknown kid: no refetch within min_refresh_interval of the last one
+            now[0] = 1010
+            self.assertIsNone(store.get_key('k2'))
+            self.assertEqual(len(fetches), 1)
+            now[0] = 1040
+            responses.append(Response([key1, key2], 'max-age=120, stale-while-revalidate=60'))
+            self.assertIsNotNone(store.get_key('k2'))
+            self.assertIs(store.get_key('k1'), first)
+            self.assertEqual(len(fetches), 2)
+
+            # past max-age (1160) but within stale-while-revalidate (1220): the
+            # old keys are served while one background refresh fetches new ones
+            now[0] = 1170
+            responses.extend([fetching, Response([key1, key3], 'max-age=120')])
+            self.assertIs(store.get_key('k1'), first)
+            self.assertTrue(fetching.wait(5))
+            self.assertIsNotNone(store.get_key('k2'))
+            self.assertEqual(len(fetches), 3)
+            release.set()
+            for i in range(500):
+                if store.get_key('k3') is not None:
+                    break
+                threading.Event().wait(0.01)
+            self.assertIsNotNone(store.get_key('k3'))
+            self.assertIsNone(store.get_key('k2'))
+            self.assertEqual(len(fetches), 3)
+
+            # past the stale window: fetched again before answering, and
+            # without a default max-age the store's own ttl applies
+            now[0] = 1170 + 120 + 3600
+            responses.append(Response([key1], ''))
+            self.assertIs(store.get_key('k1'), first)
+            self.assertEqual(len(fetches), 4)
+            now[0] += 599
+            self.assertIs(store.get_key('k1'), first)
+            self.assertEqual(len(fetches), 4)
+
+            # no key set was ever fetched
+            store = auth.JWKSKeyStore('https://example/jwks.json')
+            responses.append(OSError('unreachable'))
+            with self.assertRaises(auth.AuthError) as error:
+                store.get_key('k1')
+            self.assertEqual(error.exception.status_code, 503)
+            self.assertEqual(error.exception.error['code'], 'jwks_unavailable')
+        finally:
+            release.set()
+            auth.urlopen, auth.time = saved
+
+    def test_a3_verified_token_cache(self):
+        '''Test that a verified token is cached until its exp claim or max_ttl,
+           whichever comes first, that the least recently used token is
+           evicted at capacity, and that hits and misses are counted (and
+           reported at '/metrics')'''
+        now = [1000.0]
+
+        class Clock:
+            @staticmethod
+            def time():
+                return now[0]
+
+        saved = auth.time
+        auth.time = Clock
+        try:
+            cache = auth.VerifiedTokenCache(maxsize=2, max_ttl=300)
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', {'sub': 'a', 'exp': 1060})
+            cache.put('b', {'sub': 'b', 'exp': 5000})
+            self.assertEqual(cache.get('a'), {'sub': 'a', 'exp': 1060})
+
+            # expires at exp, or after max_ttl if that comes first
+            now[0] = 1060
+            self.assertIsNone(cache.get('a'))
+            now[0] = 1299
+            self.assertEqual(cache.get('b')['sub'], 'b')
+            now[0] = 1300
+            self.assertIsNone(cache.get('b'))
+
+            # the least recently used token goes first
+            for token in ('c', 'd'):
+                cache.put(token, {'sub': token})
+            cache.get('c')
+            cache.put('e', {'sub': 'e'})
+            self.assertIsNone(cache.get('d'))
+            self.assertEqual(cache.get('c')['sub'], 'c')
+            self.assertEqual(cache.get('e')['sub'], 'e')
+            self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 5, 'misses': 4})
+        finally:
+            auth.time = saved
+
+        self.app.config['METRICS_TOKEN'] = 'metrics-token'
+        self.client().get('/coders?limit=1', headers=mentor_headers)
+        res = self.client().get('/metrics', headers={'Authorization': 'Bearer metrics-token'})
+        text = res.get_data(as_text=True)
+        self.assertIn('# TYPE funcster_token_cache_size gauge\nfuncster_token_cache_size ', text)
+        self.assertIn('\nfuncster_token_cache_hits_total ', text)
+
+    def test_a4_requires_auth_scopes(self):
+        '''Test that requires_auth itself answers 403 to a token without every
+           required scope, and that has_scope reads the permissions it
+           verified'''
+        payloads = {
+            'reader': {'sub': 'reader', 'permissions': ['get:things']},
+            'editor': {'sub': 'editor', 'permissions': ['get:things', 'edit:things']},
+            'nobody': {'sub': 'nobody'}}
+        app = Flask(__name__)
+
+        @app.route('/things')
+        @auth.requires_auth(scopes=['get:things', 'edit:things'])
+        def edit_things():
+            return jsonify({'get': auth.has_scope('get:things'), 'delete': auth.has_scope('delete:things')})
+
+        @app.route('/any')
+        @auth.requires_auth
+        def any_token():
+            return jsonify({'get': auth.has_scope('get:things')})
+
+        @app.route('/one')
+        @auth.requires_auth(scopes='get:things')
+        def one_scope():
+            return jsonify({})
+
+        saved = auth.get_verified_payload
+        auth.get_verified_payload = lambda token: payloads[token]
+        try:
+            client = app.test_client()
+            headers = lambda token: {'Authorization': 'Bearer ' + token}
+            res = client.get('/things', headers=headers('editor'))
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json(), {'get': True, 'delete': False})
+            self.assertEqual(client.get('/things', headers=headers('reader')).status_code, 403)
+            self.assertEqual(client.get('/one', headers=headers('reader')).status_code, 200)
+            self.assertEqual(client.get('/one', headers=headers('nobody')).status_code, 403)
+            self.assertEqual(client.get('/any', headers=headers('nobody')).get_json(), {'get': False})
+            self.assertEqual(client.get('/any', headers=headers('reader')).get_json(), {'get': True})
+            with app.test_request_context('/'):
+                self.assertFalse(auth.has_scope('get:things'))
+        finally:
+            auth.get_verified_payload = saved
+
     def test_b_check_signup_fail(self):
         '''Test the signup endpoint with an existing username'''
         request_body = {
@@ -67,6 +329,260 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(res.status_code, 409)
         self.assertFalse(data['success'])
 
+    def test_b2_signup_against_auth0_stub(self):
+        '''Test the signup endpoint and the signup outbox worker against a
+           local stub of auth0: the signup is accepted straight away, then
+           sent on by the worker; a signup auth0 rejects fails (and the local
+           user is removed), one made while auth0 is failing is retried, and
+           is done if auth0 has the user by then; passwords are kept encrypted'''
+        responses, requests_seen = [], []
+
+        class StubAuth0(BaseHTTPRequestHandler):
+            def do_POST(self):
+                requests_seen.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                status, body = responses.pop(0) if responses else (503, {})
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), StubAuth0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        saved = auth0_client.base_url, auth0_client.backoff, auth0_client.breaker
+        auth0_client.base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+        auth0_client.backoff = 0
+        auth0_client.breaker = CircuitBreaker(threshold=100, reset_timeout=60)
+        signup = {'username': 'stubcoder', 'usertype': 'coder',
+                  'email': 'stubcoder@email.com', 'password': 'fakePassword'}
+        usernames = ['stubcoder', 'stubcoder2', 'stubcoder3', 'stubcoder4']
+        try:
+            res = self.client().post('/signup', json=signup)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 202)
+            self.assertEqual(data['status'], 'pending')
+            self.assertEqual(requests_seen, [])
+            signup_id = data['signup_id']
+
+            res = self.client().get('/signup/' + signup_id)
+            self.assertEqual(json.loads(res.data)['status'], 'pending')
+            with self.app.app_context():
+                outbox = SignupOutbox.query.filter_by(token=signup_id).first()
+                self.assertNotIn('fakePassword', outbox.encrypted_password)
+                self.assertEqual(outbox.password, 'fakePassword')
+
+            responses.append((200, {'_id': 'abc', 'email': 'stubcoder@email.com'}))
+            with self.app.app_context():
+                self.assertEqual(worker.process_signups(), 1)
+            self.assertEqual(requests_seen[-1]['username'], 'stubcoder')
+            self.assertEqual(requests_seen[-1]['user_metadata'], {'role': 'Coder'})
+            self.assertEqual(requests_seen[-1]['password'], 'fakePassword')
+            res = self.client().get('/signup/' + signup_id)
+            self.assertEqual(json.loads(res.data)['status'], 'done')
+
+            # rejected by auth0: the signup fails and the local user goes
+            responses.append((400, {'code': 'invalid_password', 'description': 'Password is too weak'}))
+            res = self.client().post('/signup', json=dict(signup, username='stubcoder2'))
+            signup_id = json.loads(res.data)['signup_id']
+            with self.app.app_context():
+                worker.process_signups()
+                self.assertIsNone(Coder.query.filter_by(username='stubcoder2').first())
+            data = json.loads(self.client().get('/signup/' + signup_id).data)
+            self.assertEqual(data['status'], 'failed')
+            self.assertEqual(data['error'], 'Password is too weak')
+
+            # auth0 failing: the signup stays pending, to be retried later
+            res = self.client().post('/signup', json=dict(signup, username='stubcoder3'))
+            signup_id = json.loads(res.data)['signup_id']
+            with self.app.app_context():
+                worker.process_signups()
+                outbox = SignupOutbox.query.filter_by(token=signup_id).first()
+                self.assertEqual(outbox.status, 'pending')
+                self.assertEqual(outbox.attempts, 1)
+                # not due again until its backoff has passed
+                self.assertEqual(worker.process_signups(), 0)
+
+                # the attempt that failed got through after all: auth0 now
+                # has the user, and the signup is done rather than failed
+                outbox.next_attempt_at = outbox.created_at
+                db.session.commit()
+                responses.append((400, {'code': 'user_exists', 'description': 'The user already exists.'}))
+                self.assertEqual(worker.process_signups(), 1)
+                self.assertIsNotNone(Coder.query.filter_by(username='stubcoder3').first())
+            data = json.loads(self.client().get('/signup/' + signup_id).data)
+            self.assertEqual(data['status'], 'done')
+            with self.app.app_context():
+                self.assertIsNone(SignupOutbox.query.filter_by(token=signup_id).first().encrypted_password)
+
+            # turned down on a retry without auth0 saying it has the user (e.g.
+            # the email belongs to someone else's account): the signup fails
+            res = self.client().post('/signup', json=dict(signup, username='stubcoder4'))
+            signup_id = json.loads(res.data)['signup_id']
+            with self.app.app_context():
+                worker.process_signups()
+                outbox = SignupOutbox.query.filter_by(token=signup_id).first()
+                outbox.next_attempt_at = outbox.created_at
+                db.session.commit()
+                responses.append((400, {'code': 'invalid_signup', 'description': 'Invalid sign up'}))
+                self.assertEqual(worker.process_signups(), 1)
+                self.assertIsNone(Coder.query.filter_by(username='stubcoder4').first())
+            data = json.loads(self.client().get('/signup/' + signup_id).data)
+            self.assertEqual(data['status'], 'failed')
+
+            res = self.client().get('/signup/unknown')
+            self.assertEqual(res.status_code, 404)
+        finally:
+            auth0_client.base_url, auth0_client.backoff, auth0_client.breaker = saved
+            server.shutdown()
+            server.server_close()
+            with self.app.app_context():
+                SignupOutbox.query.filter(SignupOutbox.username.in_(usernames)).delete(synchronize_session=False)
+                Coder.query.filter(Coder.username.in_(usernames)).delete(synchronize_session=False)
+                db.session.commit()
+            self.app.extensions['response_cache'].clear()
+
+    def test_b3_signup_fail_username_of_other_usertype(self):
+        '''Test the signup endpoint with a coder username that a mentor already has,
+           and that the database itself refuses such a duplicate'''
+        request_body = {
+            'username': 'mentor1',
+            'usertype': 'coder',
+            'email': 'mentor1@email.com',
+            'password': 'fakePassword'}
+
+        res = self.client().post('/signup', json=request_body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertFalse(data['success'])
+
+        with self.app.app_context():
+            db.session.add(Coder(username='mentor1'))
+            with self.assertRaises(exc.IntegrityError):
+                db.session.commit()
+            db.session.rollback()
+
+    def test_b3_user_directory_follows_writes_outside_the_orm(self):
+        '''Test that Core inserts and bulk updates and deletes keep the user
+           directory up to date, and that a bulk rename cannot take a username
+           the other usertype has'''
+        def entry(username):
+            return db.session.query(UserDirectory.usertype, UserDirectory.user_id) \
+                .filter_by(username=username).first()
+
+        with self.app.app_context():
+            db.session.execute(Coder.__table__.insert().values(username='directorycoder'))
+            usertype, coder_id = entry('directorycoder')
+            self.assertEqual(usertype, 'coder')
+
+            Coder.query.filter_by(id=coder_id).update({'username': 'directorycoder2'}, synchronize_session=False)
+            self.assertIsNone(entry('directorycoder'))
+            self.assertEqual(entry('directorycoder2'), ('coder', coder_id))
+
+            with self.assertRaises(exc.IntegrityError):
+                Coder.query.filter_by(id=coder_id).update({'username': 'mentor1'}, synchronize_session=False)
+            db.session.rollback()
+
+            db.session.execute(Coder.__table__.insert().values(username='directorycoder'))
+            Coder.query.filter_by(username='directorycoder').delete(synchronize_session=False)
+            db.session.commit()
+            self.assertIsNone(entry('directorycoder'))
+            self.assertEqual(entry('mentor1')[0], 'mentor')
+
+    def test_b4_auth0_client_retries_only_unsent_requests(self):
+        '''Test that the auth0 client retries a connection that was refused, but
+           not one lost after the request was sent, and that a failing request
+           of any kind is recorded by the circuit breaker'''
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        client = Auth0Client('http://127.0.0.1:{}'.format(port), backoff=0,
+                             breaker=CircuitBreaker(threshold=100, reset_timeout=60))
+        sent = []
+        post = client.session.post
+        client.session.post = lambda *args, **kwargs: sent.append(args) or post(*args, **kwargs)
+
+        # nothing listening: refused, so retried
+        with self.assertRaises(Auth0Error) as error:
+            client.post('/dbconnections/signup', {})
+        self.assertEqual(error.exception.error['code'], 'auth0_unavailable')
+        self.assertEqual(len(sent), client.max_retries + 1)
+
+        # the connection is dropped once the request has been read: not retried
+        listener.listen(1)
+
+        def drop_connection():
+            connection, address = listener.accept()
+            connection.recv(65536)
+            connection.close()
+        threading.Thread(target=drop_connection, daemon=True).start()
+        del sent[:]
+        with self.assertRaises(Auth0Error) as error:
+            client.post('/dbconnections/signup', {})
+        listener.close()
+        self.assertEqual(error.exception.error['code'], 'auth0_connection_lost')
+        self.assertEqual(len(sent), 1)
+
+        # an unexpected request error during a half open trial re-opens the
+        # breaker, rather than leaving the trial running forever
+        client = Auth0Client('http://', breaker=CircuitBreaker(threshold=1, reset_timeout=0))
+        client.breaker.record_failure()
+        self.assertEqual(client.breaker.state, 'half_open')
+        with self.assertRaises(Auth0Error) as error:
+            client.post('/dbconnections/signup', {})
+        self.assertEqual(error.exception.error['code'], 'auth0_request_failed')
+        self.assertEqual(client.breaker.failures, 2)
+        self.assertTrue(client.breaker.allow())
+
+    def test_b5_auth0_client_retries_only_unprocessed_statuses(self):
+        '''Test that the auth0 client retries a 429 or 503 (after its Retry-After,
+           unless that is too long), but not a 502 or 504 from a gateway'''
+        responses, requests_seen = [], []
+
+        class StubAuth0(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                requests_seen.append(self.path)
+                status, headers = responses.pop(0) if responses else (200, {})
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), StubAuth0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = Auth0Client('http://127.0.0.1:{}'.format(server.server_port), backoff=0,
+                             breaker=CircuitBreaker(threshold=100, reset_timeout=60))
+        try:
+            responses.extend([(429, {'Retry-After': '0'}), (503, {})])
+            self.assertEqual(client.post('/dbconnections/signup', {}), {})
+            self.assertEqual(len(requests_seen), 3)
+
+            for status in (502, 504):
+                del requests_seen[:]
+                responses.append((status, {}))
+                with self.assertRaises(Auth0Error) as error:
+                    client.post('/dbconnections/signup', {})
+                self.assertEqual(error.exception.error['code'], 'auth0_unavailable')
+                self.assertEqual(len(requests_seen), 1)
+
+            del requests_seen[:]
+            responses.append((503, {'Retry-After': str(client.max_retry_after + 60)}))
+            with self.assertRaises(Auth0Error) as error:
+                client.post('/dbconnections/signup', {})
+            self.assertEqual(len(requests_seen), 1)
+            self.assertEqual(client.breaker.failures, 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_c_check_get_user_info_success(self):
         '''Test the user info endpoint to get user, with proper token'''
         res = self.client().get('/userinfo/mentor1', headers=mentor_headers)
@@ -112,6 +628,128 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertFalse(data['success'])
 
+    def test_e2_get_all_coders_paginated(self):
+        '''Test that the get_all_coders endpoint pages through coders with limit/cursor'''
+        res = self.client().get('coders?limit=2', headers=mentor_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['coders']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        next_res = self.client().get('coders?limit=2&cursor={}'.format(data['next_cursor']), headers=mentor_headers)
+        next_data = json.loads(next_res.data)
+
+        self.assertEqual(next_res.status_code, 200)
+        self.assertEqual(len(next_data['coders']), 1)
+        self.assertIsNone(next_data['next_cursor'])
+        self.assertNotIn(next_data['coders'][0]['id'], [coder['id'] for coder in data['coders']])
+
+    def test_e3_get_all_coders_bad_cursor(self):
+        '''Test that the get_all_coders endpoint rejects a malformed cursor, or
+           one that doesn't wrap an integer id'''
+        res = self.client().get('coders?cursor=not-a-cursor', headers=mentor_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+        for after in (True, 1.5, '1', None):
+            cursor = base64.urlsafe_b64encode(json.dumps({'after': after}).encode()).decode()
+            res = self.client().get('coders?cursor=' + cursor, headers=mentor_headers)
+            self.assertEqual(res.status_code, 400, after)
+
+    def test_e3_get_all_coders_bad_limit(self):
+        '''Test that the get_all_coders endpoint rejects a limit that isn't a
+           whole number from 1 to the largest page size'''
+        for limit in ('abc', '1.5', '0', '-2', '100000'):
+            res = self.client().get('coders?limit=' + limit, headers=mentor_headers)
+            self.assertEqual(res.status_code, 400, limit)
+            self.assertFalse(json.loads(res.data)['success'])
+
+    def test_e4_get_all_coders_summary_view(self):
+        '''Test that the summary view of get_all_coders leaves out snippets and includes snippet counts'''
+        res = self.client().get('coders?view=summary', headers=mentor_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['coders']), 3)
+        for coder in data['coders']:
+            self.assertEqual(sorted(coder.keys()), ['id', 'mentor_id', 'snippet_count', 'username'])
+
+        res = self.client().get('coders?fields=id,snippets.snippet_name', headers=mentor_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for coder in data['coders']:
+            self.assertEqual(sorted(coder.keys()), ['id', 'snippets'])
+            for snippet in coder['snippets']:
+                self.assertEqual(list(snippet.keys()), ['snippet_name'])
+
+    def test_e5_get_all_coders_streamed(self):
+        '''Test that get_all_coders and get_mentors stream the whole list as
+           chunked JSON (the same bytes as a normal response) or as NDJSON'''
+        for path, headers in [('coders', mentor_headers), ('mentors', coder_headers)]:
+            res = self.client().get(path, headers=headers)
+            streamed = self.client().get(path + '?stream=json', headers=headers)
+
+            self.assertEqual(streamed.status_code, 200)
+            self.assertEqual(streamed.data, res.data)
+
+            streamed = self.client().get(path + '?stream=ndjson&view=summary', headers=headers)
+            rows = [json.loads(line) for line in streamed.data.decode().splitlines()]
+
+            self.assertEqual(streamed.status_code, 200)
+            self.assertEqual(streamed.mimetype, 'application/x-ndjson')
+            self.assertEqual([row['id'] for row in rows], [row['id'] for row in json.loads(res.data)[path]])
+
+        res = self.client().get('coders?stream=xml', headers=mentor_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_e6_list_responses_match_to_dict(self):
+        '''Test that the list endpoints' serializers write the same bytes as
+           jsonify() of the models' to_dict()'''
+        mentor_ids, coder_ids = self.add_mock_users('é', 2, 2, 2)
+        try:
+            for fields, snippet_fields, query in [
+                    (None, None, ''),
+                    (Coder.SUMMARY_FIELDS, Snippet.SUMMARY_FIELDS, '?view=summary'),
+                    (('id', 'snippets'), ('snippet_name', 'code'), '?fields=id,snippets.snippet_name,snippets.code')]:
+                with self.app.app_context():
+                    coders = Coder.query.order_by(Coder.id).all()
+                    mentors = Mentor.query.order_by(Mentor.id).all()
+                    expected_coders = jsonify({
+                        "success": True,
+                        "coders": [coder.to_dict(fields, snippet_fields) for coder in coders],
+                        "next_cursor": None}).get_data()
+                    expected_mentors = jsonify({
+                        "success": True,
+                        "mentors": [mentor.to_dict(fields, snippet_fields) for mentor in mentors],
+                        "next_cursor": None}).get_data()
+
+                res = self.client().get('/coders' + query, headers=mentor_headers)
+                self.assertEqual(res.data, expected_coders)
+                res = self.client().get('/mentors' + query, headers=coder_headers)
+                self.assertEqual(res.data, expected_mentors)
+        finally:
+            self.remove_mock_users(mentor_ids, coder_ids)
+
+    def test_e7_fields_in_any_order_share_a_serializer(self):
+        '''Test that the same fields listed in another order or more than once
+           give the same response from the same serializer'''
+        res = self.client().get('coders?fields=id,username,snippets.id', headers=mentor_headers)
+        self.assertEqual(res.status_code, 200)
+        built = coder_serializer.cache_info().currsize
+
+        for query in ['username,id,snippets.id', 'id,id,username,snippets.id,snippets.id',
+                      'snippets.id,username,snippets,id']:
+            other = self.client().get('coders?fields=' + query, headers=mentor_headers)
+            self.assertEqual(other.status_code, 200)
+            self.assertEqual(other.data, res.data)
+        self.assertEqual(coder_serializer.cache_info().currsize, built)
+        for coder in json.loads(res.data)['coders']:
+            self.assertEqual(sorted(coder.keys()), ['id', 'snippets', 'username'])
+
     def test_f_get_available_coders_success(self):
         '''Test the get_available_coders endpoint with valid mentor token/RBAC permissions'''
         res = self.client().get('coders/available', headers=mentor_headers)
@@ -144,6 +782,27 @@ class FuncsterCase(unittest.TestCase):
 
         self.assertEqual(confirm_data['mentor'], 'mentor2')
 
+    def test_h_select_mentor_unchanged(self):
+        '''Test the select_mentor endpoint with the coder's current mentor (given as a
+           string, as a client may send it), which changes nothing'''
+        before = self.client().get('/userinfo/coder2', headers=coder_headers)
+
+        res = self.client().patch('/coder/2/mentor', json={ 'mentorId': '3'}, headers=coder_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['message'], 'This mentor was already the mentor for this coder.')
+
+        '''the coder's row wasn't updated, so their userinfo etag still matches'''
+        res = self.client().get('/userinfo/coder2', headers=dict(coder_headers, **{'If-None-Match': before.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_h2_select_mentor_bad_id(self):
+        '''Test the select_mentor endpoint with ids that aren't whole numbers'''
+        for mentor_id in (True, 3.9, '3.9', None):
+            res = self.client().patch('/coder/2/mentor', json={'mentorId': mentor_id}, headers=coder_headers)
+            self.assertEqual(res.status_code, 400, mentor_id)
+
     def test_i_select_mentor_fail(self):
         '''Test the select_mentor endpoint with a mentor token, which does not have RBAC permissions
            to change the mentor for a coder'''
@@ -237,6 +896,80 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(data['snippet_name'], 'Add a bird')
         self.assertEqual(data['code'][:18], 'def add_a_bird(s):')
     
+    def test_n2_get_snippet_not_modified(self):
+        '''Test that get_snippet answers 304 while the client's ETag is current,
+           without loading the snippet's code, and a new ETag once it changes'''
+        res = self.client().get('/snippet/9', headers=coder_headers)
+        etag = res.headers.get('ETag')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(etag)
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        headers = dict(coder_headers, **{'If-None-Match': etag})
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().get('/snippet/9', headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers.get('ETag'), etag)
+        self.assertFalse(any('code_blobs' in statement for statement in statements))
+
+        # any update of the snippet changes its ETag
+        with self.app.app_context():
+            snippet = Snippet.query.get(9)
+            comments = snippet.comments
+            snippet.comments = 'changed'
+            snippet.update()
+        try:
+            res = self.client().get('/snippet/9', headers=headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['comments'], 'changed')
+            self.assertNotEqual(res.headers.get('ETag'), etag)
+        finally:
+            with self.app.app_context():
+                snippet = Snippet.query.get(9)
+                snippet.comments = comments
+                snippet.update()
+
+    def test_n3_list_endpoints_not_modified(self):
+        '''Test that /coders and /userinfo answer 304 while the client's ETag is
+           current, and a full response once one of their rows changes'''
+        mentor_ids, coder_ids = self.add_mock_users('n', 1, 1, 1)
+        try:
+            for path, headers in [('/coders', mentor_headers),
+                                  ('/coders?view=summary', mentor_headers),
+                                  ('/userinfo/nm0', mentor_headers),
+                                  ('/userinfo/nc0_0', coder_headers)]:
+                res = self.client().get(path, headers=headers)
+                etag = res.headers.get('ETag')
+                self.assertEqual(res.status_code, 200)
+
+                headers = dict(headers, **{'If-None-Match': etag})
+                res = self.client().get(path, headers=headers)
+                self.assertEqual(res.status_code, 304, path)
+
+                # a new snippet for the mock coder shows up in all of them
+                with self.app.app_context():
+                    snippet = Snippet(snippet_name='new', code='pass', coder_id=coder_ids[0])
+                    db.session.add(snippet)
+                    db.session.commit()
+                self.app.extensions['response_cache'].clear()
+                res = self.client().get(path, headers=headers)
+                self.assertEqual(res.status_code, 200, path)
+                self.assertNotEqual(res.headers.get('ETag'), etag)
+        finally:
+            self.remove_mock_users(mentor_ids, coder_ids)
+
     def test_o_get_snippet_fail(self):
         '''Test the get_snippet endpoint with improper token/permissions'''
         res = self.client().get('/snippet/9', headers=invalid_headers)
@@ -275,6 +1008,53 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(len(confirm_data['snippets']), 1)
         self.assertEqual(confirm_data['snippets'][0]['snippet_name'], "Testing Function")
     
+    def test_p2_snippet_code_blobs(self):
+        '''Test that identical code is stored once, that code over
+           CODE_COMPRESS_THRESHOLD bytes is stored compressed and reads back
+           unchanged, and that pruning only deletes blobs no snippet uses'''
+        mentor_ids, coder_ids = self.add_mock_users('blob', 1, 1, 0)
+        small = 'def blob_test(x):\n\treturn x'
+        large = ''.join('def blob_test_{0}(x):\n\treturn x + {0}  # é\n'.format(i) for i in range(200))
+        self.assertGreater(len(large.encode('utf-8')), CODE_COMPRESS_THRESHOLD)
+        try:
+            with self.app.app_context():
+                snippets = [Snippet(coder_id=coder_ids[0], snippet_name='blob', code=code)
+                            for code in (small, small, large)]
+                db.session.add_all(snippets)
+                db.session.commit()
+                self.assertEqual(snippets[0].code_hash, snippets[1].code_hash)
+                self.assertEqual(CodeBlob.query.filter_by(sha256=snippets[0].code_hash).count(), 1)
+                small_hash, large_hash = snippets[0].code_hash, snippets[2].code_hash
+                snippet_ids = [snippet.id for snippet in snippets]
+
+            with self.app.app_context():
+                blob = CodeBlob.query.get(large_hash)
+                self.assertTrue(blob.compressed)
+                self.assertLess(len(blob.data), len(large.encode('utf-8')))
+                self.assertFalse(CodeBlob.query.get(small_hash).compressed)
+                self.assertEqual(Snippet.query.get(snippet_ids[2]).code, large)
+                self.assertEqual(Snippet.query.get(snippet_ids[0]).code, small)
+
+                # a blob nothing refers to goes, the ones in use stay
+                orphan = CodeBlob.store('def blob_orphan():\n\tpass').sha256
+                db.session.commit()
+                self.assertGreaterEqual(CodeBlob.prune(), 1)
+                self.assertIsNone(CodeBlob.query.get(orphan))
+                self.assertIsNotNone(CodeBlob.query.get(small_hash))
+                self.assertIsNotNone(CodeBlob.query.get(large_hash))
+
+                # kept while the other snippet uses it, pruned once none does
+                Snippet.query.get(snippet_ids[0]).delete()
+                CodeBlob.prune()
+                self.assertIsNotNone(CodeBlob.query.get(small_hash))
+                Snippet.query.get(snippet_ids[1]).delete()
+                CodeBlob.prune()
+                self.assertIsNone(CodeBlob.query.get(small_hash))
+        finally:
+            self.remove_mock_users(mentor_ids, coder_ids)
+            with self.app.app_context():
+                CodeBlob.prune()
+
     def test_q_post_new_snippet_fail(self):
         '''Test the post_new_snippet endpoint with mentor token (does not have RBAC permissions to post new snippet)'''
         snippet_body = {
@@ -358,6 +1138,37 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(confirm_data['snippet_name'], 'Reviewed adasd')
         self.assertFalse(confirm_data['needs_review'])
 
+    def test_r3_get_snippet_revisions(self):
+        '''Test that revisions posted to a snippet are kept, and that each can be fetched with its code'''
+        res = self.client().get('/snippet/11/revisions', headers=coder_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        numbers = [revision['number'] for revision in data['revisions']]
+        self.assertGreaterEqual(len(numbers), 2)
+        self.assertEqual(numbers, list(range(1, len(numbers) + 1)))
+
+        '''Confirm that the first revision is the snippet as it was before any changes'''
+        res = self.client().get('/snippet/11/revisions/1', headers=coder_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['snippet_name'], 'adasd')
+        self.assertEqual(data['code'], 'asdwfwefwesdcf')
+
+        '''Confirm that the latest revision matches the snippet itself'''
+        res = self.client().get('/snippet/11/revisions/{}'.format(numbers[-1]), headers=coder_headers)
+        data = json.loads(res.data)
+        snippet = json.loads(self.client().get('/snippet/11', headers=coder_headers).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['snippet_name'], snippet['snippet_name'])
+        self.assertEqual(data['code'], snippet['code'])
+
+        res = self.client().get('/snippet/11/revisions/{}'.format(numbers[-1] + 1), headers=coder_headers)
+        self.assertEqual(res.status_code, 404)
+
     def test_s_post_revised_snippet_fail(self):
         ''' Test the post_revised_snippet endpoint with request for nonexistent snippet'''
         snippet_body = {
@@ -424,6 +1235,38 @@ class FuncsterCase(unittest.TestCase):
 
         self.assertEqual(confirm_data['snippet_name'], 'Revised adasd')
 
+    def test_s4_post_revised_snippet_edit_conflict(self):
+        '''Test that editing or deleting a snippet someone else changed since it
+           was read is a 409, and changes nothing'''
+        def changed_meanwhile(mapper, connection, snippet):
+            connection.execute(Snippet.__table__.update()
+                               .where(Snippet.id == snippet.id)
+                               .values(version=Snippet.version + 1))
+
+        snippet_body = {
+            "coderId": 2,
+            "userId": 2,
+            "usertype": "Coder",
+            "name": "Conflicting adasd",
+            "code": "def my_conflicting_function(a):\n\treturn 42"
+        }
+        for event_name, send in [
+                ('before_update', lambda: self.client().patch('/snippet/11', json=snippet_body, headers=coder_headers)),
+                ('before_delete', lambda: self.client().delete('/snippet/11', json={'coderId': 2}, headers=coder_headers))]:
+            event.listen(Snippet, event_name, changed_meanwhile)
+            try:
+                res = send()
+            finally:
+                event.remove(Snippet, event_name, changed_meanwhile)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 409)
+            self.assertFalse(data['success'])
+
+            confirm_res = self.client().get('/snippet/11', headers=coder_headers)
+            self.assertEqual(confirm_res.status_code, 200)
+            self.assertNotEqual(json.loads(confirm_res.data)['snippet_name'], 'Conflicting adasd')
+
     def test_t_delete_snippet_success(self):
         '''Test the delete snippet endpoint with a proper request/token/RBAC permissions'''
         res = self.client().delete('/snippet/11', json={ 'coderId': 2}, headers=coder_headers)
@@ -439,6 +1282,31 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(confirm_res.status_code, 404)
         self.assertFalse(confirm_data['success'])
 
+    def test_t2_delete_snippet_invalidates_cached_responses(self):
+        '''Test that the read endpoints are served from the response cache, and
+           that a write drops the cached responses it affects'''
+        mentor_ids, coder_ids = self.add_mock_users('t', 1, 1, 1)
+        try:
+            endpoints = [('/userinfo/tc0_0', coder_headers),
+                         ('/userinfo/tm0', mentor_headers),
+                         ('/coders', mentor_headers)]
+            for path, headers in endpoints:
+                self.count_queries(path, headers)
+                self.assertEqual(self.count_queries(path, headers), 0)
+
+            with self.app.app_context():
+                snippet_id = Snippet.query.filter_by(coder_id=coder_ids[0]).first().id
+            res = self.client().delete('/snippet/{}'.format(snippet_id),
+                                       json={'coderId': coder_ids[0]}, headers=coder_headers)
+            self.assertEqual(res.status_code, 200)
+
+            for path, headers in endpoints:
+                self.assertGreater(self.count_queries(path, headers), 0)
+            data = json.loads(self.client().get('/userinfo/tc0_0', headers=coder_headers).data)
+            self.assertEqual(data['snippets'], [])
+        finally:
+            self.remove_mock_users(mentor_ids, coder_ids)
+
     def test_u_delete_snippet_fail(self):
         '''Test the delete snippet endpoint with improper token/RBAC permissions'''
         res = self.client().delete('/snippet/7', json={ 'coderId': 1}, headers=mentor_headers)
@@ -469,6 +1337,284 @@ class FuncsterCase(unittest.TestCase):
         self.assertEqual(confirm_res.status_code, 200)
         self.assertTrue(confirm_data['success'])
 
+    def test_v_list_endpoints_query_count_is_constant(self):
+        '''Test that the list endpoints load their object graphs in a fixed number
+           of queries, however many mentors/coders/snippets there are'''
+        endpoints = [
+            ('/coders', mentor_headers),
+            ('/coders/available', mentor_headers),
+            ('/mentors', coder_headers),
+            ('/userinfo/vm0', mentor_headers),
+            ('/userinfo/vc0_0', coder_headers)]
+
+        small = self.add_mock_users('v', 1, 1, 1)
+        try:
+            before = [self.count_queries(path, headers) for path, headers in endpoints]
+            large = self.add_mock_users('w', 10, 5, 4)
+            try:
+                after = [self.count_queries(path, headers) for path, headers in endpoints]
+            finally:
+                self.remove_mock_users(*large)
+        finally:
+            self.remove_mock_users(*small)
+
+        self.assertEqual(before, after)
+
+    def test_v2_post_new_snippet_does_not_load_snippets(self):
+        '''Test that saving a snippet inserts it without loading the coder's
+           other snippets (however many there are)'''
+        mentor_ids, coder_ids = self.add_mock_users('x', 1, 1, 20)
+        snippet_body = {
+            "coderId": coder_ids[0],
+            "name": "Another Function",
+            "code": "def another_function(a):\n\treturn 43",
+            "needsReview": False,
+            "comments": ''
+        }
+        try:
+            res, statements = self.record_queries(
+                lambda client: client.post('/snippet', json=snippet_body, headers=coder_headers))
+            self.assertEqual(res.status_code, 200)
+            selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+            self.assertFalse([s for s in selects if 'FROM snippet' in s], selects)
+
+            res = self.client().get('/userinfo/xc0_0', headers=coder_headers)
+            self.assertEqual(len(json.loads(res.data)['snippets']), 21)
+        finally:
+            with self.app.app_context():
+                SnippetRevision.query.filter(SnippetRevision.snippet_id.in_(
+                    db.session.query(Snippet.id).filter(Snippet.coder_id.in_(coder_ids)))).delete(synchronize_session=False)
+                db.session.commit()
+            self.remove_mock_users(mentor_ids, coder_ids)
+
+    def test_w_hot_queries_use_indexes(self):
+        '''Test (with EXPLAIN, on a seeded dataset) that the hot lookups by foreign key
+           and the unmentored-coders listing use indexes rather than sequential scans'''
+        # (query, table, the index it must use, whether that is only checked on postgres)
+        hot_queries = [
+            # mentor.coders / Mentor.with_coders()
+            (Coder.query.filter(Coder.mentor_id.in_([1, 3])), 'coders', 'ix_coders_mentor_id', False),
+            # coder.snippets / Coder.with_snippets()
+            (Snippet.query.filter(Snippet.coder_id.in_([1, 2])), 'snippet', 'ix_snippet_coder_id', False),
+            # '/coders/available' page (sqlite prefers a range scan of ix_coders_mentor_id on
+            # (NULL, rowid), so only postgres' plan shows whether the partial index is there)
+            (Coder.query.filter_by(mentor_id=None).filter(Coder.id > 1).order_by(Coder.id).limit(50),
+             'coders', 'ix_coders_unmentored', True),
+        ]
+
+        with self.app.app_context():
+            connection = db.engine.connect()
+            transaction = connection.begin()
+            try:
+                # seed enough rows for the planner to care, then throw them away again
+                connection.execute(Mentor.__table__.insert(),
+                    [{'username': 'xm{}'.format(i)} for i in range(200)])
+                mentor_id = connection.execute(db.select([db.func.max(Mentor.id)])).scalar()
+                connection.execute(Coder.__table__.insert(),
+                    [{'username': 'xc{}'.format(i), 'mentor_id': mentor_id if i % 10 else None}
+                     for i in range(2000)])
+                coder_id = connection.execute(db.select([db.func.max(Coder.id)])).scalar()
+                connection.execute(Snippet.__table__.insert(),
+                    [{'snippet_name': 'x', 'needs_review': False, 'coder_id': coder_id}
+                     for i in range(5000)])
+
+                dialect = connection.dialect
+                if dialect.name == 'postgresql':
+                    connection.execute('ANALYZE coders')
+                    connection.execute('ANALYZE snippet')
+                    # with seq scans priced out, a seq scan in the plan means no usable index
+                    connection.execute('SET LOCAL enable_seqscan = off')
+                    explain = 'EXPLAIN '
+                elif dialect.name == 'sqlite':
+                    explain = 'EXPLAIN QUERY PLAN '
+                else:
+                    self.skipTest('EXPLAIN check not implemented for {}'.format(dialect.name))
+
+                for query, table, index, postgres_only in hot_queries:
+                    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+                    plan = '\n'.join(str(row[-1]) for row in connection.execute(explain + sql))
+
+                    self.assertNotIn('Seq Scan on {}'.format(table), plan)
+                    self.assertNotIn('SCAN {}\n'.format(table), plan + '\n')
+                    self.assertNotIn('SCAN TABLE {}'.format(table), plan)
+                    if dialect.name == 'postgresql' or not postgres_only:
+                        self.assertIn(index, plan)
+            finally:
+                transaction.rollback()
+                connection.close()
+
+
+    def test_x_get_stats_fail(self):
+        '''Test the stats endpoint with a token lacking the get:stats permission'''
+        res = self.client().get('/stats', headers=coder_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+    def test_x2_pool_stats_track_waits(self):
+        '''Test that the connection pool counts checkouts, their waits and timeouts'''
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        connection = engine.connect()
+        try:
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+            pool = engine.pool
+            self.assertEqual(pool.checkedout(), 1)
+            self.assertEqual(pool.checkouts, 2)
+            self.assertEqual(pool.timeouts, 1)
+            self.assertGreaterEqual(pool.max_wait, 0.05)
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def test_x3_readiness_after_warmup(self):
+        '''Test that a worker is alive from the start, but only ready once it
+           has warmed up, which fails while its database can't be reached'''
+        res = self.client().get('/healthz')
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/readyz')
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(json.loads(res.data)['ready'])
+
+        self.assertTrue(self.app.extensions['warmup'].run())
+        res = self.client().get('/readyz')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(set(data['steps']), {'signing_keys', 'database', 'queries', 'serializers'})
+
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'missing', 'funcster.db'))
+        warmup = Warmup(app)
+        self.assertFalse(warmup.run())
+        self.assertIn('error', warmup.status()['steps']['database'])
+
+    def test_x4_metrics(self):
+        '''Test that requests are counted by route, with cumulative histogram
+           buckets, that '/metrics' needs the metrics token or 'get:stats', and
+           that the counts (and connection pool gauges) of processes sharing a
+           directory are added up, and that unknown methods share one label'''
+        self.app.config['METRICS_TOKEN'] = 'metrics-token'
+        for i in range(2):
+            self.client().get('/coders?limit=1', headers=mentor_headers)
+        res = self.client().get('/metrics', headers={'Authorization': 'Bearer metrics-token'})
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain; version=0.0.4'))
+        samples = dict(line.rsplit(' ', 1) for line in res.get_data(as_text=True).splitlines()
+                       if not line.startswith('#'))
+        labels = 'route="/coders",method="GET"'
+        self.assertGreaterEqual(int(samples['funcster_http_requests_total{' + labels + ',status="200"}']), 2)
+        count = samples['funcster_http_request_duration_seconds_count{' + labels + '}']
+        self.assertEqual(samples['funcster_http_request_duration_seconds_bucket{' + labels + ',le="+Inf"}'], count)
+        self.assertGreater(int(samples['funcster_http_request_queries_total{' + labels + '}']), 0)
+        self.assertIn('funcster_http_request_phase_seconds_total{' + labels + ',phase="auth"}', samples)
+        # an unknown method is one series, whatever its name
+        for method in ('BREW', 'PROPFIND'):
+            self.assertEqual(self.client().open('/nowhere', method=method).status_code, 404)
+        res = self.client().get('/metrics', headers={'Authorization': 'Bearer metrics-token'})
+        text = res.get_data(as_text=True)
+        self.assertIn('funcster_http_requests_total{route="unmatched",method="other",status="404"} ', text)
+        self.assertNotIn('BREW', text)
+        self.assertNotIn('PROPFIND', text)
+        self.assertEqual(self.client().get('/metrics', headers=coder_headers).status_code, 403)
+        self.assertEqual(self.client().get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+
+        directory = tempfile.mkdtemp()
+        first, second = MetricsRegistry(directory), MetricsRegistry(directory)
+        phases = dict.fromkeys(PHASES, 0.001)
+        first.observe('/coders', 'GET', 200, 0.003, 500, phases, 2)
+        second.observe('/coders', 'GET', 200, 0.02, 5000, phases, 3)
+        second.flush()
+        text = first.render()
+        self.assertIn('funcster_http_requests_total{route="/coders",method="GET",status="200"} 2\n', text)
+        self.assertIn('funcster_http_request_duration_seconds_bucket{route="/coders",method="GET",le="0.005"} 1\n', text)
+        self.assertIn('funcster_http_request_duration_seconds_bucket{route="/coders",method="GET",le="0.025"} 2\n', text)
+        self.assertIn('funcster_http_request_queries_total{route="/coders",method="GET"} 5\n', text)
+
+        # the pool's gauges are summed over the processes, and dropped when one exits
+        stats = {'size': 2, 'checked_out': 1, 'overflow': 0, 'checkouts': 5, 'wait_time': 0.5, 'timeouts': 0}
+        first.add_collector('db_pool', lambda: pool_samples(stats))
+        second.add_collector('db_pool', lambda: pool_samples(stats))
+        second.flush()
+        text = first.render()
+        self.assertIn('# TYPE funcster_db_pool_size gauge\nfuncster_db_pool_size 4\n', text)
+        self.assertIn('funcster_db_pool_checked_out 2\n', text)
+        self.assertIn('funcster_db_pool_wait_seconds_total 1.0\n', text)
+        second.flush(final=True)
+        text = first.render()
+        self.assertIn('funcster_db_pool_size 2\n', text)
+        self.assertIn('funcster_db_pool_checkouts_total 10\n', text)
+
+    def test_y_read_replica_routing(self):
+        '''Test that read only endpoints read from a replica (here a local sqlite
+           database with a user the primary doesn't have), except for a user who
+           just wrote, and while the replica lags too far behind, and that neither
+           a replica read nor a read right after a write goes through the
+           response cache'''
+        handle, replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app = create_app()
+        setup_db(app, self.database_path, 'sqlite:///' + replica_path)
+        router = app.extensions['replica_router']
+        response_cache = app.extensions['response_cache']
+        try:
+            with app.app_context():
+                replica = db.get_engine(app, bind='replica')
+                db.Model.metadata.create_all(replica)
+                replica.execute(Mentor.__table__.insert(), id=99, username='replicamentor', version=1)
+
+            res = app.test_client().get('/userinfo/replicamentor', headers=mentor_headers)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(router.replica_reads, 1)
+
+            # a write sends the writer's reads to the primary for a while,
+            # past the response cache (which the replica's responses aren't in)
+            res = app.test_client().patch('/mentor/1/coder', json={'coderId': 2}, headers=mentor_headers)
+            self.assertEqual(res.status_code, 200)
+            res = app.test_client().get('/userinfo/replicamentor', headers=mentor_headers)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(router.sticky_reads, 1)
+            res = app.test_client().get('/userinfo/mentor1', headers=mentor_headers)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(response_cache.stats()['size'], 0)
+
+            # other users still read from the replica, until it lags too far behind
+            res = app.test_client().get('/userinfo/replicamentor', headers=coder_headers)
+            self.assertEqual(res.status_code, 200)
+            router.measure_lag = lambda: router.max_lag + 1
+            router.checked_at = None
+            res = app.test_client().get('/userinfo/replicamentor', headers=coder_headers)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(router.primary_reads, 1)
+        finally:
+            with app.app_context():
+                db.get_engine(app, bind='replica').dispose()
+            os.remove(replica_path)
+
+    def test_z_schema_version_check(self):
+        '''Test that the app only starts on a database migrated to the newest
+           migration, which SCHEMA_VERSION must name'''
+        migrations = ScriptDirectory(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+        self.assertEqual(SCHEMA_VERSION, migrations.get_current_head())
+
+        handle, database_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app = Flask(__name__)
+        setup_db(app, 'sqlite:///' + database_path)
+        try:
+            with app.app_context():
+                engine = db.get_engine(app)
+            self.assertRaises(RuntimeError, check_schema_version, app)
+            engine.execute('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL)')
+            engine.execute("INSERT INTO alembic_version VALUES ('5b2f9c4e1d07')")
+            self.assertRaises(RuntimeError, check_schema_version, app)
+            engine.execute(db.text('UPDATE alembic_version SET version_num = :version'), version=SCHEMA_VERSION)
+            check_schema_version(app)
+        finally:
+            engine.dispose()
+            os.remove(database_path)
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
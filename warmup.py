@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+import time
+from sqlalchemy import orm
+from sqlalchemy.pool import QueuePool
+
+import auth
+from models import db, row_versions, Mentor, Coder, Snippet, SignupOutbox, UserDirectory
+from serializers import coder_serializer, mentor_serializer
+
+
+# Warm-up of each gunicorn worker (see gunicorn.conf.py), if WARMUP_ON_START
+# is set: a worker warms up before it takes requests, for at most
+# WARMUP_TIMEOUT seconds (after that it serves while warm-up carries on in the
+# background). If the database can't be reached, warm-up is retried every
+# WARMUP_RETRY_INTERVAL seconds; '/readyz' reports the worker as not ready
+# until it has succeeded.
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'true').lower() in ('1', 'true', 'yes')
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', 10))
+WARMUP_RETRY_INTERVAL = float(os.environ.get('WARMUP_RETRY_INTERVAL', 5))
+
+# the field sets of the list endpoints' 'full' and 'summary' views
+VIEWS = ((Coder.FIELDS, Snippet.FIELDS), (Coder.SUMMARY_FIELDS, Snippet.SUMMARY_FIELDS))
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Warmup - does ahead of traffic what a worker's first requests would otherwise
+    pay for:
+    - signing_keys: fetches auth0's signing keys (and imports jose); optional,
+      as the keys are fetched on demand anyway if this fails
+    - database: opens the connection pool's DB_POOL_SIZE connections (and
+      measures the read replica's lag, if there is one)
+    - queries: configures the mappers and runs the hot queries once, with
+      their eager loads, on a row or two
+    - serializers: builds the list endpoints' serializers for their views
+    ready is True once all but the optional steps have succeeded; status()
+    reports it with each step's time in milliseconds (or its error)
+    EXAMPLE
+        warmup = Warmup(app, replica_router)
+        warmup.start()      # from gunicorn's post_worker_init hook
+'''
+class Warmup:
+    def __init__(self, app, replica_router=None, retry_interval=WARMUP_RETRY_INTERVAL):
+        self.app = app
+        self.replica_router = replica_router
+        self.retry_interval = retry_interval
+        self.ready = False
+        self.started = False
+        self.steps = {}     # step -> milliseconds taken, or {"error": ...}
+        self._lock = threading.Lock()
+
+    def start(self, timeout=WARMUP_TIMEOUT):
+        """Warms up in the background (retrying until it succeeds), waiting
+        at most timeout seconds for it
+        """
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+        thread = threading.Thread(target=self._run_until_ready, daemon=True)
+        thread.start()
+        thread.join(timeout)
+
+    def _run_until_ready(self):
+        while not self.run():
+            time.sleep(self.retry_interval)
+
+    def run(self):
+        """Runs every step once and returns whether the worker is ready
+        """
+        ready = True
+        for name, step, required in (('signing_keys', self.fetch_signing_keys, False),
+                                     ('database', self.connect, True),
+                                     ('queries', self.run_queries, True),
+                                     ('serializers', self.build_serializers, True)):
+            start = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    step()
+                except Exception as error:
+                    logger.warning('warm-up step %s failed: %s', name, error)
+                    self.steps[name] = {"error": str(error)}
+                    ready = ready and not required
+                    continue
+                finally:
+                    db.session.remove()
+            self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+        self.ready = ready
+        return ready
+
+    def fetch_signing_keys(self):
+        if auth.jwks_store.url:
+            auth.jwks_store.refresh(force=True)
+
+    def connect(self):
+        engine = db.get_engine(self.app)
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        connections = [engine.connect() for i in range(size)]
+        for connection in connections:
+            connection.close()
+        if self.replica_router is not None and self.replica_router.configured():
+            self.replica_router.lag()
+
+    def run_queries(self):
+        orm.configure_mappers()
+        for fields, snippet_fields in VIEWS:
+            Coder.with_snippets(fields, snippet_fields).order_by(Coder.id).limit(1).all()
+            Coder.need_mentor(fields, snippet_fields).limit(1).all()
+            Mentor.with_coders(fields, snippet_fields).order_by(Mentor.id).limit(1).all()
+        row_versions(Coder, Coder.id < 2)
+        row_versions(Snippet, Snippet.coder_id < 2)
+        UserDirectory.lookup('')
+        SignupOutbox.query.filter_by(token='').first()
+
+    def build_serializers(self):
+        for fields, snippet_fields in VIEWS:
+            coder_serializer(fields, snippet_fields)
+            mentor_serializer(fields, snippet_fields)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "steps": dict(self.steps)
+        }
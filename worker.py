@@ -0,0 +1,72 @@
+import logging
+import os
+import random
+import time
+
+from auth0_client import Auth0Error, auth0_client
+from models import db, SignupOutbox
+
+# Signup outbox worker settings: rows claimed per batch, how long (seconds) a
+# claimed row is reserved for this worker, attempts before a signup is given
+# up on, the backoff (seconds, doubled per attempt, with jitter) between
+# attempts, and how often (seconds) an idle worker looks for new signups.
+SIGNUP_BATCH_SIZE = int(os.environ.get('SIGNUP_BATCH_SIZE', 20))
+SIGNUP_LEASE = int(os.environ.get('SIGNUP_LEASE', 300))
+SIGNUP_MAX_ATTEMPTS = int(os.environ.get('SIGNUP_MAX_ATTEMPTS', 8))
+SIGNUP_RETRY_BACKOFF = float(os.environ.get('SIGNUP_RETRY_BACKOFF', 5))
+SIGNUP_POLL_INTERVAL = float(os.environ.get('SIGNUP_POLL_INTERVAL', 1))
+
+# auth0's error codes for a signup of a user it already has (not
+# 'invalid_signup', which it also returns for an email address another
+# account has, so it doesn't show that this signup created a user)
+USER_EXISTS_CODES = ('user_exists', 'username_exists')
+
+logger = logging.getLogger(__name__)
+
+
+def send_signup(signup):
+    """Sends one outbox row to auth0 and records the outcome
+    """
+    try:
+        auth0_client.signup(signup.email, signup.password, signup.username, signup.usertype.title())
+    except Auth0Error as error:
+        description = error.error.get('description', 'Auth0 signup failed')
+        if error.status_code < 500 and signup.attempts and error.error.get('code') in USER_EXISTS_CODES:
+            # an earlier attempt that timed out reached auth0 after all, and
+            # created the user; failing would remove the local user again
+            signup.done()
+        elif error.status_code < 500:
+            # auth0 turned the signup down; retrying won't change that
+            signup.fail(description)
+        elif signup.attempts + 1 >= SIGNUP_MAX_ATTEMPTS:
+            signup.fail(description)
+        else:
+            delay = SIGNUP_RETRY_BACKOFF * 2 ** signup.attempts
+            signup.retry(random.uniform(delay / 2, delay))
+        logger.warning('signup %s (%s): %s', signup.id, signup.status, description)
+    else:
+        signup.done()
+
+
+def process_signups(batch_size=SIGNUP_BATCH_SIZE):
+    """Claims one batch of due signups, sends them to auth0 (over the auth0
+    client's pooled connections) and returns how many were processed
+    """
+    batch = SignupOutbox.claim(batch_size, SIGNUP_LEASE)
+    for signup in batch:
+        send_signup(signup)
+    return len(batch)
+
+
+def run():
+    """Drains the signup outbox until stopped (needs an app context)
+    """
+    while True:
+        try:
+            count = process_signups()
+        except Exception:
+            logger.exception('processing the signup outbox failed')
+            db.session.rollback()
+            count = 0
+        if count < SIGNUP_BATCH_SIZE:
+            time.sleep(SIGNUP_POLL_INTERVAL)